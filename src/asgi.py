@@ -0,0 +1,189 @@
+'''
+ASGI入口。搜索接口（/api/search、/api/search/batch、/api/search/similar）以异步方式处理：
+查询嵌入使用异步Cohere客户端，向量查询使用 psycopg 3 的异步连接池，等待期间不占用线程，
+少量工作线程即可支撑大量并发搜索。整理结果时可能需要读取缩略图的版本号，在线程池中进行，不阻塞事件循环。
+其余接口仍由 server.py 中的Flask应用处理，响应格式与错误信息与Flask应用相同。
+
+运行方式：uvicorn asgi:app --app-dir src --host 0.0.0.0 --port 5000
+'''
+import asyncio
+import contextlib
+import json
+import logging
+
+import psycopg_pool
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import db_init
+import server
+
+
+def error_response(message:str, status_code:int) -> JSONResponse:
+    return JSONResponse({
+        "success": False,
+        "message": message
+    }, status_code=status_code)
+
+
+def busy_response() -> JSONResponse:
+    """连接池或流式搜索名额耗尽时的响应，与 server.busy_response 相同"""
+    response = error_response("服务器繁忙，请稍后重试", 503)
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+# 等待数据库连接超时时抛出的异常
+POOL_TIMEOUT_ERRORS = (TimeoutError, psycopg_pool.PoolTimeout)
+
+
+def _accept_mimetypes(request:Request) -> MIMEAccept:
+    return parse_accept_header(request.headers.get('accept'), MIMEAccept)
+
+
+async def _resume(first:list[tuple] | None, batches):
+    if first is not None:
+        yield first
+    async for batch in batches:
+        yield batch
+
+
+async def _hold_stream_slot(batches):
+    """server.hold_stream_slot 的异步版本"""
+    try:
+        async for batch in batches:
+            yield batch
+    finally:
+        await batches.aclose()
+        server.stream_slots.release()
+
+
+async def search_stream_events(stream:str, first:list[tuple] | None, batches, k:int, page:int, **fields):
+    """server.search_stream_events 的异步版本"""
+    total = 0
+    sent = 0
+    try:
+        yield server.stream_event(stream, "meta", {"success": True, **fields, "k": k, "page": page})
+        async for batch in _resume(first, batches):
+            total += len(batch)
+            results = await asyncio.to_thread(server.present_results, batch)
+            sent += len(results)
+            if results:
+                yield server.stream_event(stream, "results", {"results": results})
+    except Exception as e:
+        logging.error(f"Failed to stream search results: {e}")
+        yield server.stream_event(stream, "error", {"success": False, "message": f"搜索出错: {str(e)}"})
+        return
+    finally:
+        await batches.aclose()
+    yield server.stream_event(stream, "done", {"count": sent, "has_more": k > 0 and total == k})
+
+
+async def search_images(request:Request) -> JSONResponse | StreamingResponse:
+    """搜索图像的API端点"""
+    query = request.query_params.get('q', '')
+    if not query:
+        return error_response("查询不能为空", 400)
+    search_args = server.parse_search_args(request.query_params)
+    if search_args is None:
+        return error_response("无效的分页参数", 400)
+    max_dist, k, page, ef_search = search_args
+    try:
+        stream = server.parse_stream_format(request.query_params, _accept_mimetypes(request))
+    except ValueError:
+        return error_response("无效的流式格式", 400)
+
+    try:
+        if stream:
+            # 与Flask应用共用流式搜索名额，不等待，名额耗尽时直接返回503
+            if not server.stream_slots.acquire(blocking=False):
+                return busy_response()
+            # 取出第一批结果后再开始响应，嵌入或连接数据库失败时仍能返回错误状态码
+            batches = _hold_stream_slot(server.queryer_client.query_stream_async(
+                query, max_dist=max_dist, k=k or None, page=page, ef_search=ef_search, batch_size=server.STREAM_BATCH_SIZE))
+            first = await anext(batches, None)
+            return StreamingResponse(search_stream_events(stream, first, batches, k, page, query=query),
+                                     media_type=server.STREAM_FORMATS[stream],
+                                     headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        # 热重载会替换 server.queryer_client，因此每次请求时读取
+        results = await server.queryer_client.query_async(query, max_dist=max_dist, k=k or None, page=page, ef_search=ef_search)
+        return JSONResponse(await asyncio.to_thread(server.search_response, results, k, page, query=query))
+    except POOL_TIMEOUT_ERRORS as e:
+        logging.warning(f"Search rejected: {e}")
+        return busy_response()
+    except Exception as e:
+        logging.error(f"Failed to search: {e}")
+        return error_response(f"搜索出错: {str(e)}", 500)
+
+
+async def search_similar_images(request:Request) -> JSONResponse:
+    """以已索引图片为示例搜索相似图像的API端点，直接使用已保存的向量"""
+    file_name = request.path_params['file_name']
+    search_args = server.parse_search_args(request.query_params)
+    if search_args is None:
+        return error_response("无效的分页参数", 400)
+    max_dist, k, page, ef_search = search_args
+
+    try:
+        results = await server.queryer_client.query_similar_async(file_name, max_dist=max_dist, k=k or None, page=page, ef_search=ef_search)
+        return JSONResponse(await asyncio.to_thread(server.search_response, results, k, page, file_name=file_name))
+    except POOL_TIMEOUT_ERRORS as e:
+        logging.warning(f"Search rejected: {e}")
+        return busy_response()
+    except KeyError:
+        return error_response("图像未被索引", 404)
+    except Exception as e:
+        logging.error(f"Failed to search similar images: {e}")
+        return error_response(f"搜索出错: {str(e)}", 500)
+
+
+async def search_images_batch(request:Request) -> JSONResponse:
+    """批量搜索图像的API端点，所有查询共用一次嵌入调用与一次数据库查询"""
+    body = await request.body()
+    # 与Flask应用相同的请求体大小上限
+    if len(body) > server.app.config['MAX_CONTENT_LENGTH']:
+        return error_response("上传的内容过大", 413)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    try:
+        queries, max_dist, k, ef_search = server.parse_batch_search(data)
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+    try:
+        results = await server.queryer_client.query_many_async(queries, max_dist=max_dist, k=k, ef_search=ef_search)
+        return JSONResponse(await asyncio.to_thread(server.batch_search_response, queries, results, k))
+    except POOL_TIMEOUT_ERRORS as e:
+        logging.warning(f"Search rejected: {e}")
+        return busy_response()
+    except Exception as e:
+        logging.error(f"Failed to search in batch: {e}")
+        return error_response(f"搜索出错: {str(e)}", 500)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app:Starlette):
+    yield
+    await db_init.close_async_pool()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/search', search_images, methods=['GET']),
+        Route('/api/search/batch', search_images_batch, methods=['POST']),
+        Route('/api/search/similar/{file_name:path}', search_similar_images, methods=['GET']),
+        # 其余接口交给Flask应用，在线程池中运行
+        Mount('/', app=WSGIMiddleware(server.app)),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan
+)
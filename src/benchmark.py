@@ -0,0 +1,214 @@
+import argparse
+import logging
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import PIL.Image
+from pgvector.psycopg2 import register_vector
+
+import bulk_writer
+import db_init
+import indexer
+import vector_store
+
+
+# 在子进程中导入模块，输出导入耗时、峰值内存（KB）与已加载的重量级依赖
+STARTUP_PROBE = """
+import resource, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in ("torch", "clip", "onnxruntime", "tokenizers") if name in sys.modules]
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, ",".join(heavy) or "-")
+"""
+
+
+def benchmark_thumbnails(docs_path: pathlib.Path, workers: int) -> None:
+    '''
+    比较串行全分辨率解码与多进程缩小解码两种缩略图生成方式的吞吐量
+
+    :param docs_path: 图片文件夹路径
+    :param workers: 多进程模式下使用的进程数
+    '''
+    # 生成缩略图不使用嵌入客户端与向量存储，传入临时的NumPy存储以免连接数据库
+    with tempfile.TemporaryDirectory() as store_dir:
+        indexer_client = indexer.indexer(embed=None, store=vector_store.numpy_store(pathlib.Path(store_dir)))  # type: ignore[arg-type]
+        cases = [
+            ("serial, full decode", 1, False),
+            ("serial, reduced decode", 1, True),
+            (f"{workers} processes, reduced decode", workers, True),
+        ]
+        for name, case_workers, reduced_decode in cases:
+            with tempfile.TemporaryDirectory() as thumbnails_dir:
+                start = time.perf_counter()
+                result = indexer_client.create_thumbnails(docs_path=docs_path,
+                                                          thumbnails_path=pathlib.Path(thumbnails_dir),
+                                                          recreate=True,
+                                                          workers=case_workers,
+                                                          reduced_decode=reduced_decode)
+                elapsed = time.perf_counter() - start
+            print(f"{name:<32} {result['success']:>6} images  {elapsed:8.2f} s  {result['success'] / elapsed:8.2f} images/s")
+
+
+def benchmark_ingest(count: int, batch_size: int, row_sample: int) -> None:
+    '''
+    比较逐行插入提交与批量COPY写入两种方式的向量写入吞吐量。
+    测试在临时创建的 embeddings_benchmark 表中进行，结束后删除
+
+    :param count: 批量写入的向量数量
+    :param batch_size: 批量写入时每批的向量数量
+    :param row_sample: 逐行插入时写入的向量数量
+    '''
+    db_init.initialize_database()
+    conn = db_init.get_db_connection()
+    register_vector(conn)
+    table = "embeddings_benchmark"
+    rng = np.random.default_rng(0)
+
+    def rows(n: int, prefix: str):
+        for i in range(n):
+            yield (f"{prefix}{i}.jpg", rng.random(1024, dtype=np.float32), 1000, 1000, f"{i:064x}")
+
+    def recreate_table() -> None:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.commit()
+        db_init.ensure_embeddings_table(table, 1024)
+
+    try:
+        recreate_table()
+        start = time.perf_counter()
+        with conn.cursor() as cur:
+            for row in rows(row_sample, "row"):
+                cur.execute(f"INSERT INTO {table} ({bulk_writer.COLUMNS}) VALUES (%s, %s, %s, %s, %s)", row)
+                conn.commit()
+        elapsed = time.perf_counter() - start
+        print(f"{'row-by-row INSERT + commit':<32} {row_sample:>8} vectors  {elapsed:8.2f} s  {row_sample / elapsed:10.0f} vectors/s")
+
+        recreate_table()
+        writer = bulk_writer.bulk_writer(conn, table=table)
+        batch = []
+        start = time.perf_counter()
+        for row in rows(count, "bulk"):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                writer.write(batch)
+                batch = []
+        writer.write(batch)
+        elapsed = time.perf_counter() - start
+        print(f"{f'binary COPY, batch {batch_size}':<32} {count:>8} vectors  {elapsed:8.2f} s  {count / elapsed:10.0f} vectors/s")
+    finally:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.commit()
+        conn.close()
+
+
+def benchmark_clip(docs_path: pathlib.Path, count: int, batch_sizes: list[int], workers: int,
+                   num_threads: int | None) -> None:
+    '''
+    测量CLIP在不同批大小下的图片嵌入吞吐量。批大小为1且单线程预处理时相当于逐张嵌入
+
+    :param docs_path: 图片文件夹路径
+    :param count: 参与测试的图片数量
+    :param batch_sizes: 待比较的批大小
+    :param workers: 并行预处理图片的线程数
+    :param num_threads: PyTorch在CPU上推理使用的线程数，为None时使用PyTorch的默认值
+    '''
+    import embedder
+
+    files = sorted(file for file in docs_path.iterdir() if file.suffix.lower() in ('.jpg', '.jpeg', '.png'))[:count]
+    images = []
+    for file in files:
+        with PIL.Image.open(file) as image:
+            images.append(image.convert("RGB"))
+    if not images:
+        print(f"No images found in {docs_path}")
+        return
+    embed_client = embedder.CLIP_embed(device="cpu", num_threads=num_threads)
+    # 预热，排除首次调用的初始化开销
+    embed_client.embed_images(images[:2])
+    cases = [("per-image, serial preprocess", 1, 1)] + [(f"batch {size}, {workers} preprocess threads", size, workers) for size in batch_sizes]
+    for name, batch_size, case_workers in cases:
+        case_client = embedder.CLIP_embed(model=embed_client.model, preprocess=embed_client.preprocess, device="cpu",
+                                          batch_size=batch_size, preprocess_workers=case_workers)
+        start = time.perf_counter()
+        case_client.embed_images(images)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<40} {len(images):>6} images  {elapsed:8.2f} s  {len(images) / elapsed:8.2f} images/s")
+
+
+def benchmark_startup(runs: int) -> None:
+    '''
+    测量导入 embedder 包与启动服务器（导入 server 模块并完成初始化）的耗时与峰值内存，
+    并列出被加载的重量级依赖。每次测量在新的子进程中进行，结果取中位数。
+    服务器的初始化需要可用的数据库与 .env 中的配置，嵌入后端由 EMBEDDER 选择
+
+    :param runs: 每个模块的测量次数
+    '''
+    src_path = pathlib.Path(__file__).resolve().parent
+    env = {**os.environ, "PYTHONPATH": str(src_path)}
+    for module in ("embedder", "server"):
+        times, memory, heavy = [], [], "-"
+        for _ in range(runs):
+            # 服务器以仓库根目录为工作目录运行
+            completed = subprocess.run([sys.executable, "-c", STARTUP_PROBE.format(module=module)], cwd=src_path.parent,
+                                       env=env, capture_output=True, text=True)
+            if completed.returncode != 0:
+                print(f"import {module} failed:\n{completed.stderr.strip()}")
+                break
+            elapsed, max_rss, heavy = completed.stdout.strip().splitlines()[-1].split()
+            times.append(float(elapsed))
+            memory.append(int(max_rss))
+        if times:
+            print(f"import {module:<10} {statistics.median(times):8.2f} s  {statistics.median(memory) / 1024:8.1f} MB peak RSS  heavy modules: {heavy}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Akasha 性能基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    thumbnails_parser = subparsers.add_parser("thumbnails", help="缩略图生成吞吐量")
+    thumbnails_parser.add_argument("--docs", default=os.path.join(os.getenv("DATA_PATH", "data"), "docs"),
+                                   help="图片文件夹路径")
+    thumbnails_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                                   help="多进程模式下使用的进程数")
+
+    ingest_parser = subparsers.add_parser("ingest", help="向量写入吞吐量，需要可用的PostgreSQL数据库")
+    ingest_parser.add_argument("--count", type=int, default=100000, help="批量写入的向量数量")
+    ingest_parser.add_argument("--batch-size", type=int, default=500, help="批量写入时每批的向量数量")
+    ingest_parser.add_argument("--row-sample", type=int, default=5000, help="逐行插入时写入的向量数量")
+
+    clip_parser = subparsers.add_parser("clip", help="CLIP图片嵌入吞吐量")
+    clip_parser.add_argument("--docs", default=os.path.join(os.getenv("DATA_PATH", "data"), "docs"),
+                             help="图片文件夹路径")
+    clip_parser.add_argument("--count", type=int, default=256, help="参与测试的图片数量")
+    clip_parser.add_argument("--batch-sizes", default="1,8,32,64", help="待比较的批大小，以逗号分隔")
+    clip_parser.add_argument("--workers", type=int, default=4, help="并行预处理图片的线程数")
+    clip_parser.add_argument("--threads", type=int, default=None, help="PyTorch在CPU上推理使用的线程数")
+
+    startup_parser = subparsers.add_parser("startup", help="服务器启动耗时与导入内存占用")
+    startup_parser.add_argument("--runs", type=int, default=3, help="每个模块的测量次数")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.command == "thumbnails":
+        benchmark_thumbnails(pathlib.Path(args.docs), args.workers)
+    elif args.command == "ingest":
+        benchmark_ingest(args.count, args.batch_size, args.row_sample)
+    elif args.command == "startup":
+        benchmark_startup(args.runs)
+    elif args.command == "clip":
+        benchmark_clip(pathlib.Path(args.docs), args.count, [int(size) for size in args.batch_sizes.split(",")],
+                       args.workers, args.threads)
+
+
+if __name__ == "__main__":
+    main()
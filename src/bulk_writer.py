@@ -0,0 +1,126 @@
+import io
+import logging
+import struct
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import psycopg2
+
+# 待写入的一行数据，格式为 (文件名, 嵌入向量, 文件大小, 修改时间, 内容哈希)
+Row = Tuple[str, Any, int | None, int | None, str | None]
+
+COLUMNS = "file_name, embedding, file_size, file_mtime_ns, content_hash"
+
+
+def encode_copy_binary(rows: List[Row]) -> bytes:
+    '''
+    将数据编码为PostgreSQL二进制COPY格式，向量使用pgvector的二进制表示
+
+    :param rows: 待写入的数据
+
+    :return: 二进制COPY数据
+    '''
+    buf = io.BytesIO()
+    buf.write(b"PGCOPY\n\xff\r\n\x00")
+    buf.write(struct.pack("!ii", 0, 0))
+    for file_name, vector, file_size, file_mtime_ns, content_hash in rows:
+        buf.write(struct.pack("!h", 5))
+        name_bytes = file_name.encode()
+        buf.write(struct.pack("!i", len(name_bytes)))
+        buf.write(name_bytes)
+        vec = np.asarray(vector, dtype=">f4")
+        buf.write(struct.pack("!ihh", 4 + vec.nbytes, len(vec), 0))
+        buf.write(vec.tobytes())
+        for value in (file_size, file_mtime_ns):
+            if value is None:
+                buf.write(struct.pack("!i", -1))
+            else:
+                buf.write(struct.pack("!iq", 8, value))
+        if content_hash is None:
+            buf.write(struct.pack("!i", -1))
+        else:
+            hash_bytes = content_hash.encode()
+            buf.write(struct.pack("!i", len(hash_bytes)))
+            buf.write(hash_bytes)
+    buf.write(struct.pack("!h", -1))
+    return buf.getvalue()
+
+
+class bulk_writer:
+    '''
+    批量写入嵌入向量。每批数据先通过二进制COPY写入临时表，再以一条 INSERT ... ON CONFLICT 语句
+    合并到目标表并提交一次事务。批量写入失败时逐行重试，以定位出错的数据行
+    '''
+    conn: psycopg2.extensions.connection
+    table: str
+    # 目标表 embedding 列的类型，例如 vector(1024) 或 halfvec(1024)
+    embedding_type: str
+
+    def __init__(self, conn: psycopg2.extensions.connection, table: str = "embeddings", embedding_type: str = "vector"):
+        '''
+        :param conn: 数据库连接，需要已注册vector类型
+        :param table: 目标表名
+        :param embedding_type: 目标表 embedding 列的类型，临时表中的单精度向量写入时转换为该类型
+        '''
+        self.conn = conn
+        self.table = table
+        self.embedding_type = embedding_type
+        self.__staging_table = f"{table}_staging"
+
+    def __upsert_sql(self, source: str) -> str:
+        return f"""
+            INSERT INTO {self.table} ({COLUMNS})
+            {source}
+            ON CONFLICT (file_name) DO UPDATE SET
+                embedding = EXCLUDED.embedding,
+                file_size = EXCLUDED.file_size,
+                file_mtime_ns = EXCLUDED.file_mtime_ns,
+                content_hash = EXCLUDED.content_hash,
+                updated_at = CURRENT_TIMESTAMP
+        """
+
+    def __copy(self, rows: List[Row]) -> None:
+        with self.conn.cursor() as cur:
+            cur.execute(f"""
+                CREATE TEMP TABLE IF NOT EXISTS {self.__staging_table} (
+                    file_name VARCHAR(255),
+                    embedding vector,
+                    file_size BIGINT,
+                    file_mtime_ns BIGINT,
+                    content_hash CHAR(64)
+                ) ON COMMIT DELETE ROWS
+            """)
+            cur.copy_expert(f"COPY {self.__staging_table} ({COLUMNS}) FROM STDIN WITH (FORMAT binary)",
+                            io.BytesIO(encode_copy_binary(rows)))
+            cur.execute(self.__upsert_sql(
+                f"SELECT file_name, embedding::{self.embedding_type}, file_size, file_mtime_ns, content_hash FROM {self.__staging_table}"))
+        self.conn.commit()
+
+    def write(self, rows: List[Row]) -> Dict[str, str]:
+        '''
+        写入一批数据，已存在的文件名会被更新，因此重复写入是幂等的
+
+        :param rows: 待写入的数据
+
+        :return: 写入失败的数据行，格式为 {文件名: 错误信息}
+        '''
+        if not rows:
+            return {}
+        try:
+            self.__copy(rows)
+            return {}
+        except Exception as e:
+            logging.warning(f"Bulk write of {len(rows)} rows failed: {e}. Falling back to row-by-row inserts.")
+            self.conn.rollback()
+
+        failures = {}
+        with self.conn.cursor() as cur:
+            for file_name, vector, file_size, file_mtime_ns, content_hash in rows:
+                try:
+                    cur.execute(self.__upsert_sql(f"VALUES (%s, %s::{self.embedding_type}, %s, %s, %s)"),
+                                (file_name, np.asarray(vector), file_size, file_mtime_ns, content_hash))
+                    self.conn.commit()
+                except Exception as e:
+                    failures[file_name] = str(e)
+                    self.conn.rollback()
+        return failures
@@ -2,12 +2,66 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import psycopg2
+import psycopg2.pool
+import asyncio
 import os
 import logging
+import threading
+import time
+import contextlib
+import hashlib
+import re
+from typing import Iterator
 from pgvector.psycopg2 import register_vector
 
+class pooled_connection(psycopg2.extensions.connection):
+    '''
+    连接池中的连接，记录vector类型是否已注册及最近一次归还的时间
+    '''
+    vector_registered: bool = False
+    last_used: float = 0.0
+
+# 空闲超过该时间（秒）的连接在取出时会先检查是否可用
+POOL_HEALTH_CHECK_INTERVAL = 30
+# 等待空闲连接的最长时间，单位为秒，超时后抛出 TimeoutError（异步连接池为 psycopg_pool.PoolTimeout）
+POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT", "30"))
+
+__pool: psycopg2.pool.ThreadedConnectionPool | None = None
+__pool_slots: threading.BoundedSemaphore | None = None
+__pool_lock = threading.Lock()
+__async_pool = None
+__async_pool_lock = asyncio.Lock()
+
+# 旧版本的 embeddings 表使用的向量维度
+EMBEDDING_DIM = 1024
+# 嵌入向量的存储方式。vector 为单精度；halfvec 为半精度，表与索引的大小减半；
+# binary 保存单精度向量，HNSW索引建立在二值量化后的向量上，查询时再用单精度向量对候选结果重新排序
+STORAGE_MODES = ("vector", "halfvec", "binary")
+
+def embedding_column_type(storage:str, dimension:int=EMBEDDING_DIM) -> str:
+    """
+    :param storage: 向量存储方式
+    :param dimension: 向量维度
+
+    :return: 向量表中 embedding 列的类型
+    """
+    return f"halfvec({dimension})" if storage == "halfvec" else f"vector({dimension})"
+
+def model_table_name(model:str) -> str:
+    """
+    根据模型标识生成向量表名。表名包含可读的模型名与模型标识的哈希，
+    长度保证表名及其索引名不超过PostgreSQL标识符的长度限制
+
+    :param model: 模型标识，例如 "clip:ViT-B/32"
+
+    :return: 向量表名
+    """
+    slug = re.sub(r"[^a-z0-9]+", "_", model.lower()).strip("_")[:24]
+    digest = hashlib.sha1(model.encode()).hexdigest()[:8]
+    return f"embeddings_{slug}_{digest}"
+
 def get_db_connection() -> psycopg2.extensions.connection:
-    """创建并返回数据库连接"""
+    """创建并返回独立的数据库连接，用于建表等维护操作。一般查询请使用 connection()"""
     db_host = os.getenv("POSTGRES_HOST")
     db_name = os.getenv("POSTGRES_DB")
     db_user = os.getenv("POSTGRES_USER")
@@ -21,6 +75,144 @@ def get_db_connection() -> psycopg2.extensions.connection:
     )
     return conn
 
+def get_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    """
+    返回进程内共享的数据库连接池，首次调用时创建。
+    连接池大小由环境变量 POSTGRES_POOL_MIN 与 POSTGRES_POOL_MAX 配置
+    """
+    global __pool, __pool_slots
+    with __pool_lock:
+        if __pool is None:
+            min_size = int(os.getenv("POSTGRES_POOL_MIN", "1"))
+            max_size = int(os.getenv("POSTGRES_POOL_MAX", "10"))
+            __pool = psycopg2.pool.ThreadedConnectionPool(
+                min_size, max_size,
+                host=os.getenv("POSTGRES_HOST"),
+                database=os.getenv("POSTGRES_DB"),
+                user=os.getenv("POSTGRES_USER"),
+                password=os.getenv("POSTGRES_PASSWORD"),
+                connection_factory=pooled_connection
+            )
+            # ThreadedConnectionPool 在连接耗尽时直接报错，用信号量让调用方等待空闲连接
+            __pool_slots = threading.BoundedSemaphore(max_size)
+        return __pool
+
+def close_pool() -> None:
+    """关闭连接池中的所有连接"""
+    global __pool, __pool_slots
+    with __pool_lock:
+        if __pool is not None:
+            __pool.closeall()
+        __pool = None
+        __pool_slots = None
+
+async def get_async_pool():
+    """
+    返回进程内共享的异步数据库连接池，首次调用时创建并打开，供ASGI服务的异步搜索使用。
+    使用 psycopg 3 的 psycopg_pool，连接已注册vector类型，大小与 get_pool 相同。
+    连接池属于首次调用时的事件循环
+
+    :return: psycopg_pool.AsyncConnectionPool
+    """
+    global __async_pool
+    async with __async_pool_lock:
+        if __async_pool is None:
+            # 只有异步服务需要 psycopg 3
+            import psycopg.conninfo
+            import psycopg_pool
+            from pgvector.psycopg import register_vector_async
+
+            conninfo = psycopg.conninfo.make_conninfo(
+                host=os.getenv("POSTGRES_HOST"),
+                dbname=os.getenv("POSTGRES_DB"),
+                user=os.getenv("POSTGRES_USER"),
+                password=os.getenv("POSTGRES_PASSWORD")
+            )
+            pool = psycopg_pool.AsyncConnectionPool(
+                conninfo,
+                min_size=int(os.getenv("POSTGRES_POOL_MIN", "1")),
+                max_size=int(os.getenv("POSTGRES_POOL_MAX", "10")),
+                configure=register_vector_async,
+                timeout=POOL_TIMEOUT,
+                open=False
+            )
+            await pool.open()
+            __async_pool = pool
+        return __async_pool
+
+async def close_async_pool() -> None:
+    """关闭异步连接池"""
+    global __async_pool
+    async with __async_pool_lock:
+        if __async_pool is not None:
+            await __async_pool.close()
+        __async_pool = None
+
+def __is_healthy(conn:pooled_connection) -> bool:
+    if conn.closed:
+        return False
+    if conn.last_used == 0.0 or time.monotonic() - conn.last_used < POOL_HEALTH_CHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+@contextlib.contextmanager
+def connection() -> Iterator[pooled_connection]:
+    """
+    从连接池取出一个连接，退出时归还。连接已注册vector类型。
+    发生异常时回滚未提交的事务，连接已损坏时将其关闭而不是放回连接池。
+    连接池耗尽时最多等待 POOL_TIMEOUT 秒
+
+    使用示例::
+
+        with db_init.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(...)
+            conn.commit()
+    """
+    pool = get_pool()
+    slots = __pool_slots
+    assert slots is not None
+    if not slots.acquire(timeout=POOL_TIMEOUT):
+        raise TimeoutError(f"Timed out waiting for a database connection after {POOL_TIMEOUT} seconds")
+    conn: pooled_connection | None = None
+    try:
+        conn = pool.getconn()
+        if not __is_healthy(conn):
+            logging.warning("Discarding broken pooled database connection.")
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        if not conn.vector_registered:
+            try:
+                register_vector(conn)
+                conn.vector_registered = True
+            except psycopg2.ProgrammingError:
+                # vector扩展尚未创建，下次取出时再注册
+                conn.rollback()
+        yield conn
+    except Exception:
+        if conn is not None and not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        if conn is not None:
+            broken = conn.closed != 0
+            if not broken:
+                try:
+                    if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                    conn.autocommit = False
+                    conn.last_used = time.monotonic()
+                except psycopg2.Error:
+                    broken = True
+            pool.putconn(conn, close=broken)
+        slots.release()
+
 def check_table_exists(table_name:str, cursor:psycopg2.extensions.cursor) -> bool:
     # 检查表是否存在
     cursor.execute(f"""
@@ -35,11 +227,166 @@ def check_table_exists(table_name:str, cursor:psycopg2.extensions.cursor) -> boo
     table_exists = fetch_result[0] if fetch_result is not None else False
     return table_exists
 
+# 读取索引代数的SQL
+INDEX_GENERATION_SQL = "SELECT value FROM settings WHERE key = 'index_generation'"
+
+def get_index_generation(cursor:psycopg2.extensions.cursor) -> int:
+    """
+    读取索引代数。embeddings 表中的数据每次被插入或删除后代数加一，用于判断缓存的搜索结果是否过期
+
+    :param cursor: 数据库游标
+
+    :return: 当前的索引代数，从未写入过时为0
+    """
+    cursor.execute(INDEX_GENERATION_SQL)
+    row = cursor.fetchone()
+    return int(row[0]) if row else 0
+
+def bump_index_generation(cursor:psycopg2.extensions.cursor) -> None:
+    """
+    将索引代数加一，需由调用方提交事务。应与修改 embeddings 表的语句放在同一事务中
+
+    :param cursor: 数据库游标
+    """
+    cursor.execute(
+        """
+        INSERT INTO settings (key, value, updated_at)
+        VALUES ('index_generation', '1', CURRENT_TIMESTAMP)
+        ON CONFLICT (key)
+        DO UPDATE SET value = (settings.value::bigint + 1)::text, updated_at = CURRENT_TIMESTAMP
+        """
+    )
+
+def _ensure_embeddings_table(cursor:psycopg2.extensions.cursor, table:str, dimension:int, storage:str|None,
+                             convert:bool=True) -> None:
+    """
+    创建向量表，并在已有表的存储方式与 storage 不一致时转换 embedding 列的类型、删除HNSW索引，
+    索引在下次建立索引时按新的存储方式重建
+
+    :param cursor: 数据库游标
+    :param table: 表名
+    :param dimension: 向量维度
+    :param storage: 向量存储方式，为None时保留已有表的存储方式，新建的表使用 vector
+    :param convert: 是否转换已有表的存储方式，为False时 storage 只用于新建的表
+    """
+    column_type = embedding_column_type(storage or "vector", dimension)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            file_name VARCHAR(255) PRIMARY KEY,
+            embedding {column_type} NOT NULL,
+            file_size BIGINT,
+            file_mtime_ns BIGINT,
+            content_hash CHAR(64),
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    # 为旧版本创建的表补充文件指纹字段
+    cursor.execute(f"""
+        ALTER TABLE {table}
+            ADD COLUMN IF NOT EXISTS file_size BIGINT,
+            ADD COLUMN IF NOT EXISTS file_mtime_ns BIGINT,
+            ADD COLUMN IF NOT EXISTS content_hash CHAR(64);
+    """)
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {table}_content_hash_idx ON {table} (content_hash)")
+    # 转换已有表的向量存储方式
+    current_type = _embedding_column_type(cursor, table)
+    if convert and storage is not None and current_type != column_type:
+        logging.info(f"Converting {table} from {current_type} to {column_type}, the HNSW index is dropped until it is rebuilt.")
+        cursor.execute(f"DROP INDEX IF EXISTS {table}_hnsw_idx")
+        cursor.execute(f"ALTER TABLE {table} ALTER COLUMN embedding TYPE {column_type} USING embedding::{column_type}")
+
+def _embedding_column_type(cursor:psycopg2.extensions.cursor, table:str) -> str:
+    cursor.execute("""
+        SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attname = 'embedding'
+    """, (table,))
+    return cursor.fetchone()[0]
+
+def get_column_storage(table:str) -> str:
+    """
+    读取向量表 embedding 列实际使用的存储方式。binary 存储方式的列与 vector 相同，返回 vector
+
+    :param table: 表名
+
+    :return: halfvec 或 vector
+    """
+    with connection() as conn, conn.cursor() as cursor:
+        column_type = _embedding_column_type(cursor, table)
+        conn.commit()
+    return "halfvec" if column_type.startswith("halfvec") else "vector"
+
+def ensure_embeddings_table(table:str, dimension:int, storage:str|None=None) -> None:
+    """
+    创建向量表，已存在时按 storage 转换存储方式
+
+    :param table: 表名
+    :param dimension: 向量维度
+    :param storage: 向量存储方式，为None时保留已有表的存储方式，新建的表使用 vector
+
+    :raises ValueError: 如果存储方式不受支持
+    :raises Exception: 如果数据库连接或表创建失败
+    """
+    if storage is not None and storage not in STORAGE_MODES:
+        raise ValueError(f"Unsupported storage mode: {storage}")
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            _ensure_embeddings_table(cursor, table, dimension, storage)
+        conn.commit()
+    finally:
+        conn.close()
+
+def register_model(model:str, dimension:int, storage:str|None=None, convert:bool=True) -> str:
+    """
+    返回模型对应的向量表，首次使用时登记模型并按其原生维度创建向量表。
+    每个模型的向量保存在各自的表中，不同模型的向量不会混在一起。
+    旧版本的 embeddings 表在维度相符时由第一个登记的模型沿用
+
+    :param model: 模型标识，同一标识的向量可以互相比较
+    :param dimension: 模型输出的向量维度
+    :param storage: 向量存储方式，为None时保留已有表的存储方式，新建的表使用 vector
+    :param convert: 是否转换已有表的存储方式，为False时 storage 只用于新建的表
+
+    :return: 向量表名
+
+    :raises ValueError: 如果存储方式不受支持，或模型已按其他维度登记
+    :raises Exception: 如果数据库连接或表创建失败
+    """
+    if storage is not None and storage not in STORAGE_MODES:
+        raise ValueError(f"Unsupported storage mode: {storage}")
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            # 防止多个进程同时登记第一个模型
+            cursor.execute("LOCK TABLE embedding_models IN SHARE ROW EXCLUSIVE MODE")
+            cursor.execute("SELECT dimension, table_name FROM embedding_models WHERE model = %s", (model,))
+            row = cursor.fetchone()
+            if row is not None:
+                if row[0] != dimension:
+                    raise ValueError(f"Model {model} is registered with dimension {row[0]}, got {dimension}.")
+                table = row[1]
+            else:
+                table = model_table_name(model)
+                cursor.execute("SELECT EXISTS (SELECT FROM embedding_models)")
+                if not cursor.fetchone()[0] and dimension == EMBEDDING_DIM and check_table_exists("embeddings", cursor):
+                    logging.info(f"Adopting the existing embeddings table for model {model}.")
+                    table = "embeddings"
+                cursor.execute(
+                    "INSERT INTO embedding_models (model, dimension, table_name) VALUES (%s, %s, %s)",
+                    (model, dimension, table)
+                )
+            _ensure_embeddings_table(cursor, table, dimension, storage, convert)
+        conn.commit()
+        return table
+    finally:
+        conn.close()
+
 def initialize_database(recreate:bool=False) -> None:
     """
-    初始化数据库表结构
+    初始化数据库表结构。向量表在模型登记时创建，见 register_model
 
-    :param recreate: 是否重新创建表结构，默认为False
+    :param recreate: 是否重新创建表结构，默认为False，为True时删除所有模型的向量表
 
     :raises Exception: 如果数据库连接或表创建失败
     """
@@ -51,7 +398,12 @@ def initialize_database(recreate:bool=False) -> None:
     if recreate:
         try:
             # 删除现有表
+            if check_table_exists("embedding_models", cursor):
+                cursor.execute("SELECT table_name FROM embedding_models")
+                for (table,) in cursor.fetchall():
+                    cursor.execute(f"DROP TABLE IF EXISTS {table};")
             cursor.execute("DROP TABLE IF EXISTS embeddings;")
+            cursor.execute("DROP TABLE IF EXISTS embedding_models;")
             cursor.execute("DROP TABLE IF EXISTS settings;")
             conn.commit()
         except Exception as e:
@@ -64,11 +416,11 @@ def initialize_database(recreate:bool=False) -> None:
     try:
         # 创建需要的表
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS embeddings (
-                file_name VARCHAR(255) PRIMARY KEY,
-                embedding vector(1024) NOT NULL,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            CREATE TABLE IF NOT EXISTS embedding_models (
+                model VARCHAR(255) PRIMARY KEY,
+                dimension INTEGER NOT NULL,
+                table_name VARCHAR(63) NOT NULL UNIQUE,
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
             );
         """)
         cursor.execute("""
@@ -4,22 +4,37 @@ import torch
 from typing import Callable, List
 import PIL.Image
 import logging
+import concurrent.futures
 import numpy as np
 
 class CLIP_embed:
     model_name: str = "ViT-B/32"
+    # 模型输出的向量维度，由模型决定，例如 ViT-B/32 为512
+    dimension: int
     model: clip.model.CLIP
     preprocess: Callable[[PIL.Image.Image], torch.Tensor]
     device: torch.device
+    # 每次前向计算最多包含的图片数量
+    batch_size: int = 32
+    # 并行预处理图片的线程数
+    preprocess_workers: int = 4
 
-    def __init__(self, model=None, preprocess=None, model_name: str = "ViT-B/32", device=None):
+    def __init__(self, model=None, preprocess=None, model_name: str = "ViT-B/32", device=None,
+                 batch_size: int = 32, preprocess_workers: int = 4, num_threads: int | None = None):
         '''
         :param model: CLIP model
         :param preprocess: CLIP preprocess
         :param model_name: a name of available CLIP models
         :param device: 设备类型，如果为None则自动选择（优先级：cuda > mps > cpu）
+        :param batch_size: 每次前向计算最多包含的图片数量
+        :param preprocess_workers: 并行预处理图片的线程数，为1时在调用线程中预处理
+        :param num_threads: PyTorch在CPU上推理使用的线程数，对整个进程生效，为None时使用PyTorch的默认值
         '''
         self.model_name = model_name
+        self.batch_size = max(1, batch_size)
+        self.preprocess_workers = max(1, preprocess_workers)
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
         
         # 自动选择设备
         if device is None:
@@ -41,45 +56,100 @@ class CLIP_embed:
             self.preprocess = preprocess
         
         self.model.to(self.device).eval()
+        self.dimension = self.model.text_projection.shape[1]
+        # 缩放、裁剪与归一化在线程池中进行，期间PIL与PyTorch会释放GIL
+        self.__preprocess_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.preprocess_workers, thread_name_prefix="clip-preprocess") if self.preprocess_workers > 1 else None
 
-    def embed_image(self, image: PIL.Image.Image) -> List[float]:
+    def model_id(self) -> str:
         '''
-        嵌入图片
+        返回标识向量空间的字符串
 
-        :param image: 图片对象
+        :return: 模型标识
+        '''
+        return f"clip:{self.model_name}"
+
+    def embedding_id(self) -> str:
+        '''
+        返回标识嵌入结果的字符串，包含模型名称与影响结果的预处理参数
+
+        :return: 嵌入结果标识
+        '''
+        # 旧版本将向量填充至1024维，维度不同的缓存向量不可混用
+        return f"{self.model_id()}:dim={self.dimension}"
+
+    def __preprocess(self, image: PIL.Image.Image) -> torch.Tensor:
+        return self.preprocess(image.convert("RGB"))
 
-        :return: 嵌入向量
+    def __preprocess_batch(self, images: List[PIL.Image.Image]) -> torch.Tensor:
+        '''
+        预处理一批图片并合并为一个张量
 
         :raises ValueError: 如果图片格式不受支持或无法识别
         '''
         try:
-            image = image.convert("RGB")
-            image_input = self.preprocess(image)
-            image_input = torch.tensor(np.stack([image_input])).to(self.device)
+            if self.__preprocess_pool is not None:
+                tensors = list(self.__preprocess_pool.map(self.__preprocess, images))
+            else:
+                tensors = [self.__preprocess(image) for image in images]
         except Exception as e:
             logging.error(f"Embedding image failed: {e}.")
             raise ValueError("Image cannot be transformed into tensor")
-        with torch.no_grad():
-            image_features = self.model.encode_image(image_input).float()
-        image_features /= image_features.norm(dim=-1, keepdim=True)
-        # 将512维向量填充至1024维
-        feature_vector = image_features[0]
-        padded_vector = torch.cat([feature_vector, torch.zeros(1024 - len(feature_vector)).to(self.device)])
-        return padded_vector.cpu().tolist()
+        return torch.stack(tensors).to(self.device)
 
-    def embed_query(self, text: str) -> List[float]:
+    def embed_image(self, image: PIL.Image.Image) -> np.ndarray:
+        '''
+        嵌入图片
+
+        :param image: 图片对象
+
+        :return: 嵌入向量，float32数组
+
+        :raises ValueError: 如果图片格式不受支持或无法识别
+        '''
+        return self.embed_images([image])[0]
+
+    def embed_images(self, images: List[PIL.Image.Image]) -> np.ndarray:
+        '''
+        批量嵌入图片。图片按 batch_size 分批，每批先并行预处理，再在一次前向计算中完成
+
+        :param images: 图片对象列表
+
+        :return: 形状为 (图片数, dimension) 的float32数组，每行与输入图片一一对应
+
+        :raises ValueError: 如果图片格式不受支持或无法识别
+        '''
+        features = np.empty((len(images), self.dimension), dtype=np.float32)
+        for start in range(0, len(images), self.batch_size):
+            image_input = self.__preprocess_batch(images[start:start + self.batch_size])
+            with torch.inference_mode():
+                image_features = self.model.encode_image(image_input).float()
+                image_features /= image_features.norm(dim=-1, keepdim=True)
+            features[start:start + len(image_features)] = image_features.cpu().numpy()
+        return features
+
+    def embed_query(self, text: str) -> np.ndarray:
         '''
         嵌入查询文本
 
         :param text: 查询文本
 
-        :return: 嵌入向量
+        :return: 嵌入向量，float32数组
+        '''
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts: List[str]) -> np.ndarray:
+        '''
+        批量嵌入查询文本，所有文本在一次前向计算中完成
+
+        :param texts: 查询文本列表
+
+        :return: 形状为 (文本数, dimension) 的float32数组，每行与输入文本一一对应
         '''
-        text_input = clip.tokenize(text).to(self.device)
-        with torch.no_grad():
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        text_input = clip.tokenize(texts).to(self.device)
+        with torch.inference_mode():
             text_features = self.model.encode_text(text_input).float()
-        text_features /= text_features.norm(dim=-1, keepdim=True)
-        # 将512维向量填充至1024维
-        feature_vector = text_features[0]
-        padded_vector = torch.cat([feature_vector, torch.zeros(1024 - len(feature_vector)).to(self.device)])
-        return padded_vector.cpu().tolist()
+            text_features /= text_features.norm(dim=-1, keepdim=True)
+        return text_features.cpu().numpy()
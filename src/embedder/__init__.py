@@ -1,3 +1,34 @@
+import importlib
+import threading
+from typing import TYPE_CHECKING
+
 from embedder.embed_protocol import embed
-from embedder.cohere_embed import cohere_embed
-from embedder.CLIP_embed import CLIP_embed
\ No newline at end of file
+from embedder.embedding_cache import embedding_cache
+from embedder.cached_embed import cached_embed
+
+if TYPE_CHECKING:
+    from embedder.cohere_embed import cohere_embed
+    from embedder.CLIP_embed import CLIP_embed
+    from embedder.onnx_CLIP_embed import onnx_CLIP_embed, check_parity
+
+# 嵌入后端在首次使用时才导入，未被选用的后端（如依赖 torch 的 CLIP）不会拖慢启动，格式为 {名称: 所在模块}
+_LAZY_BACKENDS = {
+    "cohere_embed": "embedder.cohere_embed",
+    "CLIP_embed": "embedder.CLIP_embed",
+    "onnx_CLIP_embed": "embedder.onnx_CLIP_embed",
+    "check_parity": "embedder.onnx_CLIP_embed",
+}
+_lazy_lock = threading.RLock()
+
+__all__ = ["embed", "embedding_cache", "cached_embed", *_LAZY_BACKENDS]
+
+
+def __getattr__(name: str):
+    module_name = _LAZY_BACKENDS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _lazy_lock:
+        value = getattr(importlib.import_module(module_name), name)
+        # 子模块导入后与类同名的包属性指向子模块，这里改为指向类，之后不再经过 __getattr__
+        globals()[name] = value
+    return value
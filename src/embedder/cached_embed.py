@@ -0,0 +1,125 @@
+import asyncio
+from typing import Dict, List
+
+import PIL.Image
+
+import utilities
+from embedder.embed_protocol import embed
+from embedder.embedding_cache import embedding_cache
+
+
+class cached_embed:
+    '''
+    在任意嵌入客户端之前加入本地向量缓存。
+    图片按 (内容哈希, 嵌入结果标识) 缓存，内容和模型未变化的图片不会再次调用嵌入客户端
+    '''
+    embed: embed
+    cache: embedding_cache
+
+    def __init__(self, embed: embed, cache: embedding_cache):
+        '''
+        :param embed: 被缓存的嵌入客户端
+        :param cache: 嵌入向量缓存
+        '''
+        self.embed = embed
+        self.cache = cache
+
+    @property
+    def model_name(self) -> str:
+        return self.embed.model_name
+
+    @property
+    def dimension(self) -> int:
+        return self.embed.dimension
+
+    def model_id(self) -> str:
+        return self.embed.model_id()
+
+    def embedding_id(self) -> str:
+        return self.embed.embedding_id()
+
+    def __image_key(self, content_hash: str, decode_size: int | None) -> str:
+        if decode_size is None:
+            return f"image:{self.embed.embedding_id()}:{content_hash}"
+        return f"image:{self.embed.embedding_id()}:decode={decode_size}:{content_hash}"
+
+    def get_cached_images(self, content_hashes: List[str], decode_size: int | None = None) -> Dict[str, List[float]]:
+        '''
+        按图片文件的内容哈希查询缓存，无需打开图片
+
+        :param content_hashes: 图片文件内容的SHA-256哈希列表，与 utilities.file_hash 的结果相同
+        :param decode_size: 图片解码时缩小到的最大边长，需与 embed_images 使用的一致
+
+        :return: 命中缓存的 {内容哈希: 嵌入向量}
+        '''
+        keys = {self.__image_key(content_hash, decode_size): content_hash for content_hash in content_hashes}
+        return {keys[key]: vector for key, vector in self.cache.get_many(list(keys)).items()}
+
+    def embed_image(self, image: PIL.Image.Image) -> List[float]:
+        '''
+        嵌入图片，优先使用缓存
+
+        :param image: 图片对象
+
+        :return: 嵌入向量
+
+        :raises ValueError: 如果图片格式不受支持或无法识别
+        '''
+        return self.embed_images([image])[0]
+
+    def embed_images(self, images: List[PIL.Image.Image], content_hashes: List[str] | None = None,
+                     decode_size: int | None = None) -> List[List[float]]:
+        '''
+        批量嵌入图片，只有未命中缓存的图片会交给嵌入客户端
+
+        :param images: 图片对象列表
+        :param content_hashes: 与图片一一对应的内容哈希，调用方已计算时传入以免重复读取文件
+        :param decode_size: 调用方解码图片时缩小到的最大边长。解码尺寸影响送入模型的像素，因此计入缓存键
+
+        :return: 嵌入向量列表，与输入图片一一对应
+
+        :raises ValueError: 如果图片格式不受支持或无法识别
+        '''
+        if content_hashes is None:
+            content_hashes = [utilities.image_hash(image) for image in images]
+        keys = [self.__image_key(content_hash, decode_size) for content_hash in content_hashes]
+        cached = self.cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        if missing:
+            vectors = self.embed.embed_images([images[i] for i in missing])
+            fresh = {keys[i]: vector for i, vector in zip(missing, vectors)}
+            self.cache.put_many(fresh)
+            cached.update(fresh)
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        '''
+        嵌入查询文本
+
+        :param text: 查询文本
+
+        :return: 嵌入向量
+        '''
+        return self.embed.embed_query(text)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        '''
+        批量嵌入查询文本
+
+        :param texts: 查询文本列表
+
+        :return: 嵌入向量列表，与输入文本一一对应
+        '''
+        return self.embed.embed_queries(texts)
+
+    async def embed_queries_async(self, texts: List[str]) -> List[List[float]]:
+        '''
+        异步批量嵌入查询文本。被缓存的客户端没有异步实现时在线程池中调用 embed_queries
+
+        :param texts: 查询文本列表
+
+        :return: 嵌入向量列表，与输入文本一一对应
+        '''
+        if hasattr(self.embed, "embed_queries_async"):
+            return await self.embed.embed_queries_async(texts)
+        return await asyncio.to_thread(self.embed.embed_queries, texts)
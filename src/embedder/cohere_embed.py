@@ -12,21 +12,58 @@ import utilities
 
 class cohere_embed:
     client: cohere.ClientV2
+    # 异步客户端，仅 embed_queries_async 使用，首次使用时创建
+    async_client: cohere.AsyncClientV2 | None = None
     # 最大图片大小，单位为字节。部分API对图片大小限制为Tokens，即使很小的图片也可能超过限制，需要根据具体情况调整。
     image_max_size: int = 256*1024
+    # 单次请求最多包含的图片数量，由 model_name 决定，见 default_images_per_request
+    images_per_request: int = 1
+    # 单次请求中base64图片数据的总大小上限，单位为字节
+    request_max_size: int = 4*1024*1024
+    # 单次请求最多包含的查询文本数量
+    texts_per_request: int = 96
     model_name: str = "Cohere-embed-v3-multilingual"
+    # 模型输出的向量维度
+    dimension: int = 1024
     retry_limit: int = 3
     retry_interval: int = 5
 
-    def __init__(self, client: cohere.ClientV2 | None = None, model_name: str = "Cohere-embed-v3-multilingual"):
+    def __init__(self, client: cohere.ClientV2 | None = None, model_name: str = "Cohere-embed-v3-multilingual",
+                 dimension: int = 1024, async_client: cohere.AsyncClientV2 | None = None,
+                 images_per_request: int | None = None):
         '''
         :param client: cohere client
+        :param model_name: 模型名称
+        :param dimension: 模型输出的向量维度，例如 light 系列模型为384
+        :param async_client: cohere async client，为None时在首次异步调用时根据环境变量创建
+        :param images_per_request: 单次请求最多包含的图片数量，为None时根据模型名称确定
         '''
         if client is not None:
             self.client = client
         else:
             self.client = self.__create_cohere_client()
+        self.async_client = async_client
         self.model_name = model_name
+        self.dimension = dimension
+        if images_per_request is None:
+            images_per_request = self.default_images_per_request(model_name)
+        if images_per_request < 1:
+            raise ValueError("images_per_request must be at least 1")
+        self.images_per_request = images_per_request
+
+    @staticmethod
+    def default_images_per_request(model_name: str) -> int:
+        '''
+        根据模型名称确定单次请求最多包含的图片数量。embed-v3 系列模型每次请求只接受一张图片，
+        embed-v4 及之后的模型可以在一次请求中嵌入多张图片
+
+        :param model_name: 模型名称
+
+        :return: 单次请求最多包含的图片数量
+        '''
+        if "v3" in model_name.lower():
+            return 1
+        return 16
 
     def __create_cohere_client(self, api_key: str = "") -> cohere.ClientV2:
         '''
@@ -38,36 +75,51 @@ class cohere_embed:
 
         :raises ValueError: 如果API密钥未提供且环境变量中未找到CO_API_KEY
         '''
+        return cohere.ClientV2(api_key=self.__api_key(api_key), base_url=os.getenv("CO_API_URL"))
+
+    def __api_key(self, api_key: str = "") -> str:
         load_dotenv()
+        if api_key:
+            return api_key
+        CO_API_KEY = os.getenv("CO_API_KEY")
+        if not CO_API_KEY:
+            raise ValueError(
+                "CO_API_KEY not provided")
+        return CO_API_KEY
+
+    def model_id(self) -> str:
+        '''
+        返回标识向量空间的字符串
 
-        if not api_key:
-            CO_API_KEY = os.getenv("CO_API_KEY")
-            if not CO_API_KEY:
-                raise ValueError(
-                    "CO_API_KEY not provided")
-        else:
-            CO_API_KEY = api_key
-        cohere_client = cohere.ClientV2(api_key=CO_API_KEY, base_url=os.getenv("CO_API_URL"))
-        return cohere_client
+        :return: 模型标识
+        '''
+        return f"cohere:{self.model_name}"
 
-    def embed_image(self, image: PIL.Image.Image) -> List[float]:
+    def embedding_id(self) -> str:
         '''
-        嵌入图片
+        返回标识嵌入结果的字符串，包含模型名称与影响结果的预处理参数
 
-        :param image: 图片对象
+        :return: 嵌入结果标识
+        '''
+        return f"{self.model_id()}:max_size={self.image_max_size}"
 
-        :return: 嵌入向量
+    def __embed_images_request(self, thumbnails: List[str]) -> List[List[float]]:
+        '''
+        发送一次图片嵌入请求，失败时按配置重试
 
-        :raises ValueError: 如果图片格式不受支持或无法识别
+        :param thumbnails: base64编码的图片URL列表
+
+        :return: 嵌入向量列表
+
+        :raises ValueError: 如果API未返回与输入数量一致的嵌入向量
         '''
-        thumbnail = [utilities.thumbnail_url(image, self.image_max_size)]
         response = None
         for i in range(self.retry_limit):
             try:
                 response = self.client.embed(model=self.model_name,
                                              input_type="image",
                                              embedding_types=["float"],
-                                             images=thumbnail)
+                                             images=thumbnails)
             except Exception as e:
                 logging.warning(
                     f"Embedding image failed: {e}. Retrying {i+1}/{self.retry_limit}...")
@@ -75,10 +127,52 @@ class cohere_embed:
                 continue
             break
         if response and response.embeddings and response.embeddings.float_:
-            return response.embeddings.float_[0]
+            if len(response.embeddings.float_) != len(thumbnails):
+                raise ValueError(
+                    f"Expected {len(thumbnails)} embeddings, got {len(response.embeddings.float_)}.")
+            return response.embeddings.float_
         else:
             raise ValueError("No embeddings returned from the API response.")
 
+    def embed_image(self, image: PIL.Image.Image) -> List[float]:
+        '''
+        嵌入图片
+
+        :param image: 图片对象
+
+        :return: 嵌入向量
+
+        :raises ValueError: 如果图片格式不受支持或无法识别
+        '''
+        thumbnail = [utilities.thumbnail_url(image, self.image_max_size)]
+        return self.__embed_images_request(thumbnail)[0]
+
+    def embed_images(self, images: List[PIL.Image.Image]) -> List[List[float]]:
+        '''
+        批量嵌入图片。图片会按 images_per_request 和 request_max_size 分组，每组发送一次请求
+
+        :param images: 图片对象列表
+
+        :return: 嵌入向量列表，与输入图片一一对应
+
+        :raises ValueError: 如果图片格式不受支持或无法识别，或API未返回嵌入向量
+        '''
+        thumbnails = [utilities.thumbnail_url(image, self.image_max_size) for image in images]
+
+        embeddings: List[List[float]] = []
+        batch: List[str] = []
+        batch_size = 0
+        for thumbnail in thumbnails:
+            if batch and (len(batch) >= self.images_per_request
+                          or batch_size + len(thumbnail) > self.request_max_size):
+                embeddings.extend(self.__embed_images_request(batch))
+                batch, batch_size = [], 0
+            batch.append(thumbnail)
+            batch_size += len(thumbnail)
+        if batch:
+            embeddings.extend(self.__embed_images_request(batch))
+        return embeddings
+
     def embed_query(self, text: str) -> List[float]:
         '''
         嵌入查询文本
@@ -96,3 +190,55 @@ class cohere_embed:
         else:
             raise ValueError("No embeddings returned from the API response.")
         return vec
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        '''
+        批量嵌入查询文本，每 texts_per_request 条文本发送一次请求
+
+        :param texts: 查询文本列表
+
+        :return: 嵌入向量列表，与输入文本一一对应
+
+        :raises ValueError: 如果API未返回与输入数量一致的嵌入向量
+        '''
+        embeddings: List[List[float]] = []
+        for start in range(0, len(texts), self.texts_per_request):
+            batch = texts[start:start + self.texts_per_request]
+            response = self.client.embed(model=self.model_name,
+                                         input_type="search_query",
+                                         embedding_types=["float"],
+                                         texts=batch)
+            if not (response.embeddings and response.embeddings.float_):
+                raise ValueError("No embeddings returned from the API response.")
+            if len(response.embeddings.float_) != len(batch):
+                raise ValueError(
+                    f"Expected {len(batch)} embeddings, got {len(response.embeddings.float_)}.")
+            embeddings.extend(response.embeddings.float_)
+        return embeddings
+
+    async def embed_queries_async(self, texts: List[str]) -> List[List[float]]:
+        '''
+        异步批量嵌入查询文本，等待API期间不占用线程。分批方式与 embed_queries 相同
+
+        :param texts: 查询文本列表
+
+        :return: 嵌入向量列表，与输入文本一一对应
+
+        :raises ValueError: 如果API未返回与输入数量一致的嵌入向量
+        '''
+        if self.async_client is None:
+            self.async_client = cohere.AsyncClientV2(api_key=self.__api_key(), base_url=os.getenv("CO_API_URL"))
+        embeddings: List[List[float]] = []
+        for start in range(0, len(texts), self.texts_per_request):
+            batch = texts[start:start + self.texts_per_request]
+            response = await self.async_client.embed(model=self.model_name,
+                                                     input_type="search_query",
+                                                     embedding_types=["float"],
+                                                     texts=batch)
+            if not (response.embeddings and response.embeddings.float_):
+                raise ValueError("No embeddings returned from the API response.")
+            if len(response.embeddings.float_) != len(batch):
+                raise ValueError(
+                    f"Expected {len(batch)} embeddings, got {len(response.embeddings.float_)}.")
+            embeddings.extend(response.embeddings.float_)
+        return embeddings
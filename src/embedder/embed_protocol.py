@@ -3,13 +3,44 @@ from typing import Protocol, List
 
 
 class embed(Protocol):
+    model_name: str
+    # 嵌入向量的维度
+    dimension: int
+
+    def model_id(self) -> str:
+        '''
+        返回标识向量空间的字符串。标识相同的嵌入向量可以互相比较，保存在同一个向量表中
+
+        :return: 模型标识
+        '''
+        ...
+
+    def embedding_id(self) -> str:
+        '''
+        返回标识嵌入结果的字符串，包含模型名称与影响结果的预处理参数。
+        标识不同的嵌入结果不可混用
+
+        :return: 嵌入结果标识
+        '''
+        ...
+
     def embed_image(self, image: PIL.Image.Image) -> List[float]:
         '''
         嵌入图片
 
         :param image: 图片对象
 
-        :return: 嵌入向量，长度应为1024
+        :return: 嵌入向量，长度为 dimension
+        '''
+        ...
+
+    def embed_images(self, images: List[PIL.Image.Image]) -> List[List[float]]:
+        '''
+        批量嵌入图片
+
+        :param images: 图片对象列表
+
+        :return: 嵌入向量列表，与输入图片一一对应，每个向量长度为 dimension
         '''
         ...
 
@@ -19,6 +50,16 @@ class embed(Protocol):
 
         :param text: 查询文本
 
-        :return: 嵌入向量，长度应为1024
+        :return: 嵌入向量，长度为 dimension
+        '''
+        ...
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        '''
+        批量嵌入查询文本
+
+        :param texts: 查询文本列表
+
+        :return: 嵌入向量列表，与输入文本一一对应，每个向量长度为 dimension
         '''
         ...
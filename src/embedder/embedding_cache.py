@@ -0,0 +1,171 @@
+import logging
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+
+
+class embedding_cache:
+    '''
+    基于SQLite的本地嵌入向量缓存。向量以float32存储，
+    总大小超过 max_size 时按最近访问时间淘汰旧条目
+    '''
+    path: pathlib.Path
+    # 缓存的最大大小，单位为字节
+    max_size: int = 1024*1024*1024
+    # 淘汰时清理至最大大小的比例，避免每次写入都触发淘汰
+    evict_ratio: float = 0.9
+    # 读取时的访问时间先记录在内存中，累积到该数量或距上次写入超过该间隔（秒）时批量写入，
+    # 避免每次读取都提交一次事务
+    access_flush_size: int = 1024
+    access_flush_interval: float = 60
+    # 每条查询语句最多包含的键数，SQLite限制了单条语句中的参数个数
+    keys_per_query: int = 500
+
+    def __init__(self, path: pathlib.Path, max_size: int = 1024*1024*1024):
+        '''
+        :param path: 缓存数据库文件路径
+        :param max_size: 缓存的最大大小，单位为字节
+        '''
+        self.path = path
+        self.max_size = max_size
+        self.__lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.__conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed_at_idx ON embeddings (accessed_at)")
+        self.__conn.commit()
+        self.__size = self.__conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        self.__accessed: Dict[str, float] = {}
+        self.__accessed_flushed_at = time.monotonic()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        '''
+        批量读取缓存的向量，并记录其访问时间
+
+        :param keys: 缓存键列表
+
+        :return: 命中的缓存，格式为 {缓存键: 嵌入向量}
+        '''
+        if not keys:
+            return {}
+        with self.__lock:
+            rows = []
+            for start in range(0, len(keys), self.keys_per_query):
+                chunk = keys[start:start + self.keys_per_query]
+                placeholders = ",".join("?" * len(chunk))
+                rows.extend(self.__conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk).fetchall())
+            if rows:
+                now = time.time()
+                for row in rows:
+                    self.__accessed[row[0]] = now
+                if (len(self.__accessed) >= self.access_flush_size
+                        or time.monotonic() - self.__accessed_flushed_at >= self.access_flush_interval):
+                    try:
+                        self.__write_accessed()
+                        self.__conn.commit()
+                        self.__accessed.clear()
+                    except sqlite3.Error as e:
+                        logging.warning(f"Failed to update embedding cache access times: {e}")
+                        self.__conn.rollback()
+        return {row[0]: np.frombuffer(row[1], dtype=np.float32).tolist() for row in rows}
+
+    def get(self, key: str) -> List[float] | None:
+        '''
+        读取缓存的向量
+
+        :param key: 缓存键
+
+        :return: 嵌入向量，未命中时返回None
+        '''
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        '''
+        批量写入向量，必要时淘汰最久未访问的条目
+
+        :param items: 待写入的缓存，格式为 {缓存键: 嵌入向量}
+        '''
+        if not items:
+            return
+        now = time.time()
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items.items()]
+        with self.__lock:
+            # 大小只在提交成功后更新，回滚时保持与数据库一致
+            size = self.__size
+            try:
+                for key, blob, accessed_at in rows:
+                    old = self.__conn.execute(
+                        "SELECT LENGTH(vector) FROM embeddings WHERE key = ?", (key,)).fetchone()
+                    self.__conn.execute(
+                        "INSERT OR REPLACE INTO embeddings (key, vector, accessed_at) VALUES (?, ?, ?)",
+                        (key, blob, accessed_at))
+                    size += len(blob) - (old[0] if old else 0)
+                evicting = size > self.max_size
+                if evicting:
+                    # 淘汰前写入最近的访问时间，使淘汰顺序反映实际使用情况
+                    self.__write_accessed()
+                    size = self.__evict(size)
+                self.__conn.commit()
+                self.__size = size
+                if evicting:
+                    self.__accessed.clear()
+            except sqlite3.Error as e:
+                logging.error(f"Failed to write embedding cache: {e}")
+                self.__conn.rollback()
+
+    def put(self, key: str, vector: List[float]) -> None:
+        '''
+        写入向量
+
+        :param key: 缓存键
+        :param vector: 嵌入向量
+        '''
+        self.put_many({key: vector})
+
+    def __write_accessed(self) -> None:
+        self.__conn.executemany("UPDATE embeddings SET accessed_at = ? WHERE key = ?",
+                                [(accessed_at, key) for key, accessed_at in self.__accessed.items()])
+        self.__accessed_flushed_at = time.monotonic()
+
+    def __evict(self, size: int) -> int:
+        '''
+        在当前事务中淘汰最久未访问的条目，直到总大小不超过 max_size * evict_ratio
+
+        :param size: 淘汰前的总大小
+
+        :return: 淘汰后的总大小
+        '''
+        target = int(self.max_size * self.evict_ratio)
+        rows = self.__conn.execute(
+            "SELECT key, LENGTH(vector) FROM embeddings ORDER BY accessed_at").fetchall()
+        evicted = []
+        for key, entry_size in rows:
+            if size <= target:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        self.__conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+        logging.info(f"Evicted {len(evicted)} entries from embedding cache.")
+        return size
+
+    def close(self) -> None:
+        with self.__lock:
+            try:
+                self.__write_accessed()
+                self.__conn.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"Failed to update embedding cache access times: {e}")
+            self.__conn.close()
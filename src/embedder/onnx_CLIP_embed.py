@@ -0,0 +1,213 @@
+import concurrent.futures
+import json
+import logging
+import pathlib
+from typing import List
+
+import numpy as np
+import onnxruntime
+import PIL.Image
+import tokenizers
+
+from embedder.embed_protocol import embed
+
+# CLIP预处理使用的归一化参数
+CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+
+
+class onnx_CLIP_embed:
+    '''
+    使用ONNX Runtime在CPU上运行导出的CLIP图像与文本编码器，不依赖PyTorch。
+    模型文件夹由 export_onnx_clip.py 生成，包含 image.onnx、text.onnx、tokenizer.json 与 config.json，
+    导出时默认对权重进行int8动态量化。
+    向量与同名模型的 CLIP_embed 位于同一向量空间，导出时会检查两者的余弦相似度
+    '''
+    model_name: str = "ViT-B/32"
+    # 模型输出的向量维度
+    dimension: int
+    # 输入图片的边长
+    image_size: int
+    # 权重的量化方式，未量化时为None
+    quantization: str | None
+    # 每次推理最多包含的图片数量
+    batch_size: int = 32
+    # 并行预处理图片的线程数
+    preprocess_workers: int = 4
+
+    def __init__(self, model_path: pathlib.Path, batch_size: int = 32, preprocess_workers: int = 4,
+                 num_threads: int | None = None):
+        '''
+        :param model_path: 导出的模型文件夹路径
+        :param batch_size: 每次推理最多包含的图片数量
+        :param preprocess_workers: 并行预处理图片的线程数，为1时在调用线程中预处理
+        :param num_threads: 每个推理会话使用的线程数，为None时使用ONNX Runtime的默认值
+
+        :raises FileNotFoundError: 如果模型文件不存在
+        '''
+        with open(model_path / "config.json", encoding="utf-8") as f:
+            config = json.load(f)
+        self.model_name = config["model_name"]
+        self.dimension = config["dimension"]
+        self.image_size = config["image_size"]
+        self.quantization = config.get("quantization")
+        self.batch_size = max(1, batch_size)
+        self.preprocess_workers = max(1, preprocess_workers)
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        self.__image_session = onnxruntime.InferenceSession(str(model_path / "image.onnx"), options, providers=providers)
+        self.__text_session = onnxruntime.InferenceSession(str(model_path / "text.onnx"), options, providers=providers)
+
+        self.__tokenizer = tokenizers.Tokenizer.from_file(str(model_path / "tokenizer.json"))
+        # 与 clip.tokenize 一致：截断时保留结束符，不足部分以0填充
+        self.__tokenizer.enable_truncation(config["context_length"])
+        self.__tokenizer.enable_padding(length=config["context_length"], pad_id=0, pad_token="!")
+
+        self.__preprocess_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.preprocess_workers, thread_name_prefix="onnx-clip-preprocess") if self.preprocess_workers > 1 else None
+        logging.info(f"Loaded ONNX CLIP model {self.model_name} from {model_path} (quantization={self.quantization}).")
+
+    def model_id(self) -> str:
+        '''
+        返回标识向量空间的字符串，与同名模型的 CLIP_embed 相同
+
+        :return: 模型标识
+        '''
+        return f"clip:{self.model_name}"
+
+    def embedding_id(self) -> str:
+        '''
+        返回标识嵌入结果的字符串，包含模型名称与影响结果的预处理参数
+
+        :return: 嵌入结果标识
+        '''
+        return f"{self.model_id()}:dim={self.dimension}:onnx-{self.quantization or 'fp32'}"
+
+    def __preprocess(self, image: PIL.Image.Image) -> np.ndarray:
+        '''
+        与CLIP的预处理一致：短边双三次缩放至 image_size，居中裁剪，再按通道归一化
+
+        :return: 形状为 (3, image_size, image_size) 的float32数组
+        '''
+        image = image.convert("RGB")
+        width, height = image.size
+        size = self.image_size
+        if width <= height:
+            width, height = size, int(size * height / width)
+        else:
+            width, height = int(size * width / height), size
+        image = image.resize((width, height), PIL.Image.Resampling.BICUBIC)
+        left = int(round((width - size) / 2.0))
+        top = int(round((height - size) / 2.0))
+        image = image.crop((left, top, left + size, top + size))
+        pixels = np.asarray(image, dtype=np.float32) / 255.0
+        return ((pixels - CLIP_MEAN) / CLIP_STD).transpose(2, 0, 1)
+
+    def __preprocess_batch(self, images: List[PIL.Image.Image]) -> np.ndarray:
+        '''
+        预处理一批图片并合并为一个数组
+
+        :raises ValueError: 如果图片格式不受支持或无法识别
+        '''
+        try:
+            if self.__preprocess_pool is not None:
+                arrays = list(self.__preprocess_pool.map(self.__preprocess, images))
+            else:
+                arrays = [self.__preprocess(image) for image in images]
+        except Exception as e:
+            logging.error(f"Embedding image failed: {e}.")
+            raise ValueError("Image cannot be transformed into tensor")
+        return np.stack(arrays)
+
+    @staticmethod
+    def __normalize(features: np.ndarray) -> np.ndarray:
+        features = features.astype(np.float32, copy=False)
+        return features / np.linalg.norm(features, axis=-1, keepdims=True)
+
+    def embed_image(self, image: PIL.Image.Image) -> np.ndarray:
+        '''
+        嵌入图片
+
+        :param image: 图片对象
+
+        :return: 嵌入向量，float32数组
+
+        :raises ValueError: 如果图片格式不受支持或无法识别
+        '''
+        return self.embed_images([image])[0]
+
+    def embed_images(self, images: List[PIL.Image.Image]) -> np.ndarray:
+        '''
+        批量嵌入图片。图片按 batch_size 分批，每批先并行预处理，再在一次推理中完成
+
+        :param images: 图片对象列表
+
+        :return: 形状为 (图片数, dimension) 的float32数组，每行与输入图片一一对应
+
+        :raises ValueError: 如果图片格式不受支持或无法识别
+        '''
+        features = np.empty((len(images), self.dimension), dtype=np.float32)
+        for start in range(0, len(images), self.batch_size):
+            pixel_values = self.__preprocess_batch(images[start:start + self.batch_size])
+            outputs = self.__image_session.run(None, {"pixel_values": pixel_values})[0]
+            features[start:start + len(outputs)] = self.__normalize(outputs)
+        return features
+
+    def embed_query(self, text: str) -> np.ndarray:
+        '''
+        嵌入查询文本
+
+        :param text: 查询文本
+
+        :return: 嵌入向量，float32数组
+        '''
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts: List[str]) -> np.ndarray:
+        '''
+        批量嵌入查询文本，所有文本在一次推理中完成
+
+        :param texts: 查询文本列表
+
+        :return: 形状为 (文本数, dimension) 的float32数组，每行与输入文本一一对应
+        '''
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        input_ids = np.array([encoding.ids for encoding in self.__tokenizer.encode_batch(texts)], dtype=np.int64)
+        outputs = self.__text_session.run(None, {"input_ids": input_ids})[0]
+        return self.__normalize(outputs)
+
+
+def check_parity(candidate: embed, reference: embed, images: List[PIL.Image.Image], texts: List[str],
+                 min_similarity: float = 0.98) -> float:
+    '''
+    比较两个嵌入客户端对同一批图片与文本的嵌入结果，用于确认量化或导出后的模型与原模型一致
+
+    :param candidate: 待检查的嵌入客户端
+    :param reference: 作为基准的嵌入客户端
+    :param images: 图片对象列表
+    :param texts: 查询文本列表
+    :param min_similarity: 允许的最低余弦相似度
+
+    :return: 对应向量间的最低余弦相似度
+
+    :raises ValueError: 如果最低余弦相似度低于 min_similarity
+    '''
+    similarities = []
+    for vectors, expected in ((candidate.embed_images(images), reference.embed_images(images)),
+                              (candidate.embed_queries(texts), reference.embed_queries(texts))):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        expected = np.asarray(expected, dtype=np.float32)
+        if len(vectors) == 0:
+            continue
+        similarities.append(np.sum(vectors * expected, axis=1)
+                            / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(expected, axis=1)))
+    if not similarities:
+        raise ValueError("No images or texts to compare.")
+    worst = float(np.concatenate(similarities).min())
+    if worst < min_similarity:
+        raise ValueError(f"Cosine similarity {worst:.4f} is below the required {min_similarity}.")
+    return worst
@@ -0,0 +1,146 @@
+import argparse
+import json
+import logging
+import pathlib
+import sys
+
+import PIL.Image
+import tokenizers
+from tokenizers import decoders, models, normalizers, pre_tokenizers, processors
+
+# 参与一致性检查的查询文本
+PARITY_TEXTS = [
+    "a photo of a cat",
+    "a diagram with several arrows",
+    "sunset over the mountains",
+    "一张写满公式的黑板",
+    "screenshot of a spreadsheet",
+]
+
+
+def build_tokenizer(context_length: int) -> tokenizers.Tokenizer:
+    '''
+    由CLIP自带的BPE词表构建等价的 tokenizers 分词器，使推理时不再依赖 clip 包
+
+    :param context_length: 文本编码器的上下文长度
+
+    :return: 分词器，首尾添加起始符与结束符
+    '''
+    from clip.simple_tokenizer import SimpleTokenizer
+
+    clip_tokenizer = SimpleTokenizer()
+    merges = [pair for pair, _ in sorted(clip_tokenizer.bpe_ranks.items(), key=lambda item: item[1])]
+    tokenizer = tokenizers.Tokenizer(models.BPE(vocab=clip_tokenizer.encoder, merges=merges,
+                                                continuing_subword_prefix="", end_of_word_suffix="</w>",
+                                                fuse_unk=False))
+    tokenizer.normalizer = normalizers.Sequence([
+        normalizers.NFC(),
+        normalizers.Replace(tokenizers.Regex(r"\s+"), " "),
+        normalizers.Lowercase(),
+    ])
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence([
+        pre_tokenizers.Split(tokenizers.Regex(r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+"""),
+                             behavior="removed", invert=True),
+        pre_tokenizers.ByteLevel(add_prefix_space=False, use_regex=False),
+    ])
+    tokenizer.decoder = decoders.ByteLevel()
+    start, end = "<|startoftext|>", "<|endoftext|>"
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single=f"{start} $A {end}",
+        special_tokens=[(start, clip_tokenizer.encoder[start]), (end, clip_tokenizer.encoder[end])],
+    )
+    tokenizer.add_special_tokens([start, end])
+    tokenizer.enable_truncation(context_length)
+    return tokenizer
+
+
+def export(model_name: str, output_path: pathlib.Path, quantize: bool = True, opset: int = 17) -> None:
+    '''
+    将CLIP的图像与文本编码器导出为ONNX模型，可选地对权重进行int8动态量化，供 embedder.onnx_CLIP_embed 使用
+
+    :param model_name: CLIP模型名称，例如 "ViT-B/32"
+    :param output_path: 输出文件夹路径
+    :param quantize: 是否进行int8动态量化
+    :param opset: ONNX算子集版本
+    '''
+    import clip
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    output_path.mkdir(parents=True, exist_ok=True)
+    model, _ = clip.load(model_name, device="cpu", jit=False)
+    model = model.float().eval()
+    image_size = model.visual.input_resolution
+
+    class image_tower(torch.nn.Module):
+        def forward(self, pixel_values):
+            return model.encode_image(pixel_values)
+
+    class text_tower(torch.nn.Module):
+        def forward(self, input_ids):
+            return model.encode_text(input_ids)
+
+    towers = [
+        ("image", image_tower(), torch.randn(1, 3, image_size, image_size), "pixel_values"),
+        ("text", text_tower(), clip.tokenize(PARITY_TEXTS[:1]).to(torch.int64), "input_ids"),
+    ]
+    for name, tower, sample, input_name in towers:
+        fp32_path = output_path / f"{name}.fp32.onnx"
+        logging.info(f"Exporting {name} encoder to {fp32_path}...")
+        with torch.inference_mode():
+            torch.onnx.export(tower, (sample,), str(fp32_path), input_names=[input_name], output_names=["embeddings"],
+                              dynamic_axes={input_name: {0: "batch"}, "embeddings": {0: "batch"}}, opset_version=opset)
+        model_path = output_path / f"{name}.onnx"
+        if quantize:
+            logging.info(f"Quantizing {name} encoder to int8...")
+            quantize_dynamic(str(fp32_path), str(model_path), weight_type=QuantType.QInt8)
+        else:
+            fp32_path.replace(model_path)
+
+    build_tokenizer(model.context_length).save(str(output_path / "tokenizer.json"))
+    with open(output_path / "config.json", "w", encoding="utf-8") as f:
+        json.dump({
+            "model_name": model_name,
+            "dimension": model.text_projection.shape[1],
+            "image_size": image_size,
+            "context_length": model.context_length,
+            "quantization": "int8" if quantize else None,
+        }, f, indent=2)
+    logging.info(f"ONNX CLIP model written to {output_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导出ONNX格式的CLIP模型，并检查与PyTorch模型的一致性")
+    parser.add_argument("--model", default="ViT-B/32", help="CLIP模型名称")
+    parser.add_argument("--output", required=True, help="输出文件夹路径")
+    parser.add_argument("--no-quantize", action="store_true", help="不进行int8动态量化")
+    parser.add_argument("--docs", default=None, help="用于一致性检查的图片文件夹路径，为空时跳过检查")
+    parser.add_argument("--count", type=int, default=32, help="参与一致性检查的图片数量")
+    parser.add_argument("--min-similarity", type=float, default=0.98, help="与PyTorch模型允许的最低余弦相似度")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    output_path = pathlib.Path(args.output)
+    export(args.model, output_path, quantize=not args.no_quantize)
+    if args.docs is None:
+        return
+
+    import embedder
+
+    files = sorted(file for file in pathlib.Path(args.docs).iterdir() if file.suffix.lower() in ('.jpg', '.jpeg', '.png'))[:args.count]
+    images = [PIL.Image.open(file) for file in files]
+    try:
+        similarity = embedder.check_parity(embedder.onnx_CLIP_embed(output_path),
+                                           embedder.CLIP_embed(model_name=args.model, device="cpu"),
+                                           images, PARITY_TEXTS, args.min_similarity)
+    except ValueError as e:
+        logging.error(f"Parity check failed: {e}")
+        sys.exit(1)
+    finally:
+        for image in images:
+            image.close()
+    logging.info(f"Parity check passed, minimum cosine similarity {similarity:.4f} over {len(images)} images and {len(PARITY_TEXTS)} texts.")
+
+
+if __name__ == "__main__":
+    main()
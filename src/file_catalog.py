@@ -0,0 +1,97 @@
+import logging
+import os
+import pathlib
+import threading
+from typing import Iterable
+
+# 会被索引的图片扩展名
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+class file_catalog:
+    '''
+    图片文件夹中现有文件名的内存目录，用于在搜索结果中以O(1)的代价排除已删除的文件，
+    避免每条结果都访问一次文件系统。目录由索引扫描更新，并由后台线程定期与磁盘核对
+    '''
+    docs_path: pathlib.Path
+    # 后台核对的间隔，单位为秒
+    reconcile_interval: float
+
+    def __init__(self, docs_path:pathlib.Path, reconcile_interval:float=300):
+        '''
+        :param docs_path: 图片文件夹路径
+        :param reconcile_interval: 后台与磁盘核对的间隔，单位为秒
+        '''
+        self.docs_path = docs_path
+        self.reconcile_interval = reconcile_interval
+        self.__names: set[str] = set()
+        # 首次扫描完成前目录为空，此时退回到逐个检查文件
+        self.__ready = False
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread: threading.Thread | None = None
+
+    def replace(self, names:Iterable[str]) -> None:
+        '''
+        用完整的扫描结果替换目录内容
+
+        :param names: 图片文件夹中的全部文件名
+        '''
+        names = set(names)
+        with self.__lock:
+            self.__names = names
+            self.__ready = True
+
+    def add(self, name:str) -> None:
+        with self.__lock:
+            self.__names.add(name)
+
+    def discard(self, name:str) -> None:
+        with self.__lock:
+            self.__names.discard(name)
+
+    def __contains__(self, name:str) -> bool:
+        with self.__lock:
+            if self.__ready:
+                return name in self.__names
+        return (self.docs_path / name).exists()
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__names)
+
+    def reconcile(self) -> None:
+        '''
+        扫描图片文件夹并替换目录内容
+        '''
+        names = []
+        with os.scandir(self.docs_path) as entries:
+            for entry in entries:
+                if entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                    names.append(entry.name)
+        self.replace(names)
+        logging.debug(f"File catalog reconciled, {len(names)} files found.")
+
+    def __run(self) -> None:
+        while not self.__stop.is_set():
+            try:
+                self.reconcile()
+            except Exception as e:
+                logging.warning(f"Failed to reconcile file catalog: {e}")
+            self.__stop.wait(self.reconcile_interval)
+
+    def start(self) -> None:
+        '''
+        启动后台核对线程，首次核对立即进行
+        '''
+        if self.__thread is not None:
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name="file-catalog", daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        '''
+        停止后台核对线程。正在进行的核对不会被中断，完成后线程退出
+        '''
+        self.__stop.set()
+        self.__thread = None
@@ -1,37 +1,152 @@
 import os
 import PIL.Image
+import PIL.features
 import embedder
 import pathlib
 import db_init
-from pgvector.psycopg2 import register_vector
 import logging
-import numpy as np
 import utilities
+import file_catalog
+import vector_store
+import queue
+import threading
+import concurrent.futures
 from typing import Dict, List, Tuple, Any
 
+# 缩略图变体的格式对应的文件扩展名与MIME类型
+VARIANT_FORMATS = {
+    "AVIF": ("avif", "image/avif"),
+    "WEBP": ("webp", "image/webp"),
+}
+
+def thumbnail_variant_path(thumbnails_path:pathlib.Path, file_name:str, width:int, fmt:str) -> pathlib.Path:
+    '''
+    返回缩略图变体的保存路径，格式为 缩略图文件夹/{width}w/{file_name}.{扩展名}
+
+    :param thumbnails_path: 缩略图文件夹路径
+    :param file_name: 原图文件名
+    :param width: 变体宽度
+    :param fmt: 变体格式，为 VARIANT_FORMATS 中的键
+
+    :return: 变体路径
+    '''
+    return thumbnails_path / f"{width}w" / f"{file_name}.{VARIANT_FORMATS[fmt][0]}"
+
+def create_thumbnail(file:pathlib.Path, thumbnail_path:pathlib.Path, thumbnail_size:int, reduced_decode:bool=True,
+                     variants:List[Tuple[int, str, pathlib.Path]] | None=None) -> Dict[str, str] | None:
+    '''
+    为单张图片创建缩略图及其各宽度的变体，图片只解码一次。定义在模块级别，以便在进程池中执行
+
+    :param file: 原图路径
+    :param thumbnail_path: 缩略图保存路径
+    :param thumbnail_size: 缩略图目标大小，单位为字节
+    :param reduced_decode: 是否对JPEG启用缩小解码
+    :param variants: 需要创建的变体，格式为 [(宽度, 格式, 保存路径), ...]
+
+    :return: 成功时返回None，失败时返回失败记录，格式为 {'file': str, 'stage': str, 'error': str}
+    '''
+    try:
+        with PIL.Image.open(file) as thumbnail:
+            try:
+                if reduced_decode:
+                    utilities.draft_image(thumbnail, thumbnail_size)
+                data = utilities.compress_image(thumbnail, thumbnail_size)
+                # 从大到小依次缩放，每个宽度只缩放一次，由上一级结果继续缩小
+                source = thumbnail
+                resized: Dict[int, PIL.Image.Image] = {}
+                for width, fmt, variant_path in sorted(variants or [], key=lambda variant: -variant[0]):
+                    if width not in resized:
+                        resized[width] = source = utilities.resize_to_width(source, width)
+                    variant_path.parent.mkdir(parents=True, exist_ok=True)
+                    variant_path.write_bytes(utilities.encode_variant(resized[width], fmt))
+                # 缩略图最后写入，其修改时间不早于各变体，可作为整组缩略图的版本
+                thumbnail_path.parent.mkdir(parents=True, exist_ok=True)
+                thumbnail_path.write_bytes(data)
+                return None
+            except Exception as e:
+                error_msg = str(e)
+                logging.error(f"Failed to create thumbnail for {file}: {error_msg}")
+                return {
+                    'file': str(file),
+                    'stage': 'compress_and_save',
+                    'error': error_msg
+                }
+    except Exception as e:
+        error_msg = str(e)
+        logging.error(f"Failed to open image file {file}: {error_msg}")
+        return {
+            'file': str(file),
+            'stage': 'open_image',
+            'error': error_msg
+        }
+
 class indexer:
     embed:embedder.embed
-    def __init__(self, embed:embedder.embed) -> None:
+    # 每次交给嵌入客户端的图片数量
+    embed_batch_size:int = 32
+    # 流水线各阶段的并发线程数
+    decode_workers:int = 4
+    embed_workers:int = 2
+    # 流水线阶段间队列的容量，单位为批
+    queue_size:int = 4
+    # 流水线中已解码、尚未嵌入的图片数量上限
+    max_in_flight:int = 128
+    # 解码图片的最大边长，单位为像素。JPEG图片直接以缩小的分辨率解码，不会完整解码原图
+    decode_size:int = 1024
+    # 每次写入存储的向量数量
+    write_batch_size:int = 500
+    # 缩略图变体的宽度与格式，为空时只创建单个缩略图
+    thumbnail_widths:Tuple[int, ...] = (128, 256, 512)
+    thumbnail_formats:Tuple[str, ...] = ("WEBP",)
+    # 保存嵌入向量的存储
+    store:vector_store.store
+    # 可选的文件目录，索引扫描图片文件夹后用扫描结果更新
+    catalog:file_catalog.file_catalog|None = None
+    def __init__(self, embed:embedder.embed, embed_batch_size:int=32, decode_workers:int=4, embed_workers:int=2, queue_size:int=4, write_batch_size:int=500,
+                 max_in_flight:int=128, decode_size:int=1024, store:vector_store.store|None=None, catalog:file_catalog.file_catalog|None=None,
+                 thumbnail_widths:Tuple[int, ...]=(128, 256, 512), thumbnail_formats:Tuple[str, ...]=("WEBP",)) -> None:
         '''
         :param embed: embedding client
+        :param embed_batch_size: 每批交给嵌入客户端的图片数量
+        :param decode_workers: 解码图片的线程数
+        :param embed_workers: 同时进行的嵌入请求数
+        :param queue_size: 流水线阶段间队列的容量，单位为批
+        :param write_batch_size: 每次写入存储的向量数量
+        :param max_in_flight: 流水线中已解码、尚未嵌入的图片数量上限
+        :param decode_size: 解码图片的最大边长，单位为像素，应不小于嵌入模型所需的输入尺寸
+        :param store: 保存嵌入向量的存储，需与嵌入客户端的模型对应，默认使用该模型在PostgreSQL+pgvector中的向量表
+        :param catalog: 可选的文件目录，索引时用扫描结果更新
+        :param thumbnail_widths: 缩略图变体的宽度，单位为像素
+        :param thumbnail_formats: 缩略图变体的格式，为 VARIANT_FORMATS 中的键
+
+        :raises ValueError: 如果变体格式不受支持，或当前的Pillow不支持编码该格式
         '''
         self.embed = embed
+        self.embed_batch_size = embed_batch_size
+        self.decode_workers = max(1, decode_workers)
+        self.embed_workers = max(1, embed_workers)
+        self.queue_size = max(1, queue_size)
+        self.write_batch_size = max(1, write_batch_size)
+        self.max_in_flight = max(1, max_in_flight)
+        self.decode_size = max(1, decode_size)
+        self.store = store if store is not None else vector_store.pgvector_store.for_model(embed.model_id(), embed.dimension)
+        self.catalog = catalog
+        unsupported = [fmt for fmt in thumbnail_formats if fmt not in VARIANT_FORMATS or not PIL.features.check(fmt.lower())]
+        if unsupported:
+            raise ValueError(f"Unsupported thumbnail formats: {unsupported}")
+        self.thumbnail_widths = tuple(sorted(set(thumbnail_widths)))
+        self.thumbnail_formats = tuple(thumbnail_formats)
     
-    def __create_index(self, cur) -> None:
-        '''
-        创建索引
+    def create_thumbnails(self, docs_path:pathlib.Path, thumbnails_path:pathlib.Path, recreate:bool=False, workers:int|None=None, reduced_decode:bool=True) -> Dict[str, Any]:
         '''
-        cur.execute(
-            "CREATE INDEX IF NOT EXISTS embeddings_hnsw_idx ON embeddings USING hnsw (embedding vector_cosine_ops)"
-        )
-
-    def create_thumbnails(self, docs_path:pathlib.Path, thumbnails_path:pathlib.Path, recreate:bool=False) -> Dict[str, Any]:
-        '''
-        创建缩略图
+        创建缩略图，以及 thumbnail_widths 与 thumbnail_formats 组合出的各个变体。
+        缩略图或任一变体缺失时重新创建该图片的整组缩略图
 
         :param docs_path: 图片文件夹路径
         :param thumbnails_path: 缩略图文件夹路径
         :param recreate: 是否重新创建已存在的缩略图
+        :param workers: 生成缩略图的进程数，默认为CPU核心数。为1时在当前进程中串行处理
+        :param reduced_decode: 是否对JPEG启用缩小解码
 
         :return: 包含处理结果统计的字典，格式为 {'total': int, 'success': int, 'deleted': int, 'failed': int, 'skipped': int, 'failures': list}
         '''
@@ -57,58 +172,318 @@ class indexer:
             image_files.extend(list(docs_path.glob(f'*{ext.upper()}')))
         
         result['total'] = len(image_files)
-        
-        for i, file in enumerate(image_files):
+
+        pending = []
+        for file in image_files:
             thumbnail_path = thumbnails_path / file.name
-            
-            if thumbnail_path.exists() and not recreate:
+            variants = [(width, fmt, thumbnail_variant_path(thumbnails_path, file.name, width, fmt))
+                        for width in self.thumbnail_widths for fmt in self.thumbnail_formats]
+            if not recreate and thumbnail_path.exists() and all(path.exists() for _, _, path in variants):
                 result['skipped'] += 1
                 continue
-                
-            try:
-                with PIL.Image.open(file) as thumbnail:
+            pending.append((file, thumbnail_path, variants))
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        def collect(file:pathlib.Path, failure:Dict[str, str] | None) -> None:
+            if failure is None:
+                result['success'] += 1
+                logging.info(f"Created thumbnail for {file.name} ({result['success']+result['failed']}/{len(pending)})")
+            else:
+                result['failed'] += 1
+                result['failures'].append(failure)
+
+        if workers > 1 and len(pending) > 1:
+            # 多进程并行生成缩略图，绕开GIL以利用全部CPU核心
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(create_thumbnail, file, thumbnail_path, thumbnail_size, reduced_decode, variants): file
+                    for file, thumbnail_path, variants in pending
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    file = futures[future]
                     try:
-                        utilities.compress_image(thumbnail, thumbnail_size)
-                        thumbnail_path.parent.mkdir(parents=True, exist_ok=True)
-                        thumbnail.save(thumbnail_path, format=thumbnail.format)
-                        logging.info(f"Created thumbnail for {file.name} ({i+1}/{result['total']})")
-                        result['success'] += 1
+                        failure = future.result()
                     except Exception as e:
-                        error_msg = str(e)
-                        logging.error(f"Failed to create thumbnail for {file}: {error_msg}")
-                        result['failed'] += 1
-                        result['failures'].append({
-                            'file': str(file),
-                            'stage': 'compress_and_save',
-                            'error': error_msg
-                        })
+                        failure = {'file': str(file), 'stage': 'compress_and_save', 'error': str(e)}
+                    collect(file, failure)
+        else:
+            for file, thumbnail_path, variants in pending:
+                collect(file, create_thumbnail(file, thumbnail_path, thumbnail_size, reduced_decode, variants))
+        
+        # 移除已删除的缩略图，以及宽度或格式已不再使用的变体
+        image_file_names = {file.name for file in image_files}
+        extensions = [VARIANT_FORMATS[fmt][0] for fmt in self.thumbnail_formats]
+        existing_thumbnails = []
+        for entry in thumbnails_path.glob('*'):
+            if entry.is_file():
+                if entry.name not in image_file_names:
+                    existing_thumbnails.append(entry)
+                continue
+            width = entry.name[:-1]
+            keep = entry.name.endswith("w") and width.isdigit() and int(width) in self.thumbnail_widths
+            for variant in entry.glob('*'):
+                name, _, extension = variant.name.rpartition(".")
+                if not (keep and extension in extensions and name in image_file_names):
+                    existing_thumbnails.append(variant)
+        for existing_thumbnail in existing_thumbnails:
+            try:
+                existing_thumbnail.unlink()
+                logging.info(f"Deleted stale thumbnail {existing_thumbnail.relative_to(thumbnails_path)}.")
+                result['deleted'] = result.get('deleted', 0) + 1
             except Exception as e:
                 error_msg = str(e)
-                logging.error(f"Failed to open image file {file}: {error_msg}")
-                result['failed'] += 1
+                logging.error(f"Failed to delete thumbnail {existing_thumbnail.name}: {error_msg}")
                 result['failures'].append({
-                    'file': str(file),
-                    'stage': 'open_image',
+                    'file': str(existing_thumbnail),
+                    'stage': 'delete_thumbnail',
                     'error': error_msg
                 })
-        
-        # 移除已删除的缩略图
-        existing_thumbnails = set(thumbnails_path.glob('*'))
-        for existing_thumbnail in existing_thumbnails:
-            if not existing_thumbnail.name in [file.name for file in image_files]:
+        return result
+
+    def __record_failure(self, result:Dict[str, Any], lock:threading.Lock, file:pathlib.Path, stage:str, error_msg:str) -> None:
+        '''
+        线程安全地记录单个文件的索引失败
+        '''
+        with lock:
+            result['failures'].append({
+                'file': str(file),
+                'stage': stage,
+                'error': error_msg
+            })
+            result['failed_index'] += 1
+
+    def __decode_batch(self, files:List[pathlib.Path], result:Dict[str, Any], lock:threading.Lock) -> List[Tuple[pathlib.Path, PIL.Image.Image]]:
+        '''
+        打开并解码一批图片文件，跳过无法打开或格式不受支持的文件。
+        图片被缩小到 decode_size 以内，JPEG图片直接以缩小的分辨率解码
+
+        :return: 成功解码的 (文件路径, 图片对象) 列表
+        '''
+        decoded: List[Tuple[pathlib.Path, PIL.Image.Image]] = []
+        for file in files:
+            try:
+                image = PIL.Image.open(file)
+            except Exception as e:
+                error_msg = str(e)
+                logging.error(f"Failed to index image file {file}: {error_msg}")
+                self.__record_failure(result, lock, file, 'open_file', error_msg)
+                continue
+            if image.format not in ["JPEG", "PNG"]:
+                logging.warning(f"Unsupported image format: {image.format} for file {file}. Skipping.")
+                self.__record_failure(result, lock, file, 'check_format', f"Unsupported image format: {image.format}")
+                image.close()
+                continue
+            try:
+                # thumbnail 在加载前对JPEG调用 draft，使解码直接得到接近目标大小的图像
+                image.thumbnail((self.decode_size, self.decode_size))
+                image.load()
+            except Exception as e:
+                error_msg = str(e)
+                logging.error(f"Failed to decode image file {file}: {error_msg}")
+                self.__record_failure(result, lock, file, 'open_file', error_msg)
+                image.close()
+                continue
+            decoded.append((file, image))
+        return decoded
+
+    def __embed_images(self, decoded:List[Tuple[pathlib.Path, PIL.Image.Image]], fingerprints:Dict[pathlib.Path, Tuple[int, int, str]]) -> List[Any]:
+        '''
+        调用嵌入客户端。带缓存的客户端直接使用已计算的内容哈希，不再重复读取文件
+        '''
+        images = [image for _, image in decoded]
+        if hasattr(self.embed, "get_cached_images"):
+            return self.embed.embed_images(images, content_hashes=[fingerprints[file][2] for file, _ in decoded],
+                                           decode_size=self.decode_size)
+        return self.embed.embed_images(images)
+
+    def __embed_batch(self, decoded:List[Tuple[pathlib.Path, PIL.Image.Image]], fingerprints:Dict[pathlib.Path, Tuple[int, int, str]],
+                      result:Dict[str, Any], lock:threading.Lock) -> List[Tuple[pathlib.Path, Any]]:
+        '''
+        嵌入一批已解码的图片，并关闭图片对象。
+        整批嵌入失败时逐张重试，只将确实无法嵌入的图片记为失败
+
+        :return: 成功嵌入的 (文件路径, 嵌入向量) 列表
+        '''
+        try:
+            try:
+                embedding_vectors = self.__embed_images(decoded, fingerprints)
+                return [(file, vector) for (file, _), vector in zip(decoded, embedding_vectors)]
+            except Exception as e:
+                if len(decoded) == 1:
+                    error_msg = str(e)
+                    logging.error(f"Failed to embed {decoded[0][0]}: {error_msg}")
+                    self.__record_failure(result, lock, decoded[0][0], 'embed_and_insert', error_msg)
+                    return []
+                logging.warning(f"Failed to embed batch starting at {decoded[0][0]}, retrying one by one: {e}")
+            embedded: List[Tuple[pathlib.Path, Any]] = []
+            for file, image in decoded:
                 try:
-                    existing_thumbnail.unlink()
-                    logging.info(f"Deleted thumbnail {existing_thumbnail.name} as the original image no longer exists.")
-                    result['deleted'] = result.get('deleted', 0) + 1
+                    embedded.append((file, self.__embed_images([(file, image)], fingerprints)[0]))
                 except Exception as e:
                     error_msg = str(e)
-                    logging.error(f"Failed to delete thumbnail {existing_thumbnail.name}: {error_msg}")
-                    result['failures'].append({
-                        'file': str(existing_thumbnail),
-                        'stage': 'delete_thumbnail',
-                        'error': error_msg
-                    })
-        return result
+                    logging.error(f"Failed to embed {file}: {error_msg}")
+                    self.__record_failure(result, lock, file, 'embed_and_insert', error_msg)
+            return embedded
+        finally:
+            for _, image in decoded:
+                image.close()
+
+    def __try_file_hash(self, file:pathlib.Path) -> str | None:
+        try:
+            return utilities.file_hash(file)
+        except Exception as e:
+            logging.error(f"Failed to hash {file}: {e}")
+            return None
+
+    def __run_pipeline(self, files:List[pathlib.Path], fingerprints:Dict[pathlib.Path, Tuple[int, int, str]], result:Dict[str, Any],
+                       catalog:file_catalog.file_catalog|None=None) -> None:
+        '''
+        以 解码 -> 嵌入 -> 写入存储 三级流水线处理图片文件。
+        解码与嵌入阶段分别由 decode_workers 与 embed_workers 个线程并发执行，
+        写入阶段在当前线程中进行，每 write_batch_size 个向量批量写入存储一次。
+        嵌入客户端带缓存时，先按内容哈希查询缓存，只有未命中的文件进入流水线。
+        各阶段之间使用有界队列连接，下游处理不过来时上游会阻塞等待，
+        已解码但尚未嵌入的图片总数不超过 max_in_flight。
+
+        :param files: 待索引的图片文件
+        :param fingerprints: 文件指纹，格式为 {文件路径: (大小, 修改时间, 内容哈希)}
+        :param result: 处理结果统计字典，将被原地更新
+        :param catalog: 需要同步更新的文件目录，成功写入的文件会被加入其中
+        '''
+        lock = threading.Lock()
+        stop = threading.Event()
+        total = len(files)
+        hits: List[Tuple[pathlib.Path, Any]] = []
+
+        if hasattr(self.embed, "get_cached_images") and files:
+            try:
+                cached = self.embed.get_cached_images([fingerprints[file][2] for file in files], decode_size=self.decode_size)
+            except Exception as e:
+                logging.warning(f"Failed to look up embedding cache: {e}")
+                cached = {}
+            hits = [(file, cached[fingerprints[file][2]]) for file in files if fingerprints[file][2] in cached]
+            files = [file for file in files if fingerprints[file][2] not in cached]
+            logging.info(f"{len(hits)} files found in embedding cache.")
+
+        batches: queue.Queue = queue.Queue()
+        decoded_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        embedded_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+
+        for batch_start in range(0, len(files), self.embed_batch_size):
+            batches.put(files[batch_start:batch_start + self.embed_batch_size])
+
+        in_flight = 0
+        in_flight_changed = threading.Condition()
+
+        def reserve(count:int) -> bool:
+            # 按整批预留解码额度，避免多个线程各自持有部分额度而互相等待
+            nonlocal in_flight
+            with in_flight_changed:
+                while in_flight and in_flight + count > self.max_in_flight:
+                    if stop.is_set():
+                        return False
+                    in_flight_changed.wait(0.1)
+                in_flight += count
+                return True
+
+        def release(count:int) -> None:
+            nonlocal in_flight
+            with in_flight_changed:
+                in_flight -= count
+                in_flight_changed.notify_all()
+
+        def put(q:queue.Queue, item) -> bool:
+            # 队列满时阻塞等待，流水线中止时放弃
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def decode_worker() -> None:
+            while not stop.is_set():
+                try:
+                    batch_files = batches.get_nowait()
+                except queue.Empty:
+                    return
+                if not reserve(len(batch_files)):
+                    return
+                decoded = self.__decode_batch(batch_files, result, lock)
+                release(len(batch_files) - len(decoded))
+                if decoded and not put(decoded_queue, decoded):
+                    for _, image in decoded:
+                        image.close()
+                    release(len(decoded))
+
+        def embed_worker() -> None:
+            while True:
+                decoded = decoded_queue.get()
+                if decoded is None:
+                    return
+                if stop.is_set():
+                    for _, image in decoded:
+                        image.close()
+                    release(len(decoded))
+                    continue
+                logging.info(f"Embedding {len(decoded)} files...")
+                embedded = self.__embed_batch(decoded, fingerprints, result, lock)
+                release(len(decoded))
+                if embedded:
+                    put(embedded_queue, embedded)
+
+        def coordinator() -> None:
+            # 上游全部结束后向下游发送结束标记
+            for t in decode_threads:
+                t.join()
+            for _ in embed_threads:
+                decoded_queue.put(None)
+            for t in embed_threads:
+                t.join()
+            put(embedded_queue, None)
+
+        decode_threads = [threading.Thread(target=decode_worker, daemon=True) for _ in range(self.decode_workers)]
+        embed_threads = [threading.Thread(target=embed_worker, daemon=True) for _ in range(self.embed_workers)]
+        for t in decode_threads + embed_threads:
+            t.start()
+        threading.Thread(target=coordinator, daemon=True).start()
+
+        pending: List[Tuple[pathlib.Path, Any]] = []
+
+        def flush() -> None:
+            if not pending:
+                return
+            rows = [(file.name, vector, *fingerprints[file]) for file, vector in pending]
+            failures = self.store.write(rows)
+            for file, _ in pending:
+                if file.name in failures:
+                    logging.error(f"Failed to index {file}: {failures[file.name]}")
+                    self.__record_failure(result, lock, file, 'embed_and_insert', failures[file.name])
+                elif catalog is not None:
+                    catalog.add(file.name)
+            with lock:
+                result['newly_indexed'] += len(pending) - len(failures)
+            pending.clear()
+            logging.info(f"Indexed {result['newly_indexed']}/{total} files.")
+
+        try:
+            # 命中缓存的向量在流水线运行期间直接写入
+            for batch_start in range(0, len(hits), self.write_batch_size):
+                pending.extend(hits[batch_start:batch_start + self.write_batch_size])
+                flush()
+            while True:
+                embedded = embedded_queue.get()
+                if embedded is None:
+                    break
+                pending.extend(embedded)
+                if len(pending) >= self.write_batch_size:
+                    flush()
+            flush()
+        finally:
+            stop.set()
 
     def index_images(self, docs_path:pathlib.Path, recreate:bool=False) -> Dict[str, Any]:
         '''
@@ -117,13 +492,15 @@ class indexer:
         :param docs_path: 图片文件夹路径
 
         :return: 包含处理结果统计的字典，格式为 
-                {'total_found': int, 'newly_indexed': int, 'failed_index': int, 
+                {'total_found': int, 'newly_indexed': int, 'failed_index': int, 'reused': int,
                  'deleted': int, 'index_created': bool, 'failures': list}
+                其中 newly_indexed 包含新增和内容被修改的文件，reused 为复用已有向量的重命名文件
         '''
         result = {
             'total_found': 0,
             'newly_indexed': 0,
             'failed_index': 0,
+            'reused': 0,
             'deleted': 0,
             'index_created': False,
             'failures': []
@@ -132,19 +509,11 @@ class indexer:
         if not docs_path.exists():
             raise ValueError(f"Docs path {docs_path} does not exist.")
 
-        conn = db_init.get_db_connection()
-        cur = conn.cursor()
-        register_vector(cur)
-
         if recreate:
             try:
-                # 删除现有表
-                cur.execute("DROP TABLE IF EXISTS embeddings;")
-                conn.commit()
-                db_init.initialize_database()
+                self.store.clear()
             except Exception as e:
-                logging.error(f"Failed to recreate embeddings table: {e}")
-                conn.rollback()
+                logging.error(f"Failed to clear vector store: {e}")
 
         # 获取目录下所有jpg和png文件
         image_files = []
@@ -154,100 +523,135 @@ class indexer:
 
         result['total_found'] = len(image_files)
 
-        # 查询已经在数据库中的文件名
-        cur.execute("SELECT file_name FROM embeddings")
-        indexed_file_names = [row[0] for row in cur.fetchall()]
-        
-        # 筛选出未索引的图片文件
-        unindexed_files = [file for file in image_files if file.name not in indexed_file_names]
+        # 扫描后被删除或移走的文件直接跳过，其旧记录随后按已删除的文件处理
+        stats = {}
+        for file in image_files:
+            try:
+                stats[file] = file.stat()
+            except FileNotFoundError:
+                logging.warning(f"{file} disappeared before it could be indexed, skipping.")
+        image_files = [file for file in image_files if file in stats]
+
+        # 只有目录对应的文件夹与本次索引的文件夹相同时才同步更新目录
+        catalog = self.catalog if self.catalog is not None and self.catalog.docs_path == docs_path else None
+        if catalog is not None:
+            catalog.replace(file.name for file in image_files)
+
+        # 查询已经在存储中的文件及其指纹
+        indexed_files = self.store.fingerprints()
+        # 内容哈希到已索引文件名的映射，用于识别重命名或重复的文件
+        indexed_hashes = {fingerprint[2]: file_name for file_name, fingerprint in indexed_files.items() if fingerprint[2]}
+
+        # 大小与修改时间均未变化的文件无需打开即可跳过，其余文件需要计算内容哈希
+        to_hash = []
+        for file in image_files:
+            indexed = indexed_files.get(file.name)
+            if indexed is not None and indexed[0] == stats[file].st_size and indexed[1] == stats[file].st_mtime_ns:
+                continue
+            to_hash.append(file)
+
+        fingerprints: Dict[pathlib.Path, Tuple[int, int, str]] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.decode_workers) as executor:
+            for file, content_hash in zip(to_hash, executor.map(self.__try_file_hash, to_hash)):
+                if content_hash is None:
+                    result['failures'].append({
+                        'file': str(file),
+                        'stage': 'hash_file',
+                        'error': "Failed to read file"
+                    })
+                    result['failed_index'] += 1
+                    continue
+                fingerprints[file] = (stats[file].st_size, stats[file].st_mtime_ns, content_hash)
+
+        unchanged_files = []
+        reused_files = []
+        unindexed_files = []
+        for file, (file_size, file_mtime_ns, content_hash) in fingerprints.items():
+            indexed = indexed_files.get(file.name)
+            if indexed is not None and (indexed[2] is None or indexed[2] == content_hash):
+                # 内容未变化，或为旧版本未记录指纹的记录，只需更新指纹
+                unchanged_files.append(file)
+            elif content_hash in indexed_hashes:
+                # 重命名或内容重复的文件，复用已有向量
+                reused_files.append(file)
+            else:
+                unindexed_files.append(file)
 
         # 筛选出已经删除的图片文件
-        deleted_file_names = [file for file in indexed_file_names if not docs_path.joinpath(file).exists()]
+        image_file_names = {file.name for file in image_files}
+        deleted_file_names = [file_name for file_name in indexed_files if file_name not in image_file_names]
 
-        logging.info(f"{len(unindexed_files)} unindexed files found.")
-        
-        # 处理未索引的图片文件
-        for i, file in enumerate(unindexed_files):
+        logging.info(f"{len(unindexed_files)} unindexed files, {len(reused_files)} renamed files, {len(unchanged_files)} touched files found.")
+
+        # 更新内容未变化文件的指纹
+        if unchanged_files:
             try:
-                with PIL.Image.open(file) as image:
-                    if image.format not in ["JPEG", "PNG"]:
-                        logging.warning(f"Unsupported image format: {image.format} for file {file}. Skipping.")
-                        result['failures'].append({
-                            'file': str(file),
-                            'stage': 'check_format',
-                            'error': f"Unsupported image format: {image.format}"
-                        })
-                        result['failed_index'] += 1
-                        continue
-                    
-                    # 嵌入图片
-                    try:
-                        logging.info(f"Indexing {file.name} ({i+1}/{len(unindexed_files)})...")
-                        embedding_vector = self.embed.embed_image(image)
-                        embedding_vector = np.array(embedding_vector)
-                        cur.execute(
-                            "INSERT INTO embeddings (file_name, embedding) VALUES (%s, %s)",
-                            (file.name, embedding_vector)
-                        )
-                        conn.commit()
-                        result['newly_indexed'] += 1
-                    except Exception as e:
-                        error_msg = str(e)
-                        logging.error(f"Failed to index {file}: {error_msg}")
-                        result['failures'].append({
-                            'file': str(file),
-                            'stage': 'embed_and_insert',
-                            'error': error_msg
-                        })
-                        result['failed_index'] += 1
-                        conn.rollback()
+                self.store.update_fingerprints([(file.name, *fingerprints[file]) for file in unchanged_files])
             except Exception as e:
                 error_msg = str(e)
-                logging.error(f"Failed to index image file {file}: {error_msg}")
+                logging.error(f"Failed to update file fingerprints: {error_msg}")
                 result['failures'].append({
-                    'file': str(file),
-                    'stage': 'open_file',
+                    'stage': 'update_fingerprints',
                     'error': error_msg
                 })
-                result['failed_index'] += 1
-            
-        # 删除数据库中已删除的文件记录
-        if deleted_file_names:
+
+        # 通知存储即将写入的数量，大批量写入时存储可先删除索引，写入完成后再一次性构建
+        try:
+            self.store.begin_load(len(unindexed_files) + len(reused_files))
+        except Exception as e:
+            logging.warning(f"Failed to prepare vector store for loading: {e}")
+
+        # 写入过程中出错时也要完成加载，确保被删除的索引得到重建
+        try:
+            # 复用重命名文件的向量，须在删除旧记录之前完成
+            if reused_files:
+                failures = self.store.copy([(file.name, indexed_hashes[fingerprints[file][2]], *fingerprints[file]) for file in reused_files])
+                result['reused'] += len(reused_files) - len(failures)
+                for file in reused_files:
+                    if file.name in failures:
+                        logging.error(f"Failed to reuse embedding for {file}: {failures[file.name]}")
+                        result['failures'].append({
+                            'file': str(file),
+                            'stage': 'reuse_embedding',
+                            'error': failures[file.name]
+                        })
+                        result['failed_index'] += 1
+                    elif catalog is not None:
+                        catalog.add(file.name)
+
+            # 通过流水线处理未索引的图片文件
+            self.__run_pipeline(unindexed_files, fingerprints, result, catalog)
+
+            # 删除存储中已删除的文件记录
+            if deleted_file_names:
+                try:
+                    self.store.delete(deleted_file_names)
+                    logging.info(f"Deleted {len(deleted_file_names)} files from vector store that no longer exist.")
+                    result['deleted'] = len(deleted_file_names)
+                    if catalog is not None:
+                        for file_name in deleted_file_names:
+                            catalog.discard(file_name)
+                except Exception as e:
+                    error_msg = str(e)
+                    logging.error(f"Failed to delete files from vector store: {error_msg}")
+                    result['failures'].append({
+                        'stage': 'delete_records',
+                        'error': error_msg
+                    })
+        finally:
+            # 创建索引
             try:
-                cur.execute(
-                    "DELETE FROM embeddings WHERE file_name = ANY(%s)",
-                    (deleted_file_names,)
-                )
-                conn.commit()
-                logging.info(f"Deleted {len(deleted_file_names)} files from database that no longer exist.")
-                result['deleted'] = len(deleted_file_names)
+                self.store.finish_load()
+                logging.info("Index created successfully.")
+                result['index_created'] = True
             except Exception as e:
                 error_msg = str(e)
-                logging.error(f"Failed to delete files from database: {error_msg}")
+                logging.error(f"Failed to create index: {error_msg}")
                 result['failures'].append({
-                    'stage': 'delete_records',
+                    'stage': 'create_index',
                     'error': error_msg
                 })
-                conn.rollback()
-        
-        # 创建索引
-        try:
-            self.__create_index(cur)
-            conn.commit()
-            logging.info("Index created successfully.")
-            result['index_created'] = True
-        except Exception as e:  
-            error_msg = str(e)
-            logging.error(f"Failed to create index: {error_msg}")
-            result['failures'].append({
-                'stage': 'create_index',
-                'error': error_msg
-            })
-            conn.rollback()
-        
-        cur.close()
-        conn.close()
-        
+
         return result
 
 def main():
@@ -268,6 +672,10 @@ def main():
 
     cohere_client = cohere.ClientV2(api_key=CO_API_KEY)
     embed_client = embedder.cohere_embed(cohere_client)
+    cache_max_size = int(os.getenv("EMBEDDING_CACHE_MAX_SIZE", "1024")) * 1024 * 1024
+    if cache_max_size > 0:
+        cache = embedder.embedding_cache(data_path / "cache" / "embeddings.sqlite", cache_max_size)
+        embed_client = embedder.cached_embed(embed_client, cache)
     db_init.initialize_database()
     indexer_client = indexer(embed_client)
     indexer_client.create_thumbnails(docs_path=data_path/"docs", thumbnails_path=data_path/"thumbnails")
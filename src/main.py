@@ -29,6 +29,10 @@ def main():
         raise ValueError("CO_API_KEY not found in environment variables.")
     cohere_client = cohere.ClientV2(api_key=CO_API_KEY)
     embed_client = embedder.cohere_embed(cohere_client)
+    cache_max_size = int(os.getenv("EMBEDDING_CACHE_MAX_SIZE", "1024")) * 1024 * 1024
+    if cache_max_size > 0:
+        cache = embedder.embedding_cache(data_path / "cache" / "embeddings.sqlite", cache_max_size)
+        embed_client = embedder.cached_embed(embed_client, cache)
 
     # 创建索引器客户端
     indexer_client = indexer.indexer(embed_client)
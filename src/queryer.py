@@ -1,47 +1,501 @@
+import asyncio
 import embedder
 import logging
-import db_init
-from pgvector.psycopg2 import register_vector
-import numpy as np
+import vector_store
+import utilities
+import unicodedata
+import PIL.Image
+from typing import AsyncIterator, Iterator, List
 
 class queryer:
     embed:embedder.embed
-    def __init__(self, embed:embedder.embed):
+    # 查询向量的内存缓存
+    query_cache:utilities.lru_cache
+    # 可选的持久化查询向量缓存，内存缓存未命中时使用
+    persistent_cache:embedder.embedding_cache|None
+    # 搜索结果缓存，键中包含索引代数，索引内容变化后旧结果不再命中
+    result_cache:utilities.lru_cache
+    # 保存嵌入向量的存储
+    store:vector_store.store
+    # 存储的异步查询接口，仅异步方法使用，首次使用时创建
+    async_store:vector_store.async_store|None = None
+    def __init__(self, embed:embedder.embed, query_cache_size:int=1024, query_cache_ttl:float|None=24*3600,
+                 persistent_cache:embedder.embedding_cache|None=None, result_cache_size:int=1024,
+                 store:vector_store.store|None=None):
+        '''
+        :param embed: embedding client
+        :param query_cache_size: 内存中最多缓存的查询向量数，为0时禁用
+        :param query_cache_ttl: 内存中查询向量的有效期，单位为秒
+        :param persistent_cache: 可选的持久化查询向量缓存
+        :param result_cache_size: 内存中最多缓存的搜索结果数，为0时禁用
+        :param store: 保存嵌入向量的存储，需与嵌入客户端的模型对应，默认使用该模型在PostgreSQL+pgvector中的向量表
+        '''
         self.embed = embed
+        self.query_cache = utilities.lru_cache(query_cache_size, query_cache_ttl)
+        self.persistent_cache = persistent_cache
+        self.result_cache = utilities.lru_cache(result_cache_size)
+        self.__result_generation: int | None = None
+        self.store = store if store is not None else vector_store.pgvector_store.for_model(embed.model_id(), embed.dimension)
+
+    @staticmethod
+    def __normalize(query_text: str) -> str:
+        return " ".join(unicodedata.normalize("NFKC", query_text).split())
+
+    def index_generation(self) -> int:
+        '''
+        读取当前的索引代数。代数变化时清空搜索结果缓存，旧代数的结果不会再被使用
+
+        :return: 当前的索引代数
+        '''
+        return self.__observe_generation(self.store.generation())
+
+    async def index_generation_async(self) -> int:
+        '''
+        index_generation 的异步版本
+
+        :return: 当前的索引代数
+        '''
+        return self.__observe_generation(await self.__async_store().generation())
+
+    def __observe_generation(self, generation:int) -> int:
+        if generation != self.__result_generation:
+            self.result_cache.clear()
+            self.__result_generation = generation
+        return generation
+
+    def __async_store(self) -> vector_store.async_store:
+        if self.async_store is None:
+            self.async_store = vector_store.as_async(self.store)
+        return self.async_store
+
+    def embed_query(self, query_text: str) -> List[float]:
+        '''
+        获取查询文本的嵌入向量。查询文本经规范化后与模型标识一起作为缓存键，
+        依次查找内存缓存与持久化缓存，均未命中时才调用嵌入客户端
+
+        :param query_text: 查询文本
+
+        :return: 嵌入向量
+        '''
+        normalized = self.__normalize(query_text)
+        key = f"query:{self.embed.embedding_id()}:{normalized}"
+
+        vector = self.query_cache.get(key)
+        if vector is not None:
+            return vector
+        if self.persistent_cache is not None:
+            vector = self.persistent_cache.get(key)
+        if vector is None:
+            vector = self.embed.embed_query(normalized)
+            if self.persistent_cache is not None:
+                self.persistent_cache.put(key, vector)
+        self.query_cache.put(key, vector)
+        return vector
+
+    def embed_queries(self, query_texts: List[str]) -> List[List[float]]:
+        '''
+        批量获取查询文本的嵌入向量。缓存均未命中的文本通过一次批量调用嵌入
+
+        :param query_texts: 查询文本列表
+
+        :return: 嵌入向量列表，与输入文本一一对应
+        '''
+        keys, texts, vectors = self.__cached_queries(query_texts)
+        # 重复的文本只嵌入一次
+        missing = list(dict.fromkeys(key for key in keys if key not in vectors))
+        if missing:
+            fresh = dict(zip(missing, self.embed.embed_queries([texts[key] for key in missing])))
+            if self.persistent_cache is not None:
+                self.persistent_cache.put_many(fresh)
+            vectors.update(fresh)
+        return self.__remember_queries(keys, vectors)
+
+    async def embed_queries_async(self, query_texts: List[str]) -> List[List[float]]:
+        '''
+        embed_queries 的异步版本。嵌入客户端提供 embed_queries_async 时等待API期间不占用线程，
+        否则在线程池中调用 embed_queries；持久化缓存的读写同样在线程池中进行
+
+        :param query_texts: 查询文本列表
+
+        :return: 嵌入向量列表，与输入文本一一对应
+        '''
+        keys, texts, vectors = await asyncio.to_thread(self.__cached_queries, query_texts)
+        missing = list(dict.fromkeys(key for key in keys if key not in vectors))
+        if missing:
+            missing_texts = [texts[key] for key in missing]
+            if hasattr(self.embed, "embed_queries_async"):
+                embeddings = await self.embed.embed_queries_async(missing_texts)
+            else:
+                embeddings = await asyncio.to_thread(self.embed.embed_queries, missing_texts)
+            fresh = dict(zip(missing, embeddings))
+            if self.persistent_cache is not None:
+                await asyncio.to_thread(self.persistent_cache.put_many, fresh)
+            vectors.update(fresh)
+        return self.__remember_queries(keys, vectors)
+
+    def __cached_queries(self, query_texts: List[str]) -> tuple[List[str], dict[str, str], dict[str, List[float]]]:
+        '''
+        在内存缓存与持久化缓存中查找查询文本的嵌入向量
+
+        :return: (每个文本的缓存键, {缓存键: 规范化后的文本}, {缓存键: 已缓存的向量})
+        '''
+        normalized = [self.__normalize(text) for text in query_texts]
+        embedding_id = self.embed.embedding_id()
+        keys = [f"query:{embedding_id}:{text}" for text in normalized]
+
+        vectors: dict[str, List[float]] = {}
+        for key in keys:
+            vector = self.query_cache.get(key)
+            if vector is not None:
+                vectors[key] = vector
+        if self.persistent_cache is not None:
+            vectors.update(self.persistent_cache.get_many([key for key in keys if key not in vectors]))
+        return keys, dict(zip(keys, normalized)), vectors
+
+    def __remember_queries(self, keys: List[str], vectors: dict[str, List[float]]) -> List[List[float]]:
+        for key, vector in vectors.items():
+            self.query_cache.put(key, vector)
+        return [vectors[key] for key in keys]
     
-    def query(self, query_text: str, max_dist:float) -> list[tuple]:
+    def search(self, query_vector, max_dist:float, k:int|None=None, page:int=0, ef_search:int|None=None,
+               exclude:str|None=None) -> list[tuple]:
+        '''
+        按向量查询相似的图片
+
+        :param query_vector: 查询向量
+        :param max_dist: 最大余弦距离
+        :param k: 每页返回的最大结果数，为None时返回全部满足距离要求的结果（全表扫描）
+        :param page: 页码，从0开始，仅在指定k时有效
+        :param ef_search: HNSW搜索的候选列表大小，为None时使用数据库配置
+        :param exclude: 不出现在结果中的文件名，用于按示例图片查询时排除图片本身
+
+        :return: 包含文件名和相似度的列表，按相似度从高到低排序，格式为 [(file_name, similarity), ...]
+        '''
+        return self.store.search(query_vector, max_dist, k=k, page=page, ef_search=ef_search, exclude=exclude)
+
+    def search_many(self, query_vectors:list, max_dist:float, k:int, ef_search:int|None=None) -> list[list[tuple]]:
+        '''
+        按多个向量查询相似的图片，pgvector存储在一条SQL语句中完成所有查询
+
+        :param query_vectors: 查询向量列表
+        :param max_dist: 最大余弦距离
+        :param k: 每个查询返回的最大结果数
+        :param ef_search: HNSW搜索的候选列表大小，为None时使用数据库配置
+
+        :return: 与查询向量一一对应的结果列表，每项格式为 [(file_name, similarity), ...]，按相似度从高到低排序
+        '''
+        return self.store.search_many(query_vectors, max_dist, k, ef_search=ef_search)
+
+    def query_many(self, query_texts:List[str], max_dist:float, k:int, ef_search:int|None=None) -> list[list[tuple]]:
+        '''
+        批量查询与文本相关的图片。未命中结果缓存的文本通过一次嵌入调用与一条SQL语句完成查询
+
+        :param query_texts: 查询文本列表
+        :param max_dist: 最大余弦距离
+        :param k: 每个查询返回的最大结果数
+        :param ef_search: HNSW搜索的候选列表大小，为None时使用数据库配置
+
+        :return: 与查询文本一一对应的结果列表，每项格式为 [(file_name, similarity), ...]
+
+        :raises ValueError: 如果有查询文本为空
+        '''
+        if any(not text for text in query_texts):
+            raise ValueError("Query text cannot be empty.")
+
+        generation = self.index_generation() if self.result_cache.max_size > 0 else None
+        keys, results = self.__cached_batch(query_texts, generation, max_dist, k, ef_search)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            query_vectors = self.embed_queries([query_texts[i] for i in missing])
+            self.__remember_batch(keys, results, missing, self.search_many(query_vectors, max_dist, k, ef_search=ef_search))
+
+        logging.info(f"Batch query of {len(query_texts)} texts, {len(missing)} not cached.")
+        return [result or [] for result in results]
+
+    async def query_many_async(self, query_texts:List[str], max_dist:float, k:int, ef_search:int|None=None) -> list[list[tuple]]:
+        '''
+        query_many 的异步版本，与其共享结果缓存
+
+        :param query_texts: 查询文本列表
+        :param max_dist: 最大余弦距离
+        :param k: 每个查询返回的最大结果数
+        :param ef_search: HNSW搜索的候选列表大小，为None时使用数据库配置
+
+        :return: 与查询文本一一对应的结果列表，每项格式为 [(file_name, similarity), ...]
+
+        :raises ValueError: 如果有查询文本为空
+        '''
+        if any(not text for text in query_texts):
+            raise ValueError("Query text cannot be empty.")
+
+        generation = await self.index_generation_async() if self.result_cache.max_size > 0 else None
+        keys, results = self.__cached_batch(query_texts, generation, max_dist, k, ef_search)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            query_vectors = await self.embed_queries_async([query_texts[i] for i in missing])
+            result_lists = await self.__async_store().search_many(query_vectors, max_dist, k, ef_search=ef_search)
+            self.__remember_batch(keys, results, missing, result_lists)
+
+        logging.info(f"Batch query of {len(query_texts)} texts, {len(missing)} not cached.")
+        return [result or [] for result in results]
+
+    def __cached_batch(self, query_texts:List[str], generation:int|None, max_dist:float, k:int,
+                       ef_search:int|None) -> tuple[list[tuple | None], list[list[tuple] | None]]:
+        '''
+        在结果缓存中查找批量查询的结果，generation 为None时不使用缓存
+
+        :return: (每个文本的缓存键, 每个文本已缓存的结果，未命中时为None)
+        '''
+        results: list[list[tuple] | None] = [None] * len(query_texts)
+        keys: list[tuple | None] = [None] * len(query_texts)
+        if generation is not None:
+            embedding_id = self.embed.embedding_id()
+            for i, text in enumerate(query_texts):
+                # 与 query 使用相同的缓存键，两者可共享缓存的结果
+                keys[i] = (generation, embedding_id, self.__normalize(text), max_dist, k, 0, ef_search)
+                cached = self.result_cache.get(keys[i])
+                if cached is not None:
+                    results[i] = list(cached)
+        return keys, results
+
+    def __remember_batch(self, keys:list[tuple | None], results:list[list[tuple] | None], missing:list[int],
+                         result_lists:list[list[tuple]]) -> None:
+        for i, result_pairs in zip(missing, result_lists):
+            results[i] = result_pairs
+            if keys[i] is not None:
+                self.result_cache.put(keys[i], tuple(result_pairs))
+
+    def stored_vector(self, file_name:str) -> List[float] | None:
+        '''
+        读取已索引图片的嵌入向量
+
+        :param file_name: 图片文件名
+
+        :return: 嵌入向量，图片未被索引时返回None
+        '''
+        return self.store.get_vector(file_name)
+
+    def query_similar(self, file_name:str, max_dist:float, k:int|None=None, page:int=0, ef_search:int|None=None) -> list[tuple]:
+        '''
+        查询与已索引图片相似的图片。直接使用存储中保存的向量，不调用嵌入客户端
+
+        :param file_name: 作为示例的图片文件名
+        :param max_dist: 最大余弦距离
+        :param k: 每页返回的最大结果数，为None时返回全部满足距离要求的结果（全表扫描）
+        :param page: 页码，从0开始，仅在指定k时有效
+        :param ef_search: HNSW搜索的候选列表大小，为None时使用数据库配置
+
+        :return: 包含文件名和相似度的列表，不包含示例图片本身，格式为 [(file_name, similarity), ...]
+
+        :raises KeyError: 如果示例图片未被索引
+        '''
+        key = None
+        if self.result_cache.max_size > 0:
+            key = (self.index_generation(), "similar", file_name, max_dist, k, page, ef_search)
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                return list(cached)
+
+        query_vector = self.stored_vector(file_name)
+        if query_vector is None:
+            raise KeyError(file_name)
+        result_pairs = self.search(query_vector, max_dist, k=k, page=page, ef_search=ef_search, exclude=file_name)
+        if key is not None:
+            self.result_cache.put(key, tuple(result_pairs))
+        logging.info(f"Found {len(result_pairs)} images similar to {file_name}.")
+        return result_pairs
+
+    async def query_similar_async(self, file_name:str, max_dist:float, k:int|None=None, page:int=0,
+                                  ef_search:int|None=None) -> list[tuple]:
+        '''
+        query_similar 的异步版本，与其共享结果缓存
+
+        :param file_name: 作为示例的图片文件名
+        :param max_dist: 最大余弦距离
+        :param k: 每页返回的最大结果数，为None时返回全部满足距离要求的结果（全表扫描）
+        :param page: 页码，从0开始，仅在指定k时有效
+        :param ef_search: HNSW搜索的候选列表大小，为None时使用数据库配置
+
+        :return: 包含文件名和相似度的列表，不包含示例图片本身，格式为 [(file_name, similarity), ...]
+
+        :raises KeyError: 如果示例图片未被索引
+        '''
+        key = None
+        if self.result_cache.max_size > 0:
+            key = (await self.index_generation_async(), "similar", file_name, max_dist, k, page, ef_search)
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                return list(cached)
+
+        store = self.__async_store()
+        query_vector = await store.get_vector(file_name)
+        if query_vector is None:
+            raise KeyError(file_name)
+        result_pairs = await store.search(query_vector, max_dist, k=k, page=page, ef_search=ef_search, exclude=file_name)
+        if key is not None:
+            self.result_cache.put(key, tuple(result_pairs))
+        logging.info(f"Found {len(result_pairs)} images similar to {file_name}.")
+        return result_pairs
+
+    def query_image(self, image:PIL.Image.Image, max_dist:float, k:int|None=None, page:int=0, ef_search:int|None=None) -> list[tuple]:
+        '''
+        查询与给定图片相似的图片，图片只嵌入一次
+
+        :param image: 作为示例的图片
+        :param max_dist: 最大余弦距离
+        :param k: 每页返回的最大结果数，为None时返回全部满足距离要求的结果（全表扫描）
+        :param page: 页码，从0开始，仅在指定k时有效
+        :param ef_search: HNSW搜索的候选列表大小，为None时使用数据库配置
+
+        :return: 包含文件名和相似度的列表，格式为 [(file_name, similarity), ...]
+
+        :raises ValueError: 如果图片格式不受支持或无法识别
+        '''
+        query_vector = self.embed.embed_image(image)
+        result_pairs = self.search(query_vector, max_dist, k=k, page=page, ef_search=ef_search)
+        logging.info(f"Found {len(result_pairs)} results for the query image.")
+        return result_pairs
+
+    def query(self, query_text: str, max_dist:float, k:int|None=None, page:int=0, ef_search:int|None=None) -> list[tuple]:
         '''
         查询与文本相关的图片
 
         :param query_text: 查询文本
+        :param max_dist: 最大余弦距离
+        :param k: 每页返回的最大结果数，为None时返回全部满足距离要求的结果（全表扫描）
+        :param page: 页码，从0开始，仅在指定k时有效
+        :param ef_search: HNSW搜索的候选列表大小，为None时使用数据库配置
 
         :return: 包含文件名和相似度的列表，格式为 [(file_name, similarity), ...]
         '''
         if not query_text:
             raise ValueError("Query text cannot be empty.")
+
+        # 索引代数在搜索之前读取，缓存的结果至少与该代数一样新
+        key = None
+        if self.result_cache.max_size > 0:
+            key = (self.index_generation(), self.embed.embedding_id(), self.__normalize(query_text), max_dist, k, page, ef_search)
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                logging.info(f"Found {len(cached)} cached results for the query.")
+                return list(cached)
         
         # 获取查询文本的嵌入向量
-        query_vector = self.embed.embed_query(query_text)
-        query_vector = np.array(query_vector)
-
-        conn = db_init.get_db_connection()
-        cur = conn.cursor()
-        register_vector(cur)
-
-        cur.execute(
-            "SELECT file_name, 1 - (embedding <=> %s) AS cosine_similarity FROM embeddings WHERE embedding <=> %s < %s ORDER BY cosine_similarity DESC",
-            (query_vector, query_vector, max_dist)
-        )
+        query_vector = self.embed_query(query_text)
 
-        results = cur.fetchall()
-        if not results:
+        result_pairs = self.search(query_vector, max_dist, k=k, page=page, ef_search=ef_search)
+        if key is not None:
+            self.result_cache.put(key, tuple(result_pairs))
+        if not result_pairs:
             logging.info("No results found for the query.")
             return []
         
-        result_pairs = [(row[0], row[1]) for row in results]
         logging.info(f"Found {len(result_pairs)} results for the query.")
         return result_pairs
 
+    async def query_async(self, query_text: str, max_dist:float, k:int|None=None, page:int=0,
+                          ef_search:int|None=None) -> list[tuple]:
+        '''
+        query 的异步版本，与其共享查询向量缓存与结果缓存。等待嵌入API与数据库期间不占用线程
+
+        :param query_text: 查询文本
+        :param max_dist: 最大余弦距离
+        :param k: 每页返回的最大结果数，为None时返回全部满足距离要求的结果（全表扫描）
+        :param page: 页码，从0开始，仅在指定k时有效
+        :param ef_search: HNSW搜索的候选列表大小，为None时使用数据库配置
+
+        :return: 包含文件名和相似度的列表，格式为 [(file_name, similarity), ...]
+        '''
+        if not query_text:
+            raise ValueError("Query text cannot be empty.")
+
+        key = None
+        if self.result_cache.max_size > 0:
+            key = (await self.index_generation_async(), self.embed.embedding_id(), self.__normalize(query_text),
+                   max_dist, k, page, ef_search)
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                logging.info(f"Found {len(cached)} cached results for the query.")
+                return list(cached)
+
+        query_vector = (await self.embed_queries_async([query_text]))[0]
+        result_pairs = await self.__async_store().search(query_vector, max_dist, k=k, page=page, ef_search=ef_search)
+        if key is not None:
+            self.result_cache.put(key, tuple(result_pairs))
+        logging.info(f"Found {len(result_pairs)} results for the query.")
+        return result_pairs
+
+    def query_stream(self, query_text: str, max_dist:float, k:int|None=None, page:int=0, ef_search:int|None=None,
+                     batch_size:int=100) -> Iterator[list[tuple]]:
+        '''
+        与 query 相同，但分批返回结果，用于流式响应。命中结果缓存时一次返回全部结果；
+        不分页时结果不会被缓存，也不会在内存中累积
+
+        :param query_text: 查询文本
+        :param max_dist: 最大余弦距离
+        :param k: 每页返回的最大结果数，为None时返回全部满足距离要求的结果（全表扫描）
+        :param page: 页码，从0开始，仅在指定k时有效
+        :param ef_search: HNSW搜索的候选列表大小，为None时使用数据库配置
+        :param batch_size: 每批最多包含的结果数
+
+        :return: 结果批次的迭代器，每批格式为 [(file_name, similarity), ...]，按相似度从高到低排序
+        '''
+        if not query_text:
+            raise ValueError("Query text cannot be empty.")
+
+        key = None
+        if self.result_cache.max_size > 0 and k is not None:
+            key = (self.index_generation(), self.embed.embedding_id(), self.__normalize(query_text), max_dist, k, page, ef_search)
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                yield list(cached)
+                return
+
+        query_vector = self.embed_query(query_text)
+        collected: list[tuple] = []
+        for batch in self.store.iter_search(query_vector, max_dist, k=k, page=page, ef_search=ef_search, batch_size=batch_size):
+            if key is not None:
+                collected.extend(batch)
+            yield batch
+        if key is not None:
+            self.result_cache.put(key, tuple(collected))
+
+    async def query_stream_async(self, query_text: str, max_dist:float, k:int|None=None, page:int=0,
+                                 ef_search:int|None=None, batch_size:int=100) -> AsyncIterator[list[tuple]]:
+        '''
+        query_stream 的异步版本，与其共享查询向量缓存与结果缓存
+
+        :param query_text: 查询文本
+        :param max_dist: 最大余弦距离
+        :param k: 每页返回的最大结果数，为None时返回全部满足距离要求的结果（全表扫描）
+        :param page: 页码，从0开始，仅在指定k时有效
+        :param ef_search: HNSW搜索的候选列表大小，为None时使用数据库配置
+        :param batch_size: 每批最多包含的结果数
+
+        :return: 结果批次的异步迭代器，每批格式为 [(file_name, similarity), ...]，按相似度从高到低排序
+        '''
+        if not query_text:
+            raise ValueError("Query text cannot be empty.")
+
+        key = None
+        if self.result_cache.max_size > 0 and k is not None:
+            key = (await self.index_generation_async(), self.embed.embedding_id(), self.__normalize(query_text),
+                   max_dist, k, page, ef_search)
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                yield list(cached)
+                return
+
+        query_vector = (await self.embed_queries_async([query_text]))[0]
+        collected: list[tuple] = []
+        async for batch in self.__async_store().iter_search(query_vector, max_dist, k=k, page=page, ef_search=ef_search,
+                                                             batch_size=batch_size):
+            if key is not None:
+                collected.extend(batch)
+            yield batch
+        if key is not None:
+            self.result_cache.put(key, tuple(collected))
+
 def main():
     import cohere
     import os
@@ -1,16 +1,23 @@
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
 import os
 import pathlib
 import base64
+import json
+import itertools
 import logging
 import indexer
 import queryer
 import embedder
 import db_init
+import file_catalog
+import vector_store
+import utilities
 import cohere
 from dotenv import load_dotenv
 import threading
+import PIL.Image
+import re
 
 # 加载环境变量
 load_dotenv()
@@ -18,6 +25,8 @@ logging.basicConfig(level=logging.INFO)
 
 # 初始化 Flask 应用
 app = Flask(__name__, static_folder=pathlib.Path(os.getcwd()).joinpath("static"))
+# 请求体大小上限，用于限制以图搜图时上传的图片，单位为MB
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_UPLOAD_SIZE", "20")) * 1024 * 1024
 CORS(app)  # 启用CORS，允许前端跨域访问
 
 # 全局变量用于追踪索引构建状态
@@ -32,15 +41,78 @@ indexing_status = {
     }
 }
 
+# /api/search 默认每页返回的结果数
+DEFAULT_SEARCH_K = int(os.getenv("SEARCH_DEFAULT_K", "100"))
+# /api/search/batch 单次请求最多包含的查询数
+MAX_BATCH_QUERIES = int(os.getenv("SEARCH_MAX_BATCH_QUERIES", "100"))
+# 流式搜索每批返回的结果数
+STREAM_BATCH_SIZE = int(os.getenv("SEARCH_STREAM_BATCH_SIZE", "50"))
+# 同时进行的流式搜索数上限。每个流在响应期间占用一个数据库连接，上限应低于连接池大小，
+# 为普通请求保留连接，超出上限的流式请求返回503
+MAX_STREAMS = int(os.getenv("SEARCH_MAX_STREAMS", str(max(1, int(os.getenv("POSTGRES_POOL_MAX", "10")) // 2))))
+stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+# 流式搜索支持的格式及其MIME类型
+STREAM_FORMATS = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+# 带有当前版本号的图片URL的缓存有效期，版本号随文件变化，因此可以视为不可变
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# base64编码的缩略图的内存缓存，键中包含版本号，缩略图重新生成后旧条目不再命中
+thumbnail_base64_cache = utilities.lru_cache(int(os.getenv("THUMBNAIL_BASE64_CACHE_SIZE", "256")))
+# 搜索结果中缩略图版本号的内存缓存，缩略图重新生成后清空。
+# 缓存的版本号过时只会使缩略图请求退回到ETag验证，不会返回错误的内容
+thumbnail_version_cache = utilities.lru_cache(int(os.getenv("THUMBNAIL_VERSION_CACHE_SIZE", "65536")))
+
 # 全局变量用于存储客户端和路径
 cohere_client:cohere.ClientV2
+# 异步搜索使用的客户端，与 cohere_client 同时创建
+cohere_async_client:cohere.AsyncClientV2
+# 本地运行的CLIP模型，EMBEDDER 为 clip 或 onnx_clip 时使用
+clip_client:embedder.embed
 embed_client:embedder.embed
 indexer_client:indexer.indexer
 queryer_client:queryer.queryer
+# 图片文件夹中现有文件的目录，用于过滤搜索结果
+catalog:file_catalog.file_catalog|None = None
+# 本地嵌入向量缓存，EMBEDDING_CACHE_MAX_SIZE 为0时不使用
+embedding_cache:embedder.embedding_cache|None = None
+# 保存嵌入向量的存储，由环境变量 VECTOR_STORE 选择 pgvector 或 numpy
+store:vector_store.store|None = None
 data_path:pathlib.Path
 docs_path:pathlib.Path
 thumbnails_path:pathlib.Path
 
+# 索引构建相关的设置项，格式为 {键: (默认值, 校验函数)}。校验函数接受字符串，不合法时抛出ValueError
+def _parse_positive_int(value:str) -> str:
+    if int(value) <= 0:
+        raise ValueError(f"{value} is not a positive integer")
+    return str(int(value))
+
+def _parse_optional_non_negative_int(value:str) -> str:
+    if value == "":
+        return value
+    if int(value) < 0:
+        raise ValueError(f"{value} is not a non-negative integer")
+    return str(int(value))
+
+def _parse_optional_memory(value:str) -> str:
+    if value and not re.fullmatch(r"\d+\s*(kB|MB|GB|TB)?", value):
+        raise ValueError(f"{value} is not a valid memory size")
+    return value
+
+def _parse_storage_mode(value:str) -> str:
+    if value not in db_init.STORAGE_MODES:
+        raise ValueError(f"{value} is not a supported storage mode")
+    return value
+
+INDEX_SETTINGS = {
+    "hnsw_m": ("16", _parse_positive_int),
+    "hnsw_ef_construction": ("64", _parse_positive_int),
+    "maintenance_work_mem": ("", _parse_optional_memory),
+    "max_parallel_maintenance_workers": ("", _parse_optional_non_negative_int),
+    "bulk_load_threshold": ("10000", _parse_positive_int),
+    "vector_storage": ("vector", _parse_storage_mode),
+    "binary_rerank_factor": ("4", _parse_positive_int),
+}
+
 def get_db_setting(key:str, default_value:str="") -> str:
     """
     从数据库获取设置项
@@ -53,13 +125,10 @@ def get_db_setting(key:str, default_value:str="") -> str:
     :raises Exception: 如果数据库连接或查询失败
     """
     try:
-        conn = db_init.get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM settings WHERE key = %s", (key,))
-        result = cur.fetchone()
-        cur.close()
-        conn.close()
-        
+        with db_init.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT value FROM settings WHERE key = %s", (key,))
+            result = cur.fetchone()
+
         if result:
             return result[0]
         return default_value
@@ -79,22 +148,17 @@ def update_db_setting(key:str, value:str) -> bool:
     :raises Exception: 如果数据库连接或更新失败
     """
     try:
-        conn = db_init.get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute(
-            """
-            INSERT INTO settings (key, value, updated_at) 
-            VALUES (%s, %s, CURRENT_TIMESTAMP)
-            ON CONFLICT (key) 
-            DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP
-            """, 
-            (key, value)
-        )
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_init.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO settings (key, value, updated_at) 
+                VALUES (%s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (key) 
+                DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP
+                """, 
+                (key, value)
+            )
+            conn.commit()
         return True
     except Exception as e:
         logging.error(f"Settings update failed: {e}")
@@ -110,13 +174,26 @@ def initialize_server(hot_reload:bool=False) -> bool:
 
     :raises Exception: 如果初始化过程中发生错误
     """
-    global cohere_client, embed_client, indexer_client, queryer_client
-    global data_path, docs_path, thumbnails_path
+    global cohere_client, cohere_async_client, clip_client, embed_client, indexer_client, queryer_client, catalog, store
+    global embedding_cache, data_path, docs_path, thumbnails_path
     
     try:
+        store_type = os.getenv("VECTOR_STORE", "pgvector")
+        if store_type not in ("pgvector", "numpy"):
+            raise ValueError(f"Unsupported VECTOR_STORE: {store_type}")
+        embedder_type = os.getenv("EMBEDDER", "cohere")
+        if embedder_type not in ("cohere", "clip", "onnx_clip"):
+            raise ValueError(f"Unsupported EMBEDDER: {embedder_type}")
+
         if not hot_reload:
             logging.info("Initializing database...")
-            db_init.initialize_database(recreate=False)
+            try:
+                db_init.initialize_database(recreate=False)
+            except Exception as e:
+                # numpy存储不依赖数据库，此时设置项使用默认值
+                if store_type == "pgvector":
+                    raise
+                logging.warning(f"Database unavailable, settings fall back to defaults: {e}")
         
         # 数据路径设置
         db_data_path = get_db_setting("data_path")
@@ -131,22 +208,90 @@ def initialize_server(hot_reload:bool=False) -> bool:
         
         docs_path.mkdir(parents=True, exist_ok=True)
         thumbnails_path.mkdir(parents=True, exist_ok=True)
+        thumbnail_version_cache.clear()
         
         logging.info(f"Data path set as: {data_path}")
         
         if not db_data_path:
             update_db_setting("data_path", str(data_path))
 
+        # 图片文件夹未变化时沿用已有的目录与核对线程
+        if catalog is None or catalog.docs_path != docs_path:
+            if catalog is not None:
+                catalog.stop()
+            catalog = file_catalog.file_catalog(docs_path, float(os.getenv("FILE_CATALOG_RECONCILE_INTERVAL", "300")))
+            catalog.start()
+
         # 初始化各个对象
         if not hot_reload:
-            CO_API_KEY = os.getenv("CO_API_KEY")
-            if not CO_API_KEY:
-                raise ValueError("CO_API_KEY not found in environment variables.")
-            cohere_client = cohere.ClientV2(api_key=CO_API_KEY)
-
-        embed_client = embedder.cohere_embed(cohere_client)
-        indexer_client = indexer.indexer(embed_client)
-        queryer_client = queryer.queryer(embed_client)
+            if embedder_type == "cohere":
+                CO_API_KEY = os.getenv("CO_API_KEY")
+                if not CO_API_KEY:
+                    raise ValueError("CO_API_KEY not found in environment variables.")
+                cohere_client = cohere.ClientV2(api_key=CO_API_KEY)
+                cohere_async_client = cohere.AsyncClientV2(api_key=CO_API_KEY)
+            else:
+                clip_num_threads = os.getenv("CLIP_NUM_THREADS")
+                clip_options = {
+                    "batch_size": int(os.getenv("CLIP_BATCH_SIZE", "32")),
+                    "preprocess_workers": int(os.getenv("CLIP_PREPROCESS_WORKERS", "4")),
+                    "num_threads": int(clip_num_threads) if clip_num_threads else None
+                }
+                if embedder_type == "onnx_clip":
+                    # 模型由 export_onnx_clip.py 导出
+                    onnx_path = pathlib.Path(os.getenv("CLIP_ONNX_PATH") or data_path / "models" / "clip-onnx")
+                    clip_client = embedder.onnx_CLIP_embed(onnx_path, **clip_options)
+                else:
+                    clip_client = embedder.CLIP_embed(model_name=os.getenv("CLIP_MODEL", "ViT-B/32"), **clip_options)
+
+        embed_client = embedder.cohere_embed(cohere_client, async_client=cohere_async_client) if embedder_type == "cohere" else clip_client
+        # 本地嵌入缓存，重建索引时内容未变化的图片不再调用API
+        cache_max_size = int(os.getenv("EMBEDDING_CACHE_MAX_SIZE", "1024")) * 1024 * 1024
+        cache_path = data_path / "cache" / "embeddings.sqlite"
+        # 路径与大小未变化时沿用已打开的缓存，否则先关闭旧缓存，写入其尚未保存的访问时间
+        if embedding_cache is not None and (cache_max_size <= 0 or embedding_cache.path != cache_path
+                                            or embedding_cache.max_size != cache_max_size):
+            embedding_cache.close()
+            embedding_cache = None
+        if cache_max_size > 0 and embedding_cache is None:
+            embedding_cache = embedder.embedding_cache(cache_path, cache_max_size)
+        if embedding_cache is not None:
+            embed_client = embedder.cached_embed(embed_client, embedding_cache)
+        # 每个模型的向量分别保存，切换模型后搜索使用与当前模型对应的向量
+        if store_type == "numpy":
+            # 存储的数据只在内存中完整，数据路径未变化时沿用已加载的存储
+            vectors_path = data_path / "vectors" / db_init.model_table_name(embed_client.model_id())
+            if not (isinstance(store, vector_store.numpy_store) and store.path == vectors_path):
+                store = vector_store.numpy_store(vectors_path, dim=embed_client.dimension)
+        else:
+            index_settings = {key: get_db_setting(key, default) for key, (default, _) in INDEX_SETTINGS.items()}
+            # 存储方式变化时，已有数据在下次建立索引时转换，HNSW索引随后重建
+            store = vector_store.pgvector_store.for_model(
+                embed_client.model_id(),
+                embed_client.dimension,
+                hnsw_m=int(index_settings["hnsw_m"]),
+                hnsw_ef_construction=int(index_settings["hnsw_ef_construction"]),
+                maintenance_work_mem=index_settings["maintenance_work_mem"] or None,
+                max_parallel_maintenance_workers=int(index_settings["max_parallel_maintenance_workers"]) if index_settings["max_parallel_maintenance_workers"] else None,
+                bulk_load_threshold=int(index_settings["bulk_load_threshold"]),
+                storage=index_settings["vector_storage"],
+                rerank_factor=int(index_settings["binary_rerank_factor"])
+            )
+        indexer_client = indexer.indexer(
+            embed_client,
+            store=store,
+            catalog=catalog,
+            thumbnail_widths=tuple(int(width) for width in os.getenv("THUMBNAIL_WIDTHS", "128,256,512").split(",") if width.strip()),
+            thumbnail_formats=tuple(fmt.strip().upper() for fmt in os.getenv("THUMBNAIL_FORMATS", "webp").split(",") if fmt.strip())
+        )
+        queryer_client = queryer.queryer(
+            embed_client,
+            query_cache_size=int(os.getenv("QUERY_CACHE_SIZE", "1024")),
+            query_cache_ttl=float(os.getenv("QUERY_CACHE_TTL", str(24*3600))),
+            persistent_cache=embedding_cache,
+            result_cache_size=int(os.getenv("RESULT_CACHE_SIZE", "1024")),
+            store=store
+        )
         
         logging.info("Server initialized successfully.")
         return True
@@ -176,6 +321,7 @@ def build_index_process(recreate=False) -> None:
             thumbnails_path=thumbnails_path,
             recreate=recreate
         )
+        thumbnail_version_cache.clear()
         
         indexing_status["stats"]["thumbnails"] = thumbnail_stats
         total_thumbnails = thumbnail_stats.get('total', 0)
@@ -197,9 +343,9 @@ def build_index_process(recreate=False) -> None:
         failed_index = indexing_stats.get('failed_index', 0)
         
         if failed_index > 0:
-            indexing_status["message"] = f"索引完成，但有 {failed_index} 张图片索引失败。新增索引 {newly_indexed} 张，删除 {indexing_stats.get('deleted', 0)} 张。"
+            indexing_status["message"] = f"索引完成，但有 {failed_index} 张图片索引失败。新增索引 {newly_indexed} 张，复用 {indexing_stats.get('reused', 0)} 张，删除 {indexing_stats.get('deleted', 0)} 张。"
         else:
-            indexing_status["message"] = f"索引完成。新增索引 {newly_indexed} 张，删除 {indexing_stats.get('deleted', 0)} 张。"
+            indexing_status["message"] = f"索引完成。新增索引 {newly_indexed} 张，复用 {indexing_stats.get('reused', 0)} 张，删除 {indexing_stats.get('deleted', 0)} 张。"
             
         # 如果有任何失败，设置一个警告标记
         if failed_thumbnails > 0 or failed_index > 0:
@@ -279,20 +425,17 @@ def get_index_status():
 def get_settings():
     """获取所有设置的API端点"""
     try:
-        conn = db_init.get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT key, value FROM settings")
-        
-        settings = {}
-        for row in cur.fetchall():
-            settings[row[0]] = row[1]
-        
-        cur.close()
-        conn.close()
+        with db_init.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT key, value FROM settings")
+            settings = {}
+            for row in cur.fetchall():
+                settings[row[0]] = row[1]
         
         # 处理默认值
         if "data_path" not in settings:
             settings["data_path"] = str(data_path)
+        for key, (default, _) in INDEX_SETTINGS.items():
+            settings.setdefault(key, default)
         
         return jsonify({
             "success": True, 
@@ -317,6 +460,15 @@ def get_setting(key):
             "value": value,
             "default": True
         })
+    if key in INDEX_SETTINGS:
+        default = INDEX_SETTINGS[key][0]
+        value = get_db_setting(key, default)
+        return jsonify({
+            "success": True,
+            "key": key,
+            "value": value,
+            "default": value == default
+        })
     return jsonify({
         "success": False,
         "message": f"设置项 '{key}' 不存在",
@@ -337,6 +489,7 @@ def update_settings():
         
         updated = {}
         failed = {}
+        previous_storage = get_db_setting("vector_storage", INDEX_SETTINGS["vector_storage"][0])
         
         for key, value in data.items():
             if key == "data_path":
@@ -344,6 +497,16 @@ def update_settings():
                     updated[key] = value
                 else:
                     failed[key] = "更新失败"
+            elif key in INDEX_SETTINGS:
+                try:
+                    value = INDEX_SETTINGS[key][1](str(value).strip())
+                except ValueError:
+                    failed[key] = "无效的设置值"
+                    continue
+                if update_db_setting(key, value):
+                    updated[key] = value
+                else:
+                    failed[key] = "更新失败"
             else:
                 failed[key] = "不支持的设置项"
         
@@ -357,6 +520,15 @@ def update_settings():
         elif not initialize_server(hot_reload=True):
             result["message"] = "设置更新成功，但服务器重新加载失败，请检查日志"
             return jsonify(result), 500
+        elif updated.get("vector_storage", previous_storage) != previous_storage:
+            # 存储方式的转换与索引重建在后台的索引过程中进行，不阻塞当前请求
+            if indexing_status["is_indexing"]:
+                result["message"] = "设置更新成功，存储方式将在下次建立索引时转换"
+            else:
+                thread = threading.Thread(target=build_index_process, args=(False,))
+                thread.daemon = True
+                thread.start()
+                result["message"] = "设置更新成功，存储方式正在后台转换"
             
         return jsonify(result)
     
@@ -367,37 +539,274 @@ def update_settings():
             "message": f"更新设置失败: {str(e)}"
         }), 500
 
+def thumbnail_version(file_name:str) -> str | None:
+    """
+    读取缩略图的版本号，优先使用缓存，避免每条搜索结果都访问一次文件系统
+
+    :param file_name: 原图文件名
+
+    :return: 版本号，缩略图不存在时返回None
+    """
+    version = thumbnail_version_cache.get(file_name)
+    if version is None:
+        version = file_version(thumbnails_path / file_name)
+        if version is not None:
+            thumbnail_version_cache.put(file_name, version)
+    return version
+
+def present_results(results:list[tuple]) -> list[dict]:
+    """
+    将查询结果转换为响应格式，并排除图片文件夹中已不存在的文件。
+    每条结果附带缩略图的版本号，前端以 ?v=版本号 请求缩略图时可长期缓存
+
+    :param results: 查询结果，格式为 [(file_name, similarity), ...]
+
+    :return: 响应中的结果列表
+    """
+    return [
+        {"file_name": file_name, "similarity": similarity, "version": thumbnail_version(file_name)}
+        for file_name, similarity in results
+        if file_name in catalog
+    ]
+
+def _get_arg(args, key:str, default, type):
+    """与 werkzeug 的 args.get(key, default, type=type) 相同，无法转换时返回默认值"""
+    try:
+        return type(args[key])
+    except (KeyError, TypeError, ValueError):
+        return default
+
+def parse_search_args(args) -> tuple[float, int, int, int | None] | None:
+    """
+    解析搜索请求中的距离阈值与分页参数
+
+    :param args: 请求参数，request.args、request.form 或 ASGI 请求的 query_params
+
+    :return: (max_dist, k, page, ef_search)，参数不合法时返回None。k为0表示不分页
+    """
+    max_dist = _get_arg(args, 'max_dist', 0.57, float)
+    k = _get_arg(args, 'k', DEFAULT_SEARCH_K, int)
+    page = _get_arg(args, 'page', 0, int)
+    ef_search = _get_arg(args, 'ef_search', None, int)
+    if k < 0 or page < 0 or (ef_search is not None and not 1 <= ef_search <= 1000):
+        return None
+    return max_dist, k, page, ef_search
+
+def parse_batch_search(data) -> tuple[list[str], float, int, int | None]:
+    """
+    解析批量搜索请求的JSON数据
+
+    :param data: 请求体解析后的JSON数据
+
+    :return: (queries, max_dist, k, ef_search)
+
+    :raises ValueError: 如果请求数据不合法，异常信息为返回给客户端的提示
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('queries'), list):
+        raise ValueError("无效的请求数据")
+
+    queries = data['queries']
+    if not queries or any(not isinstance(query, str) or not query for query in queries):
+        raise ValueError("查询不能为空")
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise ValueError(f"单次最多包含 {MAX_BATCH_QUERIES} 个查询")
+
+    try:
+        max_dist = float(data.get('max_dist', 0.57))
+        k = int(data.get('k', DEFAULT_SEARCH_K))
+        ef_search = int(data['ef_search']) if data.get('ef_search') is not None else None
+    except (TypeError, ValueError):
+        raise ValueError("无效的分页参数")
+    if k <= 0 or (ef_search is not None and not 1 <= ef_search <= 1000):
+        raise ValueError("无效的分页参数")
+    return queries, max_dist, k, ef_search
+
+def batch_search_response(queries:list[str], results:list[list[tuple]], k:int) -> dict:
+    """
+    构造批量搜索请求的响应
+
+    :param queries: 查询文本列表
+    :param results: 与查询文本一一对应的查询结果
+    :param k: 每个查询返回的最大结果数
+
+    :return: 响应内容
+    """
+    return {
+        "success": True,
+        "k": k,
+        "results": [
+            {"query": query, "results": present_results(query_results)}
+            for query, query_results in zip(queries, results)
+        ]
+    }
+
+def search_response(results:list[tuple], k:int, page:int, **fields) -> dict:
+    """
+    构造单个搜索请求的响应
+
+    :param results: 查询结果，格式为 [(file_name, similarity), ...]
+    :param k: 每页结果数，为0表示不分页
+    :param page: 页码
+    :param fields: 响应中的其他字段
+
+    :return: 响应内容
+    """
+    return {
+        "success": True,
+        **fields,
+        "k": k,
+        "page": page,
+        # 本页结果数达到k时，下一页可能还有结果
+        "has_more": k > 0 and len(results) == k,
+        "results": present_results(results)
+    }
+
+def parse_stream_format(args, accept_mimetypes) -> str | None:
+    """
+    解析搜索请求的流式格式。stream 参数优先，未指定时按 Accept 头中明确列出的MIME类型选择
+
+    :param args: 请求参数
+    :param accept_mimetypes: 请求的 Accept 头，可迭代出 (MIME类型, 权重)
+
+    :return: STREAM_FORMATS 中的键，不使用流式响应时返回空字符串
+
+    :raises ValueError: 如果 stream 参数不是支持的格式
+    """
+    stream = args.get('stream')
+    if stream is not None:
+        if stream not in STREAM_FORMATS:
+            raise ValueError(f"Unsupported stream format: {stream}")
+        return stream
+    accepted = {value for value, quality in accept_mimetypes if quality > 0}
+    return next((fmt for fmt, mimetype in STREAM_FORMATS.items() if mimetype in accepted), "")
+
+def stream_event(stream:str, event:str, data:dict) -> str:
+    """
+    编码流式响应中的一个事件。NDJSON每行一个对象，事件类型保存在 type 字段中；SSE使用 event 字段
+
+    :param stream: STREAM_FORMATS 中的键
+    :param event: 事件类型，为 meta、results、done 或 error
+    :param data: 事件内容
+
+    :return: 编码后的文本
+    """
+    if stream == "sse":
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return json.dumps({"type": event, **data}, ensure_ascii=False) + "\n"
+
+def search_stream_events(stream:str, first:list[tuple] | None, batches, k:int, page:int, **fields):
+    """
+    生成流式搜索响应的事件：先发送 meta，再按批发送 results，最后发送 done。
+    搜索中途出错时发送 error 事件并结束。客户端断开时关闭 batches，释放其占用的数据库连接
+
+    :param stream: STREAM_FORMATS 中的键
+    :param first: 已取出的第一批结果，没有结果时为None
+    :param batches: 其余结果批次的生成器
+    :param k: 每页结果数，为0表示不分页
+    :param page: 页码
+    :param fields: meta 事件中的其他字段
+
+    :return: 事件文本的迭代器
+    """
+    total = 0
+    sent = 0
+    try:
+        yield stream_event(stream, "meta", {"success": True, **fields, "k": k, "page": page})
+        for batch in itertools.chain([first] if first is not None else [], batches):
+            total += len(batch)
+            results = present_results(batch)
+            sent += len(results)
+            if results:
+                yield stream_event(stream, "results", {"results": results})
+    except Exception as e:
+        logging.error(f"Failed to stream search results: {e}")
+        yield stream_event(stream, "error", {"success": False, "message": f"搜索出错: {str(e)}"})
+        return
+    finally:
+        batches.close()
+    # 与 search_response 相同，本页结果数达到k时下一页可能还有结果
+    yield stream_event(stream, "done", {"count": sent, "has_more": k > 0 and total == k})
+
+def hold_stream_slot(batches):
+    """
+    在结果批次迭代结束或被关闭时释放流式搜索名额。调用方须先取得 stream_slots，
+    并至少取出一批结果，使生成器在被关闭或回收时一定会执行释放
+
+    :param batches: 结果批次的生成器
+
+    :return: 结果批次的生成器
+    """
+    try:
+        yield from batches
+    finally:
+        stream_slots.release()
+
+def busy_response():
+    """连接池或流式搜索名额耗尽时的响应"""
+    response = jsonify({
+        "success": False,
+        "message": "服务器繁忙，请稍后重试"
+    })
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return response
+
+def stream_response(stream:str, events) -> Response:
+    """
+    返回流式响应，并禁止代理缓冲
+
+    :param stream: STREAM_FORMATS 中的键
+    :param events: 事件文本的迭代器
+
+    :return: 响应对象
+    """
+    return Response(events, mimetype=STREAM_FORMATS[stream], headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
 @app.route('/api/search', methods=['GET'])
 def search_images():
     """搜索图像的API端点"""
     query = request.args.get('q', '')
-    max_dist = float(request.args.get('max_dist', 0.57))
     
     if not query:
         return jsonify({
             "success": False,
             "message": "查询不能为空"
         }), 400
+    search_args = parse_search_args(request.args)
+    if search_args is None:
+        return jsonify({
+            "success": False,
+            "message": "无效的分页参数"
+        }), 400
+    max_dist, k, page, ef_search = search_args
+    try:
+        stream = parse_stream_format(request.args, request.accept_mimetypes)
+    except ValueError:
+        return jsonify({
+            "success": False,
+            "message": "无效的流式格式"
+        }), 400
     
     try:
+        if stream:
+            if not stream_slots.acquire(blocking=False):
+                return busy_response()
+            # 取出第一批结果后再开始响应，嵌入或连接数据库失败时仍能返回错误状态码
+            batches = hold_stream_slot(queryer_client.query_stream(query, max_dist=max_dist, k=k or None, page=page,
+                                                                   ef_search=ef_search, batch_size=STREAM_BATCH_SIZE))
+            first = next(batches, None)
+            return stream_response(stream, search_stream_events(stream, first, batches, k, page, query=query))
+
         # 执行查询
-        results = queryer_client.query(query, max_dist=max_dist)
-        response_results = []
-        
-        for file_name, similarity in results:
-            doc_path = docs_path / file_name
-            if doc_path.exists():
-                response_results.append({
-                    "file_name": file_name,
-                    "similarity": similarity,
-                })
-        
-        return jsonify({
-            "success": True,
-            "query": query,
-            "results": response_results
-        })
+        results = queryer_client.query(query, max_dist=max_dist, k=k or None, page=page, ef_search=ef_search)
+        return jsonify(search_response(results, k, page, query=query))
         
+    except TimeoutError as e:
+        logging.warning(f"Search rejected: {e}")
+        return busy_response()
     except Exception as e:
         logging.error(f"Failed to search: {e}")
         return jsonify({
@@ -405,6 +814,172 @@ def search_images():
             "message": f"搜索出错: {str(e)}"
         }), 500
 
+@app.route('/api/search/similar/<path:file_name>', methods=['GET'])
+def search_similar_images(file_name):
+    """以已索引图片为示例搜索相似图像的API端点，直接使用已保存的向量"""
+    search_args = parse_search_args(request.args)
+    if search_args is None:
+        return jsonify({
+            "success": False,
+            "message": "无效的分页参数"
+        }), 400
+    max_dist, k, page, ef_search = search_args
+
+    try:
+        results = queryer_client.query_similar(file_name, max_dist=max_dist, k=k or None, page=page, ef_search=ef_search)
+        return jsonify(search_response(results, k, page, file_name=file_name))
+
+    except TimeoutError as e:
+        logging.warning(f"Search rejected: {e}")
+        return busy_response()
+    except KeyError:
+        return jsonify({
+            "success": False,
+            "message": "图像未被索引"
+        }), 404
+    except Exception as e:
+        logging.error(f"Failed to search similar images: {e}")
+        return jsonify({
+            "success": False,
+            "message": f"搜索出错: {str(e)}"
+        }), 500
+
+@app.route('/api/search/image', methods=['POST'])
+def search_by_image():
+    """以上传的图片为示例搜索相似图像的API端点"""
+    upload = request.files.get('image')
+    if upload is None:
+        return jsonify({
+            "success": False,
+            "message": "未上传图片"
+        }), 400
+    search_args = parse_search_args(request.form)
+    if search_args is None:
+        return jsonify({
+            "success": False,
+            "message": "无效的分页参数"
+        }), 400
+    max_dist, k, page, ef_search = search_args
+
+    try:
+        image = PIL.Image.open(upload.stream)
+        image.load()
+    except Exception as e:
+        logging.warning(f"Failed to open uploaded image: {e}")
+        return jsonify({
+            "success": False,
+            "message": "无法识别的图片"
+        }), 400
+
+    try:
+        results = queryer_client.query_image(image, max_dist=max_dist, k=k or None, page=page, ef_search=ef_search)
+        return jsonify(search_response(results, k, page))
+
+    except TimeoutError as e:
+        logging.warning(f"Search rejected: {e}")
+        return busy_response()
+    except Exception as e:
+        logging.error(f"Failed to search by image: {e}")
+        return jsonify({
+            "success": False,
+            "message": f"搜索出错: {str(e)}"
+        }), 500
+
+@app.route('/api/search/batch', methods=['POST'])
+def search_images_batch():
+    """批量搜索图像的API端点，所有查询共用一次嵌入调用与一次数据库查询"""
+    try:
+        queries, max_dist, k, ef_search = parse_batch_search(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "message": str(e)
+        }), 400
+
+    try:
+        results = queryer_client.query_many(queries, max_dist=max_dist, k=k, ef_search=ef_search)
+        return jsonify(batch_search_response(queries, results, k))
+
+    except TimeoutError as e:
+        logging.warning(f"Search rejected: {e}")
+        return busy_response()
+    except Exception as e:
+        logging.error(f"Failed to search in batch: {e}")
+        return jsonify({
+            "success": False,
+            "message": f"搜索出错: {str(e)}"
+        }), 500
+
+def file_version(path:pathlib.Path) -> str | None:
+    """
+    由文件的修改时间与大小生成版本号，同时用作ETag。文件被替换或重新生成后版本号随之变化
+
+    :param path: 文件路径
+
+    :return: 版本号，文件不存在时返回None
+    """
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+def set_cache_headers(response, version:str | None):
+    """
+    设置图片响应的缓存策略：请求的版本号与文件当前版本一致时允许长期缓存，
+    否则要求客户端每次使用前通过ETag重新验证
+
+    :param response: 响应对象
+    :param version: 文件当前的版本号
+
+    :return: 响应对象
+    """
+    if version is not None and request.args.get('v') == version:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+def send_versioned_file(path:pathlib.Path, mimetype:str, version:str | None=None, **kwargs):
+    """
+    发送文件，附带ETag与Last-Modified。条件请求命中时返回304，带有Range头时返回206
+
+    :param path: 文件路径
+    :param mimetype: 文件的MIME类型
+    :param version: 判断能否长期缓存时使用的版本号，默认为文件自身的版本号
+    :param kwargs: 传给 send_file 的其他参数
+
+    :return: 响应对象
+    """
+    etag = file_version(path)
+    response = send_file(str(path), mimetype=mimetype, etag=etag or True, conditional=True, **kwargs)
+    return set_cache_headers(response, version or etag)
+
+def thumbnail_variant(file_name:str, width:int) -> tuple[pathlib.Path, str] | None:
+    """
+    选择不小于请求宽度的最小缩略图变体，没有时使用最宽的变体。
+    格式按 AVIF、WebP 的顺序选择，且必须在请求的 Accept 头中明确列出
+
+    :param file_name: 原图文件名
+    :param width: 请求的显示宽度，单位为像素
+
+    :return: (变体路径, MIME类型)，没有可用的变体时返回None
+    """
+    widths = indexer_client.thumbnail_widths
+    if not widths:
+        return None
+    chosen = next((candidate for candidate in widths if candidate >= width), widths[-1])
+    accepted = {value for value, quality in request.accept_mimetypes if quality > 0}
+    for fmt, (_, mimetype) in indexer.VARIANT_FORMATS.items():
+        if mimetype in accepted:
+            path = indexer.thumbnail_variant_path(thumbnails_path, file_name, chosen, fmt)
+            if path.exists():
+                return path, mimetype
+    return None
+
 @app.route('/api/thumbnail/<path:file_name>', methods=['GET'])
 def get_thumbnail(file_name):
     """获取缩略图的API端点"""
@@ -423,9 +998,17 @@ def get_thumbnail(file_name):
                 "message": "找不到缩略图文件"
             }), 404
         
-        mime_type = 'image/jpeg' if file_name.lower().endswith(('.jpg', '.jpeg')) else 'image/png'
-        
-        return send_file(str(file_path), mimetype=mime_type)
+        # 指定显示宽度时返回对应的WebP或AVIF变体，变体与缩略图共用版本号
+        width = request.args.get('w', 0, type=int)
+        variant = thumbnail_variant(file_name, width) if width > 0 else None
+        if variant is not None:
+            response = send_versioned_file(variant[0], variant[1], version=file_version(file_path))
+        else:
+            mime_type = 'image/jpeg' if file_name.lower().endswith(('.jpg', '.jpeg')) else 'image/png'
+            response = send_versioned_file(file_path, mime_type)
+        if width > 0:
+            response.vary.add('Accept')
+        return response
     
     except ValueError as e:
         logging.warning(f"{e}")
@@ -458,17 +1041,24 @@ def get_thumbnail_base64(file_name):
                 "message": "找不到缩略图文件"
             }), 404
         
-        # 读取文件并转换为base64
-        with open(file_path, 'rb') as img_file:
-            img_data = base64.b64encode(img_file.read()).decode('utf-8')
+        # 同一版本的缩略图只编码一次
+        version = file_version(file_path)
+        img_src = thumbnail_base64_cache.get((file_name, version))
+        if img_src is None:
+            with open(file_path, 'rb') as img_file:
+                img_data = base64.b64encode(img_file.read()).decode('utf-8')
             img_format = 'jpeg' if file_name.lower().endswith(('.jpg', '.jpeg')) else 'png'
             img_src = f"data:image/{img_format};base64,{img_data}"
-            
-            return jsonify({
-                "success": True,
-                "file_name": file_name,
-                "thumbnail": img_src
-            })
+            thumbnail_base64_cache.put((file_name, version), img_src)
+
+        response = jsonify({
+            "success": True,
+            "file_name": file_name,
+            "thumbnail": img_src
+        })
+        if version is not None:
+            response.set_etag(version)
+        return set_cache_headers(response.make_conditional(request), version)
     
     except ValueError as e:
         logging.warning(f"{e}")
@@ -503,9 +1093,9 @@ def get_original_image(file_name):
         
         mime_type = 'image/jpeg' if file_name.lower().endswith(('.jpg', '.jpeg')) else 'image/png'
         
-        return send_file(str(file_path), mimetype=mime_type, 
-                        as_attachment=request.args.get('download', 'false').lower() == 'true',
-                        download_name=file_name if request.args.get('download', 'false').lower() == 'true' else None)
+        return send_versioned_file(file_path, mime_type,
+                                   as_attachment=request.args.get('download', 'false').lower() == 'true',
+                                   download_name=file_name if request.args.get('download', 'false').lower() == 'true' else None)
     
     except ValueError as e:
         logging.warning(f"{e}")
@@ -525,6 +1115,19 @@ def health_check():
     """健康检查端点"""
     return jsonify({"status": "ok"})
 
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """获取各内存缓存的条目数与命中、未命中次数"""
+    return jsonify({
+        "success": True,
+        "caches": {
+            "query": queryer_client.query_cache.stats(),
+            "result": queryer_client.result_cache.stats(),
+            "thumbnail_base64": thumbnail_base64_cache.stats(),
+            "thumbnail_version": thumbnail_version_cache.stats()
+        }
+    })
+
 @app.errorhandler(404)
 def not_found(error):
     """处理404错误"""
@@ -536,6 +1139,14 @@ def not_found(error):
     static_folder = app.static_folder or os.path.join(os.getcwd(), "static")
     return send_from_directory(static_folder, "index.html")
 
+@app.errorhandler(413)
+def request_entity_too_large(error):
+    """处理上传内容过大的错误"""
+    return jsonify({
+        "success": False,
+        "message": "上传的内容过大"
+    }), 413
+
 @app.errorhandler(500)
 def internal_server_error(error):
     """处理500错误"""
@@ -1,11 +1,34 @@
+import asyncio
+import io
 import logging
+import os
+import pathlib
+import sqlite3
+import struct
+import tempfile
+import time
 import unittest
 from typing import List
 
+import numpy as np
 import PIL.Image
-import torch
 
+import bulk_writer
+import db_init
 import embedder
+import indexer
+import utilities
+import vector_store
+from vector_store.pgvector_store import EXTENSION_VERSION_SQL
+
+
+def cuda_available() -> bool:
+    """torch 为可选依赖，未安装时视为没有CUDA"""
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
 
 
 class BaseEmbedTest(unittest.TestCase):
@@ -26,17 +49,25 @@ class BaseEmbedTest(unittest.TestCase):
         embeddings = self.image_embed(
             embed_client, image_path)
         self.assertIsNotNone(embeddings)
-        self.assertEqual(len(embeddings), 1024)
+        self.assertEqual(len(embeddings), embed_client.dimension)
+
+    def generic_test_embed_images(self, embed_client: embedder.embed):
+        image_paths = ["data/docs/1.jpg", "data/docs/1.jpg"]
+        embeddings = embed_client.embed_images(
+            [PIL.Image.open(image_path) for image_path in image_paths])
+        self.assertEqual(len(embeddings), len(image_paths))
+        for embedding in embeddings:
+            self.assertEqual(len(embedding), embed_client.dimension)
 
     def generic_test_embed_query(self, embed_client: embedder.embed):
         query = "A beautiful sunset over the mountains"
         embeddings = self.query_embed(embed_client, query)
         self.assertIsNotNone(embeddings)
-        self.assertEqual(len(embeddings), 1024)
+        self.assertEqual(len(embeddings), embed_client.dimension)
 
 
 class TestCohereEmbed(BaseEmbedTest):
-    embed_client: embedder.cohere_embed
+    embed_client: embedder.embed
 
     def setUp(self):
         logging.basicConfig(level=logging.INFO)
@@ -45,13 +76,23 @@ class TestCohereEmbed(BaseEmbedTest):
     def test_embed_image(self):
         self.generic_test_embed_image(self.embed_client)
 
+    def test_embed_images(self):
+        self.generic_test_embed_images(self.embed_client)
+
     def test_embed_query(self):
         self.generic_test_embed_query(self.embed_client)
 
+    def test_embed_queries_async(self):
+        queries = ["A beautiful sunset over the mountains", "A cat"]
+        embeddings = asyncio.run(self.embed_client.embed_queries_async(queries))
+        self.assertEqual(len(embeddings), len(queries))
+        for embedding in embeddings:
+            self.assertEqual(len(embedding), self.embed_client.dimension)
+
 
-@unittest.skipUnless(torch.cuda.is_available(), "CUDA is not available")
+@unittest.skipUnless(cuda_available(), "CUDA is not available")
 class TestCLIPEmbed(BaseEmbedTest):
-    embed_client: embedder.CLIP_embed
+    embed_client: embedder.embed
 
     def setUp(self):
         logging.basicConfig(level=logging.INFO)
@@ -60,9 +101,373 @@ class TestCLIPEmbed(BaseEmbedTest):
     def test_embed_image(self):
         self.generic_test_embed_image(self.embed_client)
 
+    def test_embed_images(self):
+        self.generic_test_embed_images(self.embed_client)
+
+    def test_embed_query(self):
+        self.generic_test_embed_query(self.embed_client)
+
+
+@unittest.skipUnless(os.getenv("CLIP_ONNX_PATH"), "CLIP_ONNX_PATH is not set")
+class TestONNXCLIPEmbed(BaseEmbedTest):
+    embed_client: embedder.embed
+
+    def setUp(self):
+        logging.basicConfig(level=logging.INFO)
+        self.embed_client = embedder.onnx_CLIP_embed(pathlib.Path(os.environ["CLIP_ONNX_PATH"]))
+
+    def test_embed_image(self):
+        self.generic_test_embed_image(self.embed_client)
+
+    def test_embed_images(self):
+        self.generic_test_embed_images(self.embed_client)
+
     def test_embed_query(self):
         self.generic_test_embed_query(self.embed_client)
 
+    def test_parity(self):
+        reference = embedder.CLIP_embed(model_name=self.embed_client.model_name, device="cpu")
+        images = [PIL.Image.open("data/docs/1.jpg")]
+        similarity = embedder.check_parity(self.embed_client, reference, images, ["A beautiful sunset over the mountains"])
+        self.assertGreaterEqual(similarity, 0.98)
+
+
+class TestCompressImage(unittest.TestCase):
+    def test_compress_image(self):
+        image = PIL.Image.open("data/docs/1.jpg")
+        for target_size in [32*1024, 256*1024]:
+            data = utilities.compress_image(image, target_size)
+            self.assertLessEqual(len(data), target_size)
+
+    def test_encode_variant(self):
+        image = PIL.Image.new("RGBA", (800, 600), (255, 0, 0, 128))
+        resized = utilities.resize_to_width(image, 256)
+        self.assertEqual(resized.size, (256, 192))
+        self.assertIs(utilities.resize_to_width(resized, 512), resized)
+        with PIL.Image.open(io.BytesIO(utilities.encode_variant(resized, "WEBP"))) as variant:
+            self.assertEqual(variant.format, "WEBP")
+            self.assertEqual(variant.size, (256, 192))
+            self.assertEqual(variant.mode, "RGBA")
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction_and_stats(self):
+        cache = utilities.lru_cache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        # b 最久未使用，被淘汰
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 2, 'misses': 1})
+
+    def test_ttl(self):
+        cache = utilities.lru_cache(2, ttl=0.05)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats(), {'size': 0, 'hits': 1, 'misses': 1})
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    def test_get_many_above_variable_limit(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = embedder.embedding_cache(pathlib.Path(path) / "cache.sqlite")
+            # 键数超过当前SQLite单条语句的参数上限
+            limit = sqlite3.connect(":memory:").getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+            cache.put_many({f"key{i}": [float(i)] for i in (0, limit)})
+            cached = cache.get_many([f"key{i}" for i in range(limit + 1)])
+            self.assertEqual(cached, {"key0": [0.0], f"key{limit}": [float(limit)]})
+            cache.close()
+
+
+class TestBulkWriter(unittest.TestCase):
+    def test_encode_copy_binary(self):
+        data = bulk_writer.encode_copy_binary([
+            ("a.jpg", [1.0, -2.5, 0.5], 10, 20, "f" * 64),
+            ("b.jpg", [0.0, 0.0, 1.0], None, None, None),
+        ])
+        self.assertTrue(data.startswith(b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)))
+        self.assertTrue(data.endswith(struct.pack("!h", -1)))
+        offset = 19
+        self.assertEqual(struct.unpack_from("!h", data, offset), (5,))
+        offset += 2
+        self.assertEqual(struct.unpack_from("!i5s", data, offset), (5, b"a.jpg"))
+        offset += 9
+        # pgvector的二进制表示：维度与保留字段各占2字节，之后为大端float4
+        self.assertEqual(struct.unpack_from("!ihh", data, offset), (4 + 3 * 4, 3, 0))
+        offset += 8
+        self.assertEqual(struct.unpack_from("!3f", data, offset), (1.0, -2.5, 0.5))
+        offset += 12
+        self.assertEqual(struct.unpack_from("!iqiq", data, offset), (8, 10, 8, 20))
+        offset += 24
+        self.assertEqual(struct.unpack_from("!i64s", data, offset), (64, b"f" * 64))
+        offset += 68
+        # 第二行的空值编码为长度-1
+        offset += 2 + 9 + 8 + 12
+        self.assertEqual(struct.unpack_from("!iii", data, offset), (-1, -1, -1))
+        self.assertEqual(offset + 12 + 2, len(data))
+
+    def test_row_by_row_fallback(self):
+        class stub_cursor:
+            def __init__(self, conn):
+                self.conn = conn
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                return False
+
+            def execute(self, sql, params=None):
+                if params is not None and params[0] == "bad.jpg":
+                    raise ValueError("bad row")
+                if params is not None:
+                    self.conn.inserted.append(params[0])
+
+            def copy_expert(self, sql, file):
+                raise ValueError("copy failed")
+
+        class stub_connection:
+            def __init__(self):
+                self.inserted: List[str] = []
+                self.commits = 0
+                self.rollbacks = 0
+
+            def cursor(self):
+                return stub_cursor(self)
+
+            def commit(self):
+                self.commits += 1
+
+            def rollback(self):
+                self.rollbacks += 1
+
+        conn = stub_connection()
+        rows = [(name, [0.0, 1.0], 1, 1, None) for name in ("a.jpg", "bad.jpg", "c.jpg")]
+        failures = bulk_writer.bulk_writer(conn).write(rows)  # type: ignore[arg-type]
+        self.assertEqual(failures, {"bad.jpg": "bad row"})
+        self.assertEqual(conn.inserted, ["a.jpg", "c.jpg"])
+        # 批量写入失败回滚一次，坏行回滚一次，其余每行提交一次
+        self.assertEqual((conn.commits, conn.rollbacks), (2, 2))
+
+
+class TestIndexImages(unittest.TestCase):
+    class color_embed:
+        """以图片的平均颜色作为向量的嵌入客户端，记录被嵌入的图片数"""
+        model_name = "color"
+        dimension = 3
+
+        def __init__(self):
+            self.embedded = 0
+
+        def model_id(self) -> str:
+            return "color"
+
+        def embedding_id(self) -> str:
+            return "color"
+
+        def embed_images(self, images: List[PIL.Image.Image]) -> List[List[float]]:
+            self.embedded += len(images)
+            return [list(np.asarray(image.convert("RGB"), dtype=np.float32).mean(axis=(0, 1)) + 1) for image in images]
+
+        def embed_image(self, image: PIL.Image.Image) -> List[float]:
+            return self.embed_images([image])[0]
+
+    def test_skip_rename_reuse(self):
+        with tempfile.TemporaryDirectory() as path:
+            docs_path = pathlib.Path(path) / "docs"
+            docs_path.mkdir()
+            for i, color in enumerate([(255, 0, 0), (0, 255, 0), (0, 0, 255)]):
+                PIL.Image.new("RGB", (8, 8), color).save(docs_path / f"{i}.png")
+            embed_client = self.color_embed()
+            store = vector_store.numpy_store(pathlib.Path(path) / "vectors", dim=3)
+            indexer_client = indexer.indexer(embed_client, store=store, thumbnail_formats=())  # type: ignore[arg-type]
+
+            result = indexer_client.index_images(docs_path)
+            self.assertEqual((result['newly_indexed'], result['failed_index']), (3, 0))
+
+            # 未变化与仅修改时间变化的文件不再嵌入
+            os.utime(docs_path / "0.png", ns=(0, 0))
+            result = indexer_client.index_images(docs_path)
+            self.assertEqual((result['newly_indexed'], result['reused'], embed_client.embedded), (0, 0, 3))
+            self.assertEqual(store.fingerprints()["0.png"][1], 0)
+
+            # 重命名的文件复用已有向量，旧记录被删除
+            (docs_path / "1.png").rename(docs_path / "renamed.png")
+            result = indexer_client.index_images(docs_path)
+            self.assertEqual((result['newly_indexed'], result['reused'], result['deleted']), (0, 1, 1))
+            self.assertEqual(embed_client.embedded, 3)
+            self.assertEqual(set(store.fingerprints()), {"0.png", "2.png", "renamed.png"})
+
+            # 扫描到但无法读取状态的文件被跳过，不算作失败
+            (docs_path / "gone.png").symlink_to(docs_path / "missing.png")
+            result = indexer_client.index_images(docs_path)
+            self.assertEqual((result['newly_indexed'], result['failed_index']), (0, 0))
+            self.assertNotIn("gone.png", store.fingerprints())
+
+
+class TestNumpyStore(unittest.TestCase):
+    def test_search_and_persist(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.random((20, 1024), dtype=np.float32)
+        with tempfile.TemporaryDirectory() as path:
+            store = vector_store.numpy_store(pathlib.Path(path))
+            store.write([(f"{i}.jpg", vector, 1, 1, f"{i:064x}") for i, vector in enumerate(vectors)])
+            store.delete(["0.jpg"])
+            store.finish_load()
+
+            results = store.search(vectors[1], max_dist=2, k=5)
+            self.assertEqual(results[0][0], "1.jpg")
+            self.assertAlmostEqual(results[0][1], 1.0, places=5)
+            self.assertEqual(store.search(vectors[1], max_dist=2, k=2, page=1), results[2:4])
+            self.assertEqual(store.search_many([vectors[1]], max_dist=2, k=5), [results])
+            self.assertNotIn("0.jpg", [name for name, _ in store.search(vectors[0], max_dist=2)])
+
+            reloaded = vector_store.numpy_store(pathlib.Path(path))
+            self.assertEqual(reloaded.fingerprints(), store.fingerprints())
+            self.assertEqual(reloaded.search(vectors[1], max_dist=2, k=5), results)
+            batches = list(reloaded.iter_search(vectors[1], max_dist=2, k=5, batch_size=2))
+            self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+            self.assertEqual([row for batch in batches for row in batch], results)
+
+            async_store = vector_store.as_async(reloaded)
+            self.assertEqual(asyncio.run(async_store.search(vectors[1], max_dist=2, k=5)), results)
+            self.assertEqual(asyncio.run(async_store.search_many([vectors[1]], max_dist=2, k=5)), [results])
+
+
+class TestPgvectorStoreSQL(unittest.TestCase):
+    """检查各存储方式生成的查询语句，不需要数据库"""
+
+    def sql(self, storage: str) -> dict:
+        store = vector_store.pgvector_store(storage=storage, table="embeddings_test", dimension=16, rerank_factor=4)
+        statements = {"full": store.search_sql(paged=False, exclude=False), "paged": store.search_sql(paged=True, exclude=True),
+                      "many": store.search_many_sql()}
+        return {name: " ".join(sql.split()) for name, sql in statements.items()}
+
+    def test_vector(self):
+        sql = self.sql("vector")
+        self.assertIn("embedding <=> %(vector)s::vector(16) AS distance FROM embeddings_test", sql["full"])
+        self.assertNotIn("WHERE file_name", sql["full"])
+        self.assertIn("FROM embeddings_test WHERE file_name <> %(exclude)s ORDER BY embedding <=> %(vector)s::vector(16) "
+                      "LIMIT %(k)s OFFSET %(offset)s", sql["paged"])
+        self.assertIn("FROM unnest(%(vectors)s::vector[]) WITH ORDINALITY AS q(vec, ord)", sql["many"])
+        self.assertIn("ORDER BY embedding <=> q.vec::vector(16) LIMIT %(k)s OFFSET 0", sql["many"])
+        for statement in sql.values():
+            self.assertNotIn("binary_quantize", statement)
+
+    def test_halfvec(self):
+        sql = self.sql("halfvec")
+        self.assertIn("embedding <=> %(vector)s::halfvec(16) AS distance", sql["full"])
+        self.assertIn("ORDER BY embedding <=> %(vector)s::halfvec(16) LIMIT %(k)s OFFSET %(offset)s", sql["paged"])
+        # 查询参数以 vector[] 传入，逐个转换为 halfvec 后与列比较
+        self.assertIn("unnest(%(vectors)s::vector[])", sql["many"])
+        self.assertIn("ORDER BY embedding <=> q.vec::halfvec(16) LIMIT %(k)s OFFSET 0", sql["many"])
+        for statement in sql.values():
+            self.assertNotIn("::vector(16)", statement)
+            self.assertNotIn("binary_quantize", statement)
+
+    def test_binary(self):
+        sql = self.sql("binary")
+        # 不分页时全表扫描，直接按单精度向量计算距离
+        self.assertNotIn("binary_quantize", sql["full"])
+        self.assertIn("embedding <=> %(vector)s::vector(16) AS distance FROM embeddings_test", sql["full"])
+        # 分页时先按汉明距离取出 rerank_factor 倍的候选，再按余弦距离排序
+        self.assertIn("SELECT file_name, embedding FROM embeddings_test WHERE file_name <> %(exclude)s "
+                      "ORDER BY binary_quantize(embedding)::bit(16) <~> binary_quantize(%(vector)s::vector(16)) "
+                      "LIMIT (%(k)s + %(offset)s) * 4 ) AS quantized ORDER BY distance LIMIT %(k)s OFFSET %(offset)s",
+                      sql["paged"])
+        self.assertIn("ORDER BY binary_quantize(embedding)::bit(16) <~> binary_quantize(q.vec::vector(16)) "
+                      "LIMIT (%(k)s + 0) * 4 ) AS quantized ORDER BY distance LIMIT %(k)s OFFSET 0", sql["many"])
+        self.assertIn("WHERE candidates.distance < %(max_dist)s ORDER BY q.ord, candidates.distance", sql["many"])
+
+    def test_search_settings(self):
+        vector_settings = vector_store.pgvector_store(storage="vector").search_settings(100, 200, None, False)
+        binary_settings = vector_store.pgvector_store(storage="binary").search_settings(100, 200, None, False)
+        self.assertEqual(vector_settings, [("SELECT set_config('hnsw.ef_search', %s, true)", ("300",))])
+        self.assertEqual(binary_settings, [("SELECT set_config('hnsw.ef_search', %s, true)", ("1000",))])
+        self.assertEqual(vector_store.pgvector_store(storage="binary").search_settings(5, 0, None, True),
+                         [("SET LOCAL hnsw.iterative_scan = strict_order", ())])
+
+
+class TestPgvectorStore(unittest.TestCase):
+    """需要可用的PostgreSQL数据库，halfvec 与 binary 需要 pgvector 0.7.0 及以上版本"""
+    dimension = 16
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            db_init.initialize_database()
+            with db_init.connection() as conn, conn.cursor() as cur:
+                cur.execute(EXTENSION_VERSION_SQL)
+                version = cur.fetchone()[0]
+                conn.commit()
+        except Exception as e:
+            raise unittest.SkipTest(f"Database unavailable: {e}")
+        cls.supports_halfvec = tuple(int(part) for part in version.split('.')[:2]) >= (0, 7)
+
+    def setUp(self):
+        self.models: List[str] = []
+        rng = np.random.default_rng(0)
+        self.vectors = rng.standard_normal((20, self.dimension)).astype(np.float32)
+
+    def tearDown(self):
+        with db_init.connection() as conn, conn.cursor() as cur:
+            for model in self.models:
+                cur.execute("SELECT table_name FROM embedding_models WHERE model = %s", (model,))
+                for (table,) in cur.fetchall():
+                    cur.execute(f"DROP TABLE IF EXISTS {table}")
+                cur.execute("DELETE FROM embedding_models WHERE model = %s", (model,))
+            conn.commit()
+
+    def create_store(self, model: str, storage: str) -> vector_store.pgvector_store:
+        self.models.append(model)
+        return vector_store.pgvector_store.for_model(model, self.dimension, storage, bulk_load_threshold=1)
+
+    def load(self, store: vector_store.pgvector_store) -> None:
+        store.begin_load(len(self.vectors))
+        store.write([(f"{i}.jpg", vector, 1, 1, f"{i:064x}") for i, vector in enumerate(self.vectors)])
+        store.finish_load()
+
+    def check_search(self, store: vector_store.pgvector_store) -> None:
+        results = store.search(self.vectors[1], max_dist=2, k=5)
+        self.assertEqual(results[0][0], "1.jpg")
+        self.assertAlmostEqual(results[0][1], 1.0, places=2)
+        self.assertEqual(len(results), 5)
+
+    def check_storage(self, storage: str) -> None:
+        if storage != "vector" and not self.supports_halfvec:
+            self.skipTest(f"{storage} storage requires pgvector 0.7.0")
+        store = self.create_store(f"test-storage-{storage}", storage)
+        self.load(store)
+        self.check_search(store)
+
+    def test_vector(self):
+        self.check_storage("vector")
+
+    def test_halfvec(self):
+        self.check_storage("halfvec")
+
+    def test_binary(self):
+        self.check_storage("binary")
+
+    def test_convert_storage(self):
+        if not self.supports_halfvec:
+            self.skipTest("halfvec storage requires pgvector 0.7.0")
+        store = self.create_store("test-storage-convert", "vector")
+        self.load(store)
+        # 存储方式变化时不立即转换，转换前仍按原类型查询
+        store = vector_store.pgvector_store.for_model("test-storage-convert", self.dimension, "halfvec")
+        self.assertEqual((store.storage, store.pending_storage), ("vector", "halfvec"))
+        self.check_search(store)
+        store.begin_load(0)
+        store.finish_load()
+        self.assertEqual((store.storage, store.pending_storage), ("halfvec", None))
+        self.assertEqual(db_init.get_column_storage(store.table), "halfvec")
+        self.check_search(store)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,14 +1,41 @@
 import PIL.Image
 import io
 import base64
+import hashlib
 import logging
+import pathlib
+import threading
+import time
+import collections
+from typing import Any, Dict, Hashable
 
-def compress_image(image:PIL.Image.Image, target_size) -> None:
+# 各格式编码后每像素字节数的初始估计值，用于直接推算目标尺寸
+INITIAL_BYTES_PER_PIXEL = {"JPEG": 0.3, "PNG": 2.0}
+# JPEG编码质量的初始值与下限
+JPEG_QUALITY = 85
+JPEG_MIN_QUALITY = 60
+
+def _encode_image(image:PIL.Image.Image, fmt:str, quality:int) -> bytes:
+    with io.BytesIO() as buf:
+        if fmt == "JPEG":
+            if image.mode not in ("RGB", "L", "CMYK"):
+                image = image.convert("RGB")
+            image.save(buf, format=fmt, quality=quality)
+        else:
+            image.save(buf, format=fmt, compress_level=6)
+        return buf.getvalue()
+
+def compress_image(image:PIL.Image.Image, target_size, max_attempts:int=3) -> bytes:
     '''
-    压缩图像至指定大小
+    将图像编码为不超过指定大小的JPEG或PNG数据。
+    先根据每像素字节数的估计值推算目标尺寸，再根据实际编码大小修正，最多尝试 max_attempts 次。
+    每次尝试都从原图一次缩放得到，JPEG在超出大小时还会同时降低编码质量
 
-    :param image: 待压缩的图像。该图像将被原地压缩
-    :param target_size: 目标大小，单位为字节
+    :param image: 待压缩的图像，不会被修改
+    :param target_size: 编码后的目标大小，单位为字节
+    :param max_attempts: 根据编码大小修正尺寸的最大次数
+
+    :return: 编码后的图像数据，格式与原图相同
 
     :raises ValueError: 如果图像格式不受支持或无法识别
     '''
@@ -17,26 +44,100 @@ def compress_image(image:PIL.Image.Image, target_size) -> None:
         raise ValueError("Image format not recognized")
     if fmt not in ["JPEG", "PNG"]:
         raise ValueError(f"Unsupported image format: {fmt}")
-    
+
+    w, h = image.size
+    scale = min(1.0, (target_size / (w * h * INITIAL_BYTES_PER_PIXEL[fmt])) ** 0.5)
+    quality = JPEG_QUALITY
+    best: bytes | None = None
+    attempt = 0
     while True:
-        w,h = image.size
-        img_size = len(image.tobytes())
-        scale = target_size / img_size
-        if scale > 0.9:
-            scale = 0.9
-        if scale < 0.5:
-            scale = 0.5
-        image.thumbnail((w*scale, h*scale))
-        img_size = len(image.tobytes())
-        if img_size <= target_size:
-            break
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        resized = image if size == image.size else image.resize(size, PIL.Image.Resampling.BILINEAR, reducing_gap=2.0)
+        data = _encode_image(resized, fmt, quality)
+        attempt += 1
+
+        if len(data) <= target_size:
+            best = data
+            # 已是原图尺寸，或已接近目标大小，无需继续放大
+            if scale >= 1.0 or len(data) >= target_size * 0.75 or attempt >= max_attempts:
+                return best
+        elif best is not None and attempt >= max_attempts:
+            return best
+        elif attempt >= max_attempts:
+            # 超出尝试次数仍未达到目标大小，则每次减半直到满足要求
+            scale /= 2
+            if size == (1, 1):
+                return data
+            continue
+        elif fmt == "JPEG" and best is None:
+            quality = max(JPEG_MIN_QUALITY, quality - 10)
+
+        # 编码大小与像素数近似成正比，按比例修正缩放系数，并留出少量余量
+        scale = min(1.0, scale * (target_size / len(data)) ** 0.5 * 0.95)
+
+# 缩略图变体支持的格式及其编码参数
+VARIANT_ENCODE_OPTIONS = {
+    "AVIF": {"quality": 55, "speed": 6},
+    "WEBP": {"quality": 80, "method": 4},
+}
+
+def resize_to_width(image:PIL.Image.Image, width:int) -> PIL.Image.Image:
+    '''
+    按比例将图像缩小到指定宽度，不会放大
+
+    :param image: 待缩放的图像，不会被修改
+    :param width: 目标宽度，单位为像素
+
+    :return: 缩放后的图像，宽度不超过目标宽度时返回原图像
+    '''
+    w, h = image.size
+    if w <= width:
+        return image
+    return image.resize((width, max(1, round(h * width / w))), PIL.Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+def encode_variant(image:PIL.Image.Image, fmt:str) -> bytes:
+    '''
+    将图像编码为缩略图变体使用的WebP或AVIF数据，保留透明通道
+
+    :param image: 待编码的图像，不会被修改
+    :param fmt: 格式，为 VARIANT_ENCODE_OPTIONS 中的键
+
+    :return: 编码后的图像数据
+
+    :raises ValueError: 如果格式不受支持
+    '''
+    if fmt not in VARIANT_ENCODE_OPTIONS:
+        raise ValueError(f"Unsupported variant format: {fmt}")
+    if image.mode not in ("RGB", "RGBA"):
+        has_alpha = image.mode in ("LA", "PA", "RGBa") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+    with io.BytesIO() as buf:
+        image.save(buf, format=fmt, **VARIANT_ENCODE_OPTIONS[fmt])
+        return buf.getvalue()
+
+def draft_image(image:PIL.Image.Image, target_size) -> None:
+    '''
+    对JPEG图像启用缩小解码，使其直接以接近目标大小的分辨率解码，而不是先完整解码再缩小。
+    其他格式的图像保持不变。必须在图像数据被加载之前调用
+
+    :param image: 待处理的图像。该图像将被原地修改
+    :param target_size: 编码后的目标大小，单位为字节
+    '''
+    if image.format != "JPEG":
+        return
+    w, h = image.size
+    scale = (target_size / (w * h * INITIAL_BYTES_PER_PIXEL["JPEG"])) ** 0.5
+    if scale >= 1:
+        return
+    # draft 选择不小于请求尺寸的最大缩小比例，因此解码结果不会低于请求尺寸
+    image.draft(image.mode, (max(1, int(w * scale)), max(1, int(h * scale))))
 
 def thumbnail_url(image: PIL.Image.Image, target_size) -> str:
     '''
     压缩图像并生成base64编码的URL
 
-    :param image: 待处理的图片。该图像将被原地压缩
-    :param target_size: 目标大小，单位为字节
+    :param image: 待处理的图片，不会被修改
+    :param target_size: 编码后的目标大小，单位为字节
 
     :return: 图片URL
     
@@ -48,9 +149,97 @@ def thumbnail_url(image: PIL.Image.Image, target_size) -> str:
     if fmt not in ["JPEG", "PNG"]:
         raise ValueError(f"Unsupported image format: {fmt}")
 
-    compress_image(image, target_size)
-
-    with io.BytesIO() as buf:
-        image.save(buf, format=fmt)
-        data = base64.b64encode(buf.getvalue()).decode()
+    data = base64.b64encode(compress_image(image, target_size)).decode()
     return f"data:image/{fmt.lower()};base64,{data}"
+
+def file_hash(path:pathlib.Path) -> str:
+    '''
+    计算文件内容的SHA-256哈希
+
+    :param path: 文件路径
+
+    :return: 十六进制表示的哈希值
+    '''
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+def image_hash(image:PIL.Image.Image) -> str:
+    '''
+    计算图片内容的SHA-256哈希。从文件打开的图片使用文件内容计算，否则使用像素数据计算
+
+    :param image: 图片对象
+
+    :return: 十六进制表示的哈希值
+    '''
+    filename = getattr(image, 'filename', None)
+    if filename:
+        return file_hash(pathlib.Path(filename))
+    digest = hashlib.sha256(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+class lru_cache:
+    '''
+    线程安全的有界LRU缓存，条目超过 ttl 秒后失效，并统计命中与未命中次数
+    '''
+    max_size: int
+    ttl: float | None
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self, max_size:int, ttl:float|None=None):
+        '''
+        :param max_size: 最多缓存的条目数
+        :param ttl: 条目的有效期，单位为秒，为None时永不过期
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__items: collections.OrderedDict[Hashable, tuple[float, Any]] = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key:Hashable) -> Any | None:
+        '''
+        读取缓存
+
+        :param key: 缓存键
+
+        :return: 缓存的值，未命中或已过期时返回None
+        '''
+        with self.__lock:
+            item = self.__items.get(key)
+            if item is not None and (self.ttl is None or time.monotonic() - item[0] < self.ttl):
+                self.__items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self.__items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key:Hashable, value:Any) -> None:
+        '''
+        写入缓存，超出容量时淘汰最久未使用的条目
+
+        :param key: 缓存键
+        :param value: 缓存的值
+        '''
+        if self.max_size <= 0:
+            return
+        with self.__lock:
+            self.__items[key] = (time.monotonic(), value)
+            self.__items.move_to_end(key)
+            while len(self.__items) > self.max_size:
+                self.__items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__items.clear()
+
+    def stats(self) -> Dict[str, int]:
+        '''
+        :return: 缓存统计，格式为 {'size': int, 'hits': int, 'misses': int}
+        '''
+        with self.__lock:
+            return {'size': len(self.__items), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,5 @@
+from vector_store.store_protocol import store, async_store, Row, Fingerprint
+from vector_store.pgvector_store import pgvector_store
+from vector_store.numpy_store import numpy_store
+from vector_store.async_pgvector_store import async_pgvector_store
+from vector_store.threaded_store import threaded_store, as_async
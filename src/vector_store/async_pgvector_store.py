@@ -0,0 +1,91 @@
+from typing import AsyncIterator, List, Tuple
+
+import numpy as np
+
+import db_init
+from vector_store.pgvector_store import pgvector_store, EXTENSION_VERSION_SQL
+
+
+class async_pgvector_store:
+    '''
+    pgvector_store 的异步查询接口，使用 db_init.get_async_pool 中的连接，
+    等待数据库期间不占用线程。SQL语句与搜索参数由被包装的 pgvector_store 生成，与同步查询一致
+    '''
+    store: pgvector_store
+
+    def __init__(self, store: pgvector_store):
+        '''
+        :param store: 被包装的同步存储，决定向量表、存储方式与搜索参数
+        '''
+        self.store = store
+        self.__iterative_scan: bool | None = None
+
+    async def __configure_search(self, cur, k: int, offset: int, ef_search: int | None) -> None:
+        if self.__iterative_scan is None:
+            await cur.execute(EXTENSION_VERSION_SQL)
+            row = await cur.fetchone()
+            self.__iterative_scan = self.store.supports_iterative_scan(row[0] if row else None)
+        for statement, params in self.store.search_settings(k, offset, ef_search, self.__iterative_scan):
+            await cur.execute(statement, params)
+
+    async def generation(self) -> int:
+        pool = await db_init.get_async_pool()
+        async with pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(db_init.INDEX_GENERATION_SQL)
+            row = await cur.fetchone()
+        return int(row[0]) if row else 0
+
+    async def get_vector(self, file_name: str) -> List[float] | None:
+        pool = await db_init.get_async_pool()
+        async with pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(f"SELECT embedding FROM {self.store.table} WHERE file_name = %s", (file_name,))
+            row = await cur.fetchone()
+        if row is None:
+            return None
+        vector = row[0].to_numpy() if hasattr(row[0], "to_numpy") else row[0]
+        return np.asarray(vector).tolist()
+
+    async def search(self, query_vector, max_dist: float, k: int | None = None, page: int = 0, ef_search: int | None = None,
+                     exclude: str | None = None) -> List[Tuple[str, float]]:
+        params = {"vector": np.asarray(query_vector, dtype=np.float32), "max_dist": max_dist, "exclude": exclude}
+        pool = await db_init.get_async_pool()
+        async with pool.connection() as conn, conn.cursor() as cur:
+            if k is not None:
+                offset = page * k
+                # 被排除的文件可能占用一个候选位置
+                await self.__configure_search(cur, k + (exclude is not None), offset, ef_search)
+                params.update(k=k, offset=offset)
+            await cur.execute(self.store.search_sql(k is not None, exclude is not None), params)
+            return [(row[0], row[1]) for row in await cur.fetchall()]
+
+    async def iter_search(self, query_vector, max_dist: float, k: int | None = None, page: int = 0,
+                          ef_search: int | None = None, exclude: str | None = None,
+                          batch_size: int = 100) -> AsyncIterator[List[Tuple[str, float]]]:
+        params = {"vector": np.asarray(query_vector, dtype=np.float32), "max_dist": max_dist, "exclude": exclude}
+        pool = await db_init.get_async_pool()
+        async with pool.connection() as conn:
+            if k is not None:
+                offset = page * k
+                async with conn.cursor() as cur:
+                    await self.__configure_search(cur, k + (exclude is not None), offset, ef_search)
+                params.update(k=k, offset=offset)
+            # 服务端游标，与搜索参数处于同一事务
+            async with conn.cursor(name="search_stream") as cur:
+                cur.itersize = batch_size
+                await cur.execute(self.store.search_sql(k is not None, exclude is not None), params)
+                while rows := await cur.fetchmany(batch_size):
+                    yield [(row[0], row[1]) for row in rows]
+
+    async def search_many(self, query_vectors: list, max_dist: float, k: int,
+                          ef_search: int | None = None) -> List[List[Tuple[str, float]]]:
+        results: List[List[Tuple[str, float]]] = [[] for _ in query_vectors]
+        if not query_vectors:
+            return results
+        vectors = [np.asarray(vector, dtype=np.float32) for vector in query_vectors]
+        pool = await db_init.get_async_pool()
+        async with pool.connection() as conn, conn.cursor() as cur:
+            await self.__configure_search(cur, k, 0, ef_search)
+            await cur.execute(self.store.search_many_sql(), {"vectors": vectors, "k": k, "max_dist": max_dist})
+            for ord, file_name, similarity in await cur.fetchall():
+                results[ord - 1].append((file_name, similarity))
+        return results
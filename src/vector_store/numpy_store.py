@@ -0,0 +1,256 @@
+import json
+import logging
+import os
+import pathlib
+import threading
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from vector_store.store_protocol import Row, Fingerprint
+
+
+class numpy_store:
+    '''
+    基于NumPy的嵌入式向量存储，不依赖数据库，适用于边缘部署与测试。
+    向量归一化后保存在内存映射的float32矩阵 embeddings.npy 中，文件名与指纹保存在 meta.json 中。
+    查询为精确搜索：矩阵与查询向量相乘得到余弦相似度，再用 argpartition 选出top-k。
+
+    写入与删除直接修改内存映射矩阵，元数据在 finish_load 或 flush 时写入磁盘。
+    修改开始时会创建 dirty 标记文件，若进程在持久化之前退出，下次加载时数据会被丢弃并需要重新索引
+    '''
+    path: pathlib.Path
+    # 向量维度
+    dim: int
+    # 批量查询时相似度矩阵的元素数上限，用于限制内存占用
+    search_block_size: int = 1 << 24
+
+    def __init__(self, path: pathlib.Path, dim: int = 1024):
+        '''
+        :param path: 存储文件夹路径
+        :param dim: 向量维度
+        '''
+        self.path = path
+        self.dim = dim
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.__lock = threading.RLock()
+        self.__matrix_path = self.path / "embeddings.npy"
+        self.__meta_path = self.path / "meta.json"
+        self.__dirty_path = self.path / "dirty"
+        self.__load()
+
+    def __load(self) -> None:
+        self.__generation = 0
+        meta = None
+        if self.__meta_path.exists():
+            with open(self.__meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            self.__generation = meta["generation"]
+        if meta is not None and (self.__dirty_path.exists() or meta["dim"] != self.dim or not self.__matrix_path.exists()):
+            logging.warning(f"Vector store at {self.path} is incomplete or incompatible, discarding it.")
+            meta = None
+
+        if meta is None:
+            self.__names: List[str] = []
+            self.__fingerprints: List[Fingerprint] = []
+            self.__matrix = np.lib.format.open_memmap(self.__matrix_path, mode="w+", dtype=np.float32, shape=(1024, self.dim))
+            self.__generation += 1
+            self.__save_meta()
+        else:
+            self.__names = [file[0] for file in meta["files"]]
+            self.__fingerprints = [tuple(file[1:]) for file in meta["files"]]
+            self.__matrix = np.lib.format.open_memmap(self.__matrix_path, mode="r+")
+        self.__rows: Dict[str, int] = {name: row for row, name in enumerate(self.__names)}
+
+    def __save_meta(self) -> None:
+        meta = {
+            "dim": self.dim,
+            "generation": self.__generation,
+            "files": [[name, *fingerprint] for name, fingerprint in zip(self.__names, self.__fingerprints)]
+        }
+        tmp_path = self.__meta_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, self.__meta_path)
+        self.__dirty_path.unlink(missing_ok=True)
+
+    def __begin_change(self) -> None:
+        '''
+        在修改数据之前调用，标记存储尚未持久化，并使索引代数加一
+        '''
+        if not self.__dirty_path.exists():
+            self.__dirty_path.touch()
+        self.__generation += 1
+
+    def __reserve(self, count: int) -> None:
+        '''
+        确保矩阵至少能容纳 count 行，容量不足时按倍数扩容
+        '''
+        capacity = self.__matrix.shape[0]
+        if count <= capacity:
+            return
+        while capacity < count:
+            capacity *= 2
+        tmp_path = self.path / "embeddings.tmp.npy"
+        matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(capacity, self.dim))
+        matrix[:len(self.__names)] = self.__matrix[:len(self.__names)]
+        matrix.flush()
+        os.replace(tmp_path, self.__matrix_path)
+        self.__matrix = matrix
+
+    def __normalize(self, vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        if vector.shape != (self.dim,):
+            raise ValueError(f"Expected a vector of dimension {self.dim}, got shape {vector.shape}.")
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def __put(self, file_name: str, vector: np.ndarray, fingerprint: Fingerprint) -> None:
+        row = self.__rows.get(file_name)
+        if row is None:
+            row = len(self.__names)
+            self.__reserve(row + 1)
+            self.__names.append(file_name)
+            self.__fingerprints.append(fingerprint)
+            self.__rows[file_name] = row
+        else:
+            self.__fingerprints[row] = fingerprint
+        self.__matrix[row] = vector
+
+    def generation(self) -> int:
+        with self.__lock:
+            return self.__generation
+
+    def fingerprints(self) -> Dict[str, Fingerprint]:
+        with self.__lock:
+            return dict(zip(self.__names, self.__fingerprints))
+
+    def update_fingerprints(self, rows: List[Tuple[str, int, int, str]]) -> None:
+        with self.__lock:
+            if not self.__dirty_path.exists():
+                self.__dirty_path.touch()
+            for file_name, file_size, file_mtime_ns, content_hash in rows:
+                row = self.__rows.get(file_name)
+                if row is not None:
+                    self.__fingerprints[row] = (file_size, file_mtime_ns, content_hash)
+
+    def write(self, rows: List[Row]) -> Dict[str, str]:
+        failures = {}
+        with self.__lock:
+            self.__begin_change()
+            for file_name, vector, file_size, file_mtime_ns, content_hash in rows:
+                try:
+                    self.__put(file_name, self.__normalize(vector), (file_size, file_mtime_ns, content_hash))
+                except Exception as e:
+                    failures[file_name] = str(e)
+        return failures
+
+    def copy(self, rows: List[Tuple[str, str, int, int, str]]) -> Dict[str, str]:
+        failures = {}
+        with self.__lock:
+            self.__begin_change()
+            for file_name, source_file_name, file_size, file_mtime_ns, content_hash in rows:
+                source_row = self.__rows.get(source_file_name)
+                if source_row is None:
+                    failures[file_name] = f"{source_file_name} is not indexed"
+                    continue
+                self.__put(file_name, np.array(self.__matrix[source_row]), (file_size, file_mtime_ns, content_hash))
+        return failures
+
+    def delete(self, file_names: List[str]) -> None:
+        '''
+        删除时将最后一行移动到被删除的位置，矩阵始终保持连续
+        '''
+        with self.__lock:
+            self.__begin_change()
+            for file_name in file_names:
+                row = self.__rows.pop(file_name, None)
+                if row is None:
+                    continue
+                last = len(self.__names) - 1
+                if row != last:
+                    self.__matrix[row] = self.__matrix[last]
+                    self.__names[row] = self.__names[last]
+                    self.__fingerprints[row] = self.__fingerprints[last]
+                    self.__rows[self.__names[row]] = row
+                self.__names.pop()
+                self.__fingerprints.pop()
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__begin_change()
+            self.__names = []
+            self.__fingerprints = []
+            self.__rows = {}
+            self.flush()
+
+    def begin_load(self, count: int) -> None:
+        with self.__lock:
+            self.__reserve(len(self.__names) + count)
+
+    def finish_load(self) -> None:
+        self.flush()
+
+    def flush(self) -> None:
+        '''
+        将矩阵与元数据写入磁盘
+        '''
+        with self.__lock:
+            self.__matrix.flush()
+            self.__save_meta()
+
+    def get_vector(self, file_name: str) -> List[float] | None:
+        with self.__lock:
+            row = self.__rows.get(file_name)
+            return self.__matrix[row].tolist() if row is not None else None
+
+    def __top_k(self, similarities: np.ndarray, max_dist: float, k: int | None, offset: int) -> List[Tuple[str, float]]:
+        '''
+        从一个查询的相似度中选出按相似度排序的第 offset 到 offset + k 个结果，并按距离阈值过滤
+        '''
+        if k is None:
+            candidates = np.flatnonzero(1 - similarities < max_dist)
+        else:
+            end = min(offset + k, len(similarities))
+            if offset >= end:
+                return []
+            # 只对前 end 个结果排序
+            candidates = np.argpartition(-similarities, end - 1)[:end] if end < len(similarities) else np.arange(end)
+        candidates = candidates[np.argsort(-similarities[candidates], kind="stable")]
+        if k is not None:
+            candidates = candidates[offset:]
+        return [(self.__names[row], float(similarities[row])) for row in candidates if 1 - similarities[row] < max_dist]
+
+    def search(self, query_vector, max_dist: float, k: int | None = None, page: int = 0, ef_search: int | None = None,
+               exclude: str | None = None) -> List[Tuple[str, float]]:
+        query_vector = self.__normalize(query_vector)
+        with self.__lock:
+            similarities = self.__matrix[:len(self.__names)] @ query_vector
+            if exclude is not None and exclude in self.__rows:
+                similarities[self.__rows[exclude]] = -np.inf
+            return self.__top_k(similarities, max_dist, k, page * k if k is not None else 0)
+
+    def iter_search(self, query_vector, max_dist: float, k: int | None = None, page: int = 0,
+                    ef_search: int | None = None, exclude: str | None = None,
+                    batch_size: int = 100) -> Iterator[List[Tuple[str, float]]]:
+        '''
+        结果在一次矩阵运算中得到，再按 batch_size 分批返回
+        '''
+        results = self.search(query_vector, max_dist, k=k, page=page, ef_search=ef_search, exclude=exclude)
+        for start in range(0, len(results), batch_size):
+            yield results[start:start + batch_size]
+
+    def search_many(self, query_vectors: list, max_dist: float, k: int,
+                    ef_search: int | None = None) -> List[List[Tuple[str, float]]]:
+        if not query_vectors:
+            return []
+        queries = np.stack([self.__normalize(vector) for vector in query_vectors])
+        results: List[List[Tuple[str, float]]] = []
+        with self.__lock:
+            matrix = self.__matrix[:len(self.__names)]
+            # 分块计算相似度矩阵，避免查询数与向量数都很大时占用过多内存
+            block = max(1, self.search_block_size // max(1, len(self.__names)))
+            for start in range(0, len(queries), block):
+                similarities = queries[start:start + block] @ matrix.T
+                results.extend(self.__top_k(row, max_dist, k, 0) for row in similarities)
+        return results
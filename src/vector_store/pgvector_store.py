@@ -0,0 +1,436 @@
+import logging
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+import psycopg2.extras
+
+import bulk_writer
+import db_init
+from vector_store.store_protocol import Row, Fingerprint
+
+# 查询vector扩展版本的SQL
+EXTENSION_VERSION_SQL = "SELECT extversion FROM pg_extension WHERE extname = 'vector'"
+# 各存储方式下HNSW索引使用的操作符类
+INDEX_OPCLASS = {"vector": "vector_cosine_ops", "halfvec": "halfvec_cosine_ops", "binary": "bit_hamming_ops"}
+
+
+class pgvector_store:
+    '''
+    基于PostgreSQL+pgvector的向量存储，使用HNSW索引进行近似查询。
+    每个模型的向量保存在各自的表中，表名由 db_init.register_model 给出。
+    向量的存储方式见 db_init.STORAGE_MODES，查询计划随存储方式变化
+    '''
+    # 向量表名与向量维度
+    table: str = "embeddings"
+    dimension: int = db_init.EMBEDDING_DIM
+    # 向量存储方式
+    storage: str = "vector"
+    # 已配置但尚未转换的存储方式，在下次写入前由 convert_storage 转换
+    pending_storage: str | None = None
+    # binary 存储方式下，按汉明距离取出 k 的多少倍作为候选，再按单精度向量的余弦距离重新排序
+    rerank_factor: int = 4
+    # HNSW索引参数
+    hnsw_m: int = 16
+    hnsw_ef_construction: int = 64
+    # 构建索引时使用的 maintenance_work_mem 与并行维护进程数，为空时使用数据库配置
+    maintenance_work_mem: str | None = None
+    max_parallel_maintenance_workers: int | None = None
+    # 待写入向量数达到该值时，先删除索引，写入完成后再重新构建
+    bulk_load_threshold: int = 10000
+
+    def __init__(self, hnsw_m: int = 16, hnsw_ef_construction: int = 64, maintenance_work_mem: str | None = None,
+                 max_parallel_maintenance_workers: int | None = None, bulk_load_threshold: int = 10000,
+                 storage: str = "vector", rerank_factor: int = 4, table: str = "embeddings",
+                 dimension: int = db_init.EMBEDDING_DIM):
+        '''
+        :param hnsw_m: HNSW索引每个节点的最大连接数
+        :param hnsw_ef_construction: 构建HNSW索引时的候选列表大小
+        :param maintenance_work_mem: 构建索引时使用的 maintenance_work_mem，例如 "2GB"
+        :param max_parallel_maintenance_workers: 构建索引时的并行维护进程数
+        :param bulk_load_threshold: 待写入向量数达到该值时，写入期间删除索引并在写入完成后重建
+        :param storage: 向量存储方式，需与 db_init.initialize_database 使用的一致
+        :param rerank_factor: binary 存储方式下候选结果数与 k 的倍数
+        :param table: 向量表名
+        :param dimension: 向量维度，需与向量表一致
+
+        :raises ValueError: 如果存储方式不受支持
+        '''
+        if storage not in db_init.STORAGE_MODES:
+            raise ValueError(f"Unsupported storage mode: {storage}")
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construction = hnsw_ef_construction
+        self.maintenance_work_mem = maintenance_work_mem
+        self.max_parallel_maintenance_workers = max_parallel_maintenance_workers
+        self.bulk_load_threshold = bulk_load_threshold
+        self.storage = storage
+        self.rerank_factor = max(1, rerank_factor)
+        self.table = table
+        self.dimension = dimension
+        self.__index_name = f"{table}_hnsw_idx"
+        self.__column_type = db_init.embedding_column_type(storage, dimension)
+        self.__iterative_scan: bool | None = None
+
+    @classmethod
+    def for_model(cls, model: str, dimension: int, storage: str = "vector", **kwargs) -> "pgvector_store":
+        '''
+        返回保存指定模型向量的存储，首次使用时登记模型并按其原生维度创建向量表
+
+        :param model: 模型标识，见 embedder.embed.model_id
+        :param dimension: 模型输出的向量维度
+        :param storage: 向量存储方式。已有表的向量列类型不一致时不在此处转换，
+                        存储沿用表的当前类型，转换在下次建立索引时由 begin_load 进行
+        :param kwargs: 其余参数见 __init__
+
+        :return: 向量存储
+        '''
+        table = db_init.register_model(model, dimension, storage, convert=False)
+        current = db_init.get_column_storage(table)
+        if db_init.embedding_column_type(current, dimension) == db_init.embedding_column_type(storage, dimension):
+            current = storage
+        store = cls(storage=current, table=table, dimension=dimension, **kwargs)
+        if current != storage:
+            logging.info(f"Vector storage of {table} will be converted from {current} to {storage} on the next indexing run.")
+            store.pending_storage = storage
+        return store
+
+    def convert_storage(self) -> None:
+        '''
+        将向量列转换为 pending_storage 对应的类型。转换期间表被锁定，HNSW索引被删除，由随后的 finish_load 重建
+        '''
+        storage = self.pending_storage
+        if storage is None:
+            return
+        db_init.ensure_embeddings_table(self.table, self.dimension, storage)
+        with db_init.connection() as conn, conn.cursor() as cur:
+            db_init.bump_index_generation(cur)
+            conn.commit()
+        self.storage = storage
+        self.__column_type = db_init.embedding_column_type(storage, self.dimension)
+        self.pending_storage = None
+
+    def generation(self) -> int:
+        with db_init.connection() as conn, conn.cursor() as cur:
+            generation = db_init.get_index_generation(cur)
+            conn.commit()
+        return generation
+
+    def fingerprints(self) -> Dict[str, Fingerprint]:
+        with db_init.connection() as conn, conn.cursor() as cur:
+            cur.execute(f"SELECT file_name, file_size, file_mtime_ns, content_hash FROM {self.table}")
+            rows = cur.fetchall()
+            conn.commit()
+        return {row[0]: (row[1], row[2], row[3]) for row in rows}
+
+    def update_fingerprints(self, rows: List[Tuple[str, int, int, str]]) -> None:
+        with db_init.connection() as conn, conn.cursor() as cur:
+            psycopg2.extras.execute_batch(
+                cur,
+                f"UPDATE {self.table} SET file_size = %s, file_mtime_ns = %s, content_hash = %s WHERE file_name = %s",
+                [(file_size, file_mtime_ns, content_hash, file_name) for file_name, file_size, file_mtime_ns, content_hash in rows]
+            )
+            conn.commit()
+
+    def write(self, rows: List[Row]) -> Dict[str, str]:
+        '''
+        通过 bulk_writer 批量写入并提交，随后单独提交索引代数的更新
+        '''
+        if not rows:
+            return {}
+        with db_init.connection() as conn:
+            failures = bulk_writer.bulk_writer(conn, table=self.table, embedding_type=self.__column_type).write(rows)
+            if len(failures) < len(rows):
+                try:
+                    with conn.cursor() as cur:
+                        db_init.bump_index_generation(cur)
+                    conn.commit()
+                except Exception as e:
+                    logging.warning(f"Failed to bump index generation: {e}")
+                    conn.rollback()
+        return failures
+
+    def copy(self, rows: List[Tuple[str, str, int, int, str]]) -> Dict[str, str]:
+        failures = {}
+        with db_init.connection() as conn, conn.cursor() as cur:
+            for file_name, source_file_name, file_size, file_mtime_ns, content_hash in rows:
+                try:
+                    cur.execute(
+                        f"""
+                        INSERT INTO {self.table} (file_name, embedding, file_size, file_mtime_ns, content_hash)
+                        SELECT %s, embedding, %s, %s, %s FROM {self.table} WHERE file_name = %s
+                        ON CONFLICT (file_name) DO UPDATE SET
+                            embedding = EXCLUDED.embedding,
+                            file_size = EXCLUDED.file_size,
+                            file_mtime_ns = EXCLUDED.file_mtime_ns,
+                            content_hash = EXCLUDED.content_hash,
+                            updated_at = CURRENT_TIMESTAMP
+                        """,
+                        (file_name, file_size, file_mtime_ns, content_hash, source_file_name)
+                    )
+                    db_init.bump_index_generation(cur)
+                    conn.commit()
+                except Exception as e:
+                    failures[file_name] = str(e)
+                    conn.rollback()
+        return failures
+
+    def delete(self, file_names: List[str]) -> None:
+        if not file_names:
+            return
+        with db_init.connection() as conn, conn.cursor() as cur:
+            cur.execute(f"DELETE FROM {self.table} WHERE file_name = ANY(%s)", (file_names,))
+            db_init.bump_index_generation(cur)
+            conn.commit()
+
+    def clear(self) -> None:
+        with db_init.connection() as conn, conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {self.table};")
+            db_init.bump_index_generation(cur)
+            conn.commit()
+        db_init.ensure_embeddings_table(self.table, self.dimension, self.storage)
+
+    def __index_state(self, cur) -> Tuple[bool, bool, Dict[str, str], str]:
+        '''
+        查询HNSW索引的状态
+
+        :return: (索引是否存在, 索引是否有效, 索引的存储参数, 索引定义)
+        '''
+        cur.execute(
+            """
+            SELECT i.indisvalid, c.reloptions, pg_get_indexdef(c.oid) FROM pg_class c
+            JOIN pg_index i ON i.indexrelid = c.oid
+            WHERE c.relname = %s
+            """,
+            (self.__index_name,)
+        )
+        row = cur.fetchone()
+        if row is None:
+            return False, False, {}, ""
+        options = dict(option.split('=', 1) for option in (row[1] or []))
+        return True, row[0], options, row[2]
+
+    def __index_target(self) -> str:
+        '''
+        :return: HNSW索引的索引列与操作符类。binary 存储方式下索引建立在二值量化后的向量上
+        '''
+        if self.storage == "binary":
+            return f"(binary_quantize(embedding)::bit({self.dimension})) bit_hamming_ops"
+        return f"embedding {INDEX_OPCLASS[self.storage]}"
+
+    def begin_load(self, count: int) -> None:
+        '''
+        大批量写入时先删除索引，避免逐行维护HNSW图，写入完成后再一次性构建。
+        存储方式有待转换时先进行转换
+        '''
+        self.convert_storage()
+        if count < self.bulk_load_threshold:
+            return
+        with db_init.connection() as conn, conn.cursor() as cur:
+            cur.execute(f"DROP INDEX IF EXISTS {self.__index_name}")
+            conn.commit()
+        logging.info(f"Bulk load of {count} files, index dropped until the load finishes.")
+
+    def finish_load(self) -> None:
+        '''
+        按配置的参数创建索引。索引已存在但参数与配置不一致时，使用 REINDEX CONCURRENTLY 重建，重建期间搜索不受影响
+        '''
+        with db_init.connection() as conn:
+            # CONCURRENTLY 不能在事务块中执行
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                if self.maintenance_work_mem:
+                    cur.execute("SET maintenance_work_mem = %s", (self.maintenance_work_mem,))
+                if self.max_parallel_maintenance_workers is not None:
+                    cur.execute("SET max_parallel_maintenance_workers = %s", (self.max_parallel_maintenance_workers,))
+
+                exists, valid, options, definition = self.__index_state(cur)
+                if exists and not valid:
+                    # 之前中断的并发构建会留下无效索引
+                    logging.warning("Dropping invalid index left by an interrupted build.")
+                    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {self.__index_name}")
+                    exists = False
+                elif exists and INDEX_OPCLASS[self.storage] not in definition:
+                    logging.info(f"Dropping HNSW index built for another storage mode: {definition}")
+                    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {self.__index_name}")
+                    exists = False
+
+                if not exists:
+                    logging.info(f"Building HNSW index for {self.storage} storage (m={self.hnsw_m}, ef_construction={self.hnsw_ef_construction})...")
+                    cur.execute(
+                        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {self.__index_name} ON {self.table} USING hnsw ({self.__index_target()}) WITH (m = %s, ef_construction = %s)",
+                        (self.hnsw_m, self.hnsw_ef_construction)
+                    )
+                elif options.get('m', '16') != str(self.hnsw_m) or options.get('ef_construction', '64') != str(self.hnsw_ef_construction):
+                    logging.info(f"Rebuilding HNSW index with m={self.hnsw_m}, ef_construction={self.hnsw_ef_construction}...")
+                    cur.execute(
+                        f"ALTER INDEX {self.__index_name} SET (m = %s, ef_construction = %s)",
+                        (self.hnsw_m, self.hnsw_ef_construction)
+                    )
+                    cur.execute(f"REINDEX INDEX CONCURRENTLY {self.__index_name}")
+                cur.execute("RESET maintenance_work_mem")
+                cur.execute("RESET max_parallel_maintenance_workers")
+
+    def get_vector(self, file_name: str) -> List[float] | None:
+        with db_init.connection() as conn, conn.cursor() as cur:
+            cur.execute(f"SELECT embedding FROM {self.table} WHERE file_name = %s", (file_name,))
+            row = cur.fetchone()
+            conn.commit()
+        if row is None:
+            return None
+        # 不同版本的pgvector返回numpy数组或 Vector 对象
+        vector = row[0].to_numpy() if hasattr(row[0], "to_numpy") else row[0]
+        return np.asarray(vector).tolist()
+
+    @staticmethod
+    def supports_iterative_scan(extension_version: str | None) -> bool:
+        '''
+        pgvector 0.8.0 起支持HNSW迭代扫描，结果数不再受 hnsw.ef_search 限制
+
+        :param extension_version: vector扩展的版本，由 EXTENSION_VERSION_SQL 查询，未安装时为None
+        '''
+        version = tuple(int(part) for part in extension_version.split('.')[:2]) if extension_version else (0, 0)
+        return version >= (0, 8)
+
+    def __iterative_scan_enabled(self, cur) -> bool:
+        if self.__iterative_scan is None:
+            cur.execute(EXTENSION_VERSION_SQL)
+            row = cur.fetchone()
+            self.__iterative_scan = self.supports_iterative_scan(row[0] if row else None)
+        return self.__iterative_scan
+
+    def search_settings(self, k: int, offset: int, ef_search: int | None, iterative_scan: bool) -> List[Tuple[str, tuple]]:
+        '''
+        返回为当前事务设置HNSW搜索参数的语句，使索引至少能返回 offset + k 个结果，binary 存储方式下为其 rerank_factor 倍
+
+        :param iterative_scan: 数据库是否支持迭代扫描，见 supports_iterative_scan
+
+        :return: 待依次执行的 (SQL语句, 参数) 列表
+        '''
+        statements: List[Tuple[str, tuple]] = []
+        if iterative_scan:
+            statements.append(("SET LOCAL hnsw.iterative_scan = strict_order", ()))
+        else:
+            # 没有迭代扫描时，HNSW索引最多返回 ef_search 个结果，需覆盖到当前页的末尾
+            candidates = (offset + k) * (self.rerank_factor if self.storage == "binary" else 1)
+            ef_search = max(ef_search or 40, min(candidates, 1000))
+        if ef_search is not None:
+            statements.append(("SELECT set_config('hnsw.ef_search', %s, true)", (str(ef_search),)))
+        return statements
+
+    def __configure_search(self, cur, k: int, offset: int, ef_search: int | None) -> None:
+        for statement, params in self.search_settings(k, offset, ef_search, self.__iterative_scan_enabled(cur)):
+            cur.execute(statement, params)
+
+    def __candidates_sql(self, query: str, where_sql: str, limit: str, offset: str) -> str:
+        '''
+        按余弦距离排序并分页的子查询，返回 file_name 与 distance，可以使用HNSW索引。
+        binary 存储方式下先按二值量化后的汉明距离取出 rerank_factor 倍的候选，再按单精度向量的余弦距离精确排序
+
+        :param query: 查询向量的SQL表达式，类型需与 embedding 列一致
+        :param where_sql: 过滤条件，可为空
+        :param limit: 每页结果数的SQL表达式
+        :param offset: 偏移量的SQL表达式
+        '''
+        if self.storage != "binary":
+            return f"""
+                SELECT file_name, embedding <=> {query} AS distance FROM {self.table} {where_sql}
+                ORDER BY embedding <=> {query}
+                LIMIT {limit} OFFSET {offset}
+            """
+        return f"""
+            SELECT file_name, embedding <=> {query} AS distance FROM (
+                SELECT file_name, embedding FROM {self.table} {where_sql}
+                ORDER BY binary_quantize(embedding)::bit({self.dimension}) <~> binary_quantize({query})
+                LIMIT ({limit} + {offset}) * {self.rerank_factor}
+            ) AS quantized
+            ORDER BY distance
+            LIMIT {limit} OFFSET {offset}
+        """
+
+    def search_sql(self, paged: bool, exclude: bool) -> str:
+        '''
+        返回 search 使用的SQL语句。不分页时全表扫描；否则内层查询按距离排序并分页以使用HNSW索引，距离阈值在外层过滤
+
+        :param paged: 是否分页
+        :param exclude: 是否排除一个文件
+
+        :return: SQL语句，命名参数为 vector、max_dist、exclude，分页时还有 k、offset。结果列为 (file_name, similarity)
+        '''
+        query = f"%(vector)s::{self.__column_type}"
+        # file_name <> NULL 恒为NULL，未指定 exclude 时不能用该条件过滤
+        exclude_sql = "WHERE file_name <> %(exclude)s" if exclude else ""
+        if not paged:
+            candidates = f"SELECT file_name, embedding <=> {query} AS distance FROM {self.table} {exclude_sql}"
+        else:
+            candidates = self.__candidates_sql(query, exclude_sql, "%(k)s", "%(offset)s")
+        return f"""
+            SELECT file_name, 1 - distance FROM (
+                {candidates}
+            ) AS candidates
+            WHERE distance < %(max_dist)s
+            ORDER BY distance
+        """
+
+    def search_many_sql(self) -> str:
+        '''
+        返回 search_many 使用的SQL语句。每个查询向量执行一次按距离排序的 LATERAL 子查询，均可使用HNSW索引
+
+        :return: SQL语句，命名参数为 vectors、k、max_dist。结果列为 (查询序号, file_name, similarity)，查询序号从1开始
+        '''
+        return f"""
+            SELECT q.ord, candidates.file_name, 1 - candidates.distance
+            FROM unnest(%(vectors)s::vector[]) WITH ORDINALITY AS q(vec, ord)
+            CROSS JOIN LATERAL (
+                {self.__candidates_sql(f"q.vec::{self.__column_type}", "", "%(k)s", "0")}
+            ) AS candidates
+            WHERE candidates.distance < %(max_dist)s
+            ORDER BY q.ord, candidates.distance
+        """
+
+    def search(self, query_vector, max_dist: float, k: int | None = None, page: int = 0, ef_search: int | None = None,
+               exclude: str | None = None) -> List[Tuple[str, float]]:
+        params = {"vector": np.array(query_vector), "max_dist": max_dist, "exclude": exclude}
+        with db_init.connection() as conn, conn.cursor() as cur:
+            if k is not None:
+                offset = page * k
+                # 被排除的文件可能占用一个候选位置
+                self.__configure_search(cur, k + (exclude is not None), offset, ef_search)
+                params.update(k=k, offset=offset)
+            cur.execute(self.search_sql(k is not None, exclude is not None), params)
+            results = [(row[0], row[1]) for row in cur.fetchall()]
+            conn.commit()
+        return results
+
+    def iter_search(self, query_vector, max_dist: float, k: int | None = None, page: int = 0,
+                    ef_search: int | None = None, exclude: str | None = None,
+                    batch_size: int = 100) -> Iterator[List[Tuple[str, float]]]:
+        '''
+        通过服务端游标分批读取结果，不分页的大结果集不会一次性载入内存。迭代期间占用一个连接
+        '''
+        params = {"vector": np.array(query_vector), "max_dist": max_dist, "exclude": exclude}
+        with db_init.connection() as conn:
+            if k is not None:
+                offset = page * k
+                with conn.cursor() as cur:
+                    self.__configure_search(cur, k + (exclude is not None), offset, ef_search)
+                params.update(k=k, offset=offset)
+            # 命名游标在数据库端保存结果，与搜索参数处于同一事务
+            with conn.cursor(name="search_stream") as cur:
+                cur.itersize = batch_size
+                cur.execute(self.search_sql(k is not None, exclude is not None), params)
+                while rows := cur.fetchmany(batch_size):
+                    yield [(row[0], row[1]) for row in rows]
+            conn.commit()
+
+    def search_many(self, query_vectors: list, max_dist: float, k: int,
+                    ef_search: int | None = None) -> List[List[Tuple[str, float]]]:
+        results: List[List[Tuple[str, float]]] = [[] for _ in query_vectors]
+        if not query_vectors:
+            return results
+        query_vectors = [np.array(vector, dtype=np.float32) for vector in query_vectors]
+        with db_init.connection() as conn, conn.cursor() as cur:
+            self.__configure_search(cur, k, 0, ef_search)
+            cur.execute(self.search_many_sql(), {"vectors": query_vectors, "k": k, "max_dist": max_dist})
+            for ord, file_name, similarity in cur.fetchall():
+                results[ord - 1].append((file_name, similarity))
+            conn.commit()
+        return results
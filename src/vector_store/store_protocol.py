@@ -0,0 +1,159 @@
+from typing import Protocol, AsyncIterator, Dict, Iterator, List, Tuple, Any
+
+# 待写入的一行数据，格式为 (文件名, 嵌入向量, 文件大小, 修改时间, 内容哈希)
+Row = Tuple[str, Any, int | None, int | None, str | None]
+# 文件指纹，格式为 (文件大小, 修改时间, 内容哈希)，旧版本写入的记录可能为空
+Fingerprint = Tuple[int | None, int | None, str | None]
+
+
+class store(Protocol):
+    '''
+    向量存储。保存每个已索引文件的嵌入向量与文件指纹，并提供按余弦距离的top-k查询。
+    每次插入或删除数据后索引代数加一
+    '''
+
+    def generation(self) -> int:
+        '''
+        :return: 当前的索引代数
+        '''
+        ...
+
+    def fingerprints(self) -> Dict[str, Fingerprint]:
+        '''
+        :return: 所有已索引文件的指纹，格式为 {文件名: (文件大小, 修改时间, 内容哈希)}
+        '''
+        ...
+
+    def update_fingerprints(self, rows: List[Tuple[str, int, int, str]]) -> None:
+        '''
+        更新内容未变化的文件的指纹，不改变向量
+
+        :param rows: 格式为 [(文件名, 文件大小, 修改时间, 内容哈希), ...]
+        '''
+        ...
+
+    def write(self, rows: List[Row]) -> Dict[str, str]:
+        '''
+        写入一批向量，已存在的文件名会被更新
+
+        :param rows: 待写入的数据
+
+        :return: 写入失败的数据行，格式为 {文件名: 错误信息}
+        '''
+        ...
+
+    def copy(self, rows: List[Tuple[str, str, int, int, str]]) -> Dict[str, str]:
+        '''
+        复用已索引文件的向量写入新的文件名，用于重命名或内容重复的文件
+
+        :param rows: 格式为 [(文件名, 被复用的文件名, 文件大小, 修改时间, 内容哈希), ...]
+
+        :return: 写入失败的数据行，格式为 {文件名: 错误信息}
+        '''
+        ...
+
+    def delete(self, file_names: List[str]) -> None:
+        '''
+        删除文件的向量
+
+        :param file_names: 待删除的文件名
+        '''
+        ...
+
+    def clear(self) -> None:
+        '''
+        删除所有数据
+        '''
+        ...
+
+    def begin_load(self, count: int) -> None:
+        '''
+        在一次索引过程写入数据之前调用，存储可借此为大批量写入做准备
+
+        :param count: 预计写入的向量数量
+        '''
+        ...
+
+    def finish_load(self) -> None:
+        '''
+        在一次索引过程写入完成后调用，构建索引或将数据持久化
+        '''
+        ...
+
+    def get_vector(self, file_name: str) -> List[float] | None:
+        '''
+        读取已索引文件的嵌入向量
+
+        :param file_name: 文件名
+
+        :return: 嵌入向量，文件未被索引时返回None
+        '''
+        ...
+
+    def search(self, query_vector, max_dist: float, k: int | None = None, page: int = 0, ef_search: int | None = None,
+               exclude: str | None = None) -> List[Tuple[str, float]]:
+        '''
+        按向量查询相似的文件
+
+        :param query_vector: 查询向量
+        :param max_dist: 最大余弦距离
+        :param k: 每页返回的最大结果数，为None时返回全部满足距离要求的结果
+        :param page: 页码，从0开始，仅在指定k时有效
+        :param ef_search: 近似搜索的候选列表大小，为None时使用默认配置。精确搜索的存储会忽略该参数
+        :param exclude: 不出现在结果中的文件名
+
+        :return: 包含文件名和相似度的列表，按相似度从高到低排序，格式为 [(file_name, similarity), ...]
+        '''
+        ...
+
+    def iter_search(self, query_vector, max_dist: float, k: int | None = None, page: int = 0,
+                    ef_search: int | None = None, exclude: str | None = None,
+                    batch_size: int = 100) -> Iterator[List[Tuple[str, float]]]:
+        '''
+        与 search 相同，但按相似度从高到低分批返回结果，用于流式响应。
+        迭代未结束时存储可能一直占用资源（如数据库连接），不再需要时应关闭迭代器
+
+        :param batch_size: 每批最多包含的结果数
+
+        :return: 结果批次的迭代器，每批格式为 [(file_name, similarity), ...]
+        '''
+        ...
+
+    def search_many(self, query_vectors: list, max_dist: float, k: int,
+                    ef_search: int | None = None) -> List[List[Tuple[str, float]]]:
+        '''
+        按多个向量查询相似的文件
+
+        :param query_vectors: 查询向量列表
+        :param max_dist: 最大余弦距离
+        :param k: 每个查询返回的最大结果数
+        :param ef_search: 近似搜索的候选列表大小，为None时使用默认配置。精确搜索的存储会忽略该参数
+
+        :return: 与查询向量一一对应的结果列表，每项格式为 [(file_name, similarity), ...]
+        '''
+        ...
+
+
+class async_store(Protocol):
+    '''
+    向量存储的异步查询接口，供ASGI服务使用。各方法的参数与返回值与 store 的同名方法相同
+    '''
+
+    async def generation(self) -> int:
+        ...
+
+    async def get_vector(self, file_name: str) -> List[float] | None:
+        ...
+
+    async def search(self, query_vector, max_dist: float, k: int | None = None, page: int = 0, ef_search: int | None = None,
+                     exclude: str | None = None) -> List[Tuple[str, float]]:
+        ...
+
+    def iter_search(self, query_vector, max_dist: float, k: int | None = None, page: int = 0,
+                    ef_search: int | None = None, exclude: str | None = None,
+                    batch_size: int = 100) -> AsyncIterator[List[Tuple[str, float]]]:
+        ...
+
+    async def search_many(self, query_vectors: list, max_dist: float, k: int,
+                          ef_search: int | None = None) -> List[List[Tuple[str, float]]]:
+        ...
@@ -0,0 +1,59 @@
+import asyncio
+from typing import AsyncIterator, List, Tuple
+
+from vector_store.store_protocol import store, async_store
+from vector_store.pgvector_store import pgvector_store
+from vector_store.async_pgvector_store import async_pgvector_store
+
+
+class threaded_store:
+    '''
+    在线程池中调用同步存储，为没有异步实现的存储（如 numpy_store 的矩阵运算）提供异步查询接口
+    '''
+    store: store
+
+    def __init__(self, store: store):
+        '''
+        :param store: 被包装的同步存储
+        '''
+        self.store = store
+
+    async def generation(self) -> int:
+        return await asyncio.to_thread(self.store.generation)
+
+    async def get_vector(self, file_name: str) -> List[float] | None:
+        return await asyncio.to_thread(self.store.get_vector, file_name)
+
+    async def search(self, query_vector, max_dist: float, k: int | None = None, page: int = 0, ef_search: int | None = None,
+                     exclude: str | None = None) -> List[Tuple[str, float]]:
+        return await asyncio.to_thread(self.store.search, query_vector, max_dist, k=k, page=page,
+                                       ef_search=ef_search, exclude=exclude)
+
+    async def iter_search(self, query_vector, max_dist: float, k: int | None = None, page: int = 0,
+                          ef_search: int | None = None, exclude: str | None = None,
+                          batch_size: int = 100) -> AsyncIterator[List[Tuple[str, float]]]:
+        iterator = self.store.iter_search(query_vector, max_dist, k=k, page=page, ef_search=ef_search,
+                                          exclude=exclude, batch_size=batch_size)
+        try:
+            while (batch := await asyncio.to_thread(next, iterator, None)) is not None:
+                yield batch
+        finally:
+            # 提前结束时在线程池中关闭迭代器，释放其占用的资源
+            await asyncio.to_thread(iterator.close)
+
+    async def search_many(self, query_vectors: list, max_dist: float, k: int,
+                          ef_search: int | None = None) -> List[List[Tuple[str, float]]]:
+        return await asyncio.to_thread(self.store.search_many, query_vectors, max_dist, k, ef_search=ef_search)
+
+
+def as_async(store: store) -> async_store:
+    '''
+    返回存储的异步查询接口。pgvector_store 使用异步连接池，其他存储在线程池中调用
+
+    :param store: 同步存储
+
+    :return: 异步查询接口
+    '''
+    if isinstance(store, pgvector_store):
+        return async_pgvector_store(store)
+    return threaded_store(store)